@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Local benchmark harness for BFHRF.
+Generates synthetic tree sets of n taxa and k trees, times and memory-profiles each stage of
+BipartitionFrequencyHash.py (reading, create_bipartition_set, rf_bfh, output) in a fresh process per run, optionally
+runs DendropySingle.py and DendropySingleMP.py on the same files, and writes one JSON/CSV record per stage so results
+can be compared between commits.
+"""
+
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import numpy as np
+from time import time, process_time
+
+__author__ = "Alvin Chon"
+__email__ = "achon@iastate.edu"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+here = os.path.dirname(os.path.abspath(__file__))
+stage_names = ["reading", "create_bipartition_set", "rf_bfh", "output"]
+
+
+def random_tree_template(n, rng):
+    """
+    Random binary tree shape over n leaf slots, built by joining random pairs of subtrees.
+    :param n: number of taxa
+    :param rng: random.Random
+    :return: Newick template with str.format slots {0}..{n-1} for the leaves
+    """
+    subtrees = ["{" + str(i) + "}" for i in range(n)]
+    while len(subtrees) > 2:
+        i, j = sorted(rng.sample(range(len(subtrees)), 2))
+        right = subtrees.pop(j)
+        subtrees[i] = "(" + subtrees[i] + "," + right + ")"
+    return "(" + ",".join(subtrees) + ");"
+
+
+def generate_trees(trees_file, n, k, swaps, seed, branch_lengths=True):
+    """
+    Writes k trees over taxa t0..t{n-1}, one Newick tree per line.  Every tree is the same random species tree with
+    `swaps` random pairs of leaves exchanged, so the trees share bipartitions like gene trees do; swaps >= n gives
+    unrelated random labelings.
+    :param trees_file:
+    :param n: number of taxa
+    :param k: number of trees
+    :param swaps: leaf swaps per tree
+    :param seed:
+    :param branch_lengths: append random branch lengths to the leaves
+    :return:
+    """
+    rng = random.Random(seed)
+    template = random_tree_template(n, rng)
+    taxa = ["t" + str(i) for i in range(n)]
+    with open(trees_file, 'w') as ofh:
+        for _ in range(k):
+            labels = list(taxa)
+            for _ in range(swaps):
+                i, j = rng.randrange(n), rng.randrange(n)
+                labels[i], labels[j] = labels[j], labels[i]
+            if branch_lengths:
+                labels = ["{}:{:.3f}".format(label, rng.random()) for label in labels]
+            ofh.write(template.format(*labels) + "\n")
+
+
+def peak_rss_reset():
+    """
+    Resets the peak RSS (VmHWM) of this process where Linux allows it.
+    :return: True if per-stage peaks are available
+    """
+    try:
+        with open("/proc/self/clear_refs", 'w') as fh:
+            fh.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def peak_rss_kb():
+    """
+    Peak RSS of this process in kB: VmHWM since the last reset, else the lifetime maximum.
+    :return:
+    """
+    try:
+        with open("/proc/self/status") as fh:
+            for line in fh:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def children_cpu_s():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def stage_runner(args):
+    """
+    Runs the BFHRF stages in this process and prints one JSON list of stage records.
+    Worker CPU time and peak RSS are taken from the reaped pool processes (RUSAGE_CHILDREN); the children peak RSS
+    is the largest worker so far, not a per-stage value.
+    :param args:
+    :return:
+    """
+    sys.path.insert(0, here)
+    import BipartitionFrequencyHash as bfhrf
+    bfh = bfhrf.BFH(backend=args.bfh_backend, num_cpu=int(args.num_cpu), cache_size=int(args.cache_size),
+                    num_taxa=int(args.num_taxa))
+    stages = []
+    state = {}
+
+    def reading():
+        state["ref"] = open(args.ref_trees, 'r').readlines()
+        state["query"] = open(args.query_trees, 'r').readlines()
+        bfh.taxon_map = {label: i for i, label in enumerate(bfhrf.newick_taxa(state["ref"][0]))}
+        bfh.num_ref_trees = len(state["ref"])
+
+    def create_bipartition_set():
+        bfhrf.create_bipartition_set(bfh, state["ref"])
+
+    def rf_bfh():
+        state["rows"] = bfhrf.rf_bfh(bfh, state["query"])
+
+    def output():
+        ofh = open(args.output_file, 'w')
+        for tree_name, avg_norm_rf in state["rows"]:
+            ofh.write("{},{}\n".format(tree_name, str(avg_norm_rf)))
+        ofh.close()
+
+    for name, stage in zip(stage_names, [reading, create_bipartition_set, rf_bfh, output]):
+        per_stage_peak = peak_rss_reset()
+        wall_start, cpu_start, children_start = time(), process_time(), children_cpu_s()
+        stage()
+        stages.append({"stage": name,
+                       "wall_s": time() - wall_start,
+                       "cpu_s": process_time() - cpu_start,
+                       "workers_cpu_s": children_cpu_s() - children_start,
+                       "peak_rss_kb": peak_rss_kb() if per_stage_peak else None,
+                       "workers_peak_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss})
+    stages[0]["num_ref_trees"] = len(state["ref"])
+    stages[1]["unique_bipartitions"] = len(bfh)
+    if args.bfh_backend == "array":
+        stages[1]["bfh_bytes"] = bfh.ref_trees_bipartitions.nbytes()
+    stages[2]["num_query_trees"] = len(state["rows"])
+    print(json.dumps(stages))
+
+
+def run_measured(command):
+    """
+    Runs a command and measures it with wait4, which includes the CPU time and peak RSS of its reaped children.
+    :param command:
+    :return: (stdout, wall_s, cpu_s, peak_rss_kb)
+    """
+    start_time = time()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=here)
+    stdout = process.stdout.read().decode()
+    process.stdout.close()
+    pid, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, "waitstatus_to_exitcode") else status
+    wall_time = time() - start_time
+    if process.returncode != 0:
+        raise RuntimeError("{} failed with status {}:\n{}".format(" ".join(command), process.returncode, stdout))
+    return stdout, wall_time, usage.ru_utime + usage.ru_stime, usage.ru_maxrss
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=here,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(args):
+    """
+    Runs every (n, k) configuration and writes the records.
+    :param args:
+    :return:
+    """
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="bfhrf_bench_")
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    run_info = {"commit": git_commit(), "python": platform.python_version(), "numpy": np.__version__,
+                "machine": platform.machine(), "cpu_count": os.cpu_count(), "num_cpu": int(args.num_cpu),
+                "seed": args.seed, "swaps": args.swaps}
+    records = []
+    begin_time = time()
+    for n in [int(v) for v in args.n.split(",")]:
+        for k in [int(v) for v in args.k.split(",")]:
+            trees_file = os.path.join(data_dir, "trees.{}.{}".format(n, k))
+            start_time = time()
+            generate_trees(trees_file, n, k, args.swaps, args.seed)
+            print("|Generated {} trees of {} taxa: {}s".format(k, n, np.around(time() - start_time, 2)))
+            config = dict(run_info, n=n, k=k)
+            output_file = os.path.join(data_dir, "output.{}.{}".format(n, k))
+            for repeat in range(int(args.repeats)):
+                command = [sys.executable, os.path.abspath(__file__), "-stage_runner", trees_file, trees_file,
+                           str(n), args.num_cpu, output_file, "-bfh_backend", args.bfh_backend,
+                           "-cache_size", str(args.cache_size)]
+                stdout, wall_time, cpu_time, peak_rss = run_measured(command)
+                stages = json.loads(stdout.strip().splitlines()[-1])
+                for stage in stages:
+                    records.append(dict(config, tool="bfhrf", repeat=repeat, **stage))
+                records.append(dict(config, tool="bfhrf", repeat=repeat, stage="total", wall_s=wall_time,
+                                    cpu_s=cpu_time, peak_rss_kb=peak_rss))
+                print("||bfhrf n={} k={} repeat {}: {}".format(n, k, repeat, ", ".join(
+                    "{} {}s".format(stage["stage"], np.around(stage["wall_s"], 3)) for stage in stages)))
+                if args.baselines and k <= int(args.baselines_max_k):
+                    for tool, script, extra in (("DendropySingle", "DendropySingle.py", []),
+                                                ("DendropySingleMP", "DendropySingleMP.py", [args.num_cpu])):
+                        command = [sys.executable, os.path.join(here, script), trees_file, trees_file, str(n)] + \
+                                  extra + ["-output_file", output_file + "." + tool]
+                        stdout, wall_time, cpu_time, peak_rss = run_measured(command)
+                        records.append(dict(config, tool=tool, repeat=repeat, stage="total", wall_s=wall_time,
+                                            cpu_s=cpu_time, peak_rss_kb=peak_rss))
+                        print("||{} n={} k={} repeat {}: {}s".format(tool, n, k, repeat, np.around(wall_time, 3)))
+    if args.format == "csv":
+        fields = []
+        for record in records:
+            fields.extend(field for field in record if field not in fields)
+        with open(args.output_file, 'w', newline='') as ofh:
+            writer = csv.DictWriter(ofh, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(records)
+    else:
+        with open(args.output_file, 'w') as ofh:
+            json.dump(records, ofh, indent=1)
+    if not args.data_dir and not args.keep_data:
+        shutil.rmtree(data_dir)
+    print("|Wrote {} records to {}".format(len(records), args.output_file))
+    print('|STATS: TOTAL TIME: {}s'.format(np.around(time() - begin_time, 2)))
+
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    parser = argparse.ArgumentParser(description='Benchmark BFHRF stages on synthetic trees')
+    if len(sys.argv) > 1 and sys.argv[1] == "-stage_runner":
+        parser.add_argument("-stage_runner", action="store_true")
+        parser.add_argument("ref_trees")
+        parser.add_argument("query_trees")
+        parser.add_argument("num_taxa")
+        parser.add_argument("num_cpu")
+        parser.add_argument("output_file")
+        parser.add_argument("-bfh_backend", choices=["array", "dict"], default="array")
+        parser.add_argument("-cache_size", default=65536)
+        stage_runner(parser.parse_args())
+        sys.exit(0)
+    parser.add_argument("-n", help="Comma separated numbers of taxa, default=50,100", default="50,100")
+    parser.add_argument("-k", help="Comma separated numbers of trees, default=1000,5000", default="1000,5000")
+    parser.add_argument("-num_cpu", help="Number of CPUs, default=2", default="2")
+    parser.add_argument("-repeats", help="Runs per configuration, default=3", default=3)
+    parser.add_argument("-swaps", help="Leaf swaps between each generated tree and the species tree, default=5",
+                        type=int, default=5)
+    parser.add_argument("-seed", help="Random seed of the tree generator, default=1", type=int, default=1)
+    parser.add_argument("-bfh_backend", help="BFH storage, default=array", choices=["array", "dict"],
+                        default="array")
+    parser.add_argument("-cache_size", help="Score cache slots, default=65536", type=int, default=65536)
+    parser.add_argument("-baselines", help="Also run DendropySingle.py and DendropySingleMP.py (needs Dendropy)",
+                        action="store_true")
+    parser.add_argument("-baselines_max_k", help="Only run the baselines up to this many trees, default=1000",
+                        default=1000)
+    parser.add_argument("-data_dir", help="Keep generated trees here, default=temporary directory", default=None)
+    parser.add_argument("-keep_data", help="Keep the temporary directory of generated trees", action="store_true")
+    parser.add_argument("-format", help="Results format, default=json", choices=["json", "csv"], default="json")
+    parser.add_argument("-output_file", help="Results file, default=bfhrf_bench.json", default="bfhrf_bench.json")
+    input_args = parser.parse_args()
+    print(input_args)
+    benchmark(input_args)
@@ -6,11 +6,49 @@ This allows us to do a q vs BFH_R for all trees in Q.
 """
 
 import argparse
-import dendropy
+import asyncio
+import bz2
+import cProfile
+import csv
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import lzma
+import os
+import queue
+import re
+import signal
+import socket
+import sys
+import threading
+import tracemalloc
 import numpy as np
-from time import time
-from multiprocessing import Pool
-from math import ceil
+from time import time, process_time
+from multiprocessing import get_context, shared_memory, util
+from math import ceil, e, log
+from contextlib import contextmanager, nullcontext
+from functools import partial
+from itertools import chain, islice
+
+try:
+    import resource
+except ImportError:  # not available on Windows; peak RSS is then not reported
+    resource = None
+
+try:
+    import dendropy
+except ImportError:  # only needed for -parser dendropy and -validate
+    dendropy = None
+try:
+    from scipy import sparse
+except ImportError:  # only needed for the matrix command
+    sparse = None
+try:
+    import zstandard
+except ImportError:  # only needed for .zst tree files
+    zstandard = None
 
 __author__ = "Alvin Chon"
 __email__ = "achon@iastate.edu"
@@ -18,118 +56,2033 @@ __version__ = "0.1.0"
 __license__ = "MIT"
 
 # globals
-tns = dendropy.TreeList.taxon_namespace
-ref_trees_bipartitions = {}
-num_taxa = 0
-num_cpu = 0
-num_ref_trees = 0
-ref_trees_keys = []
-ref_trees_sum = 0
-bipartition_range = []
-
-
-# def parse_tree_size(tree):
-#     """
-#     Parse a tree (Newick str), generate bipartitions, filter based upon sizes, and return bipartitions.
-#     :param tree:
-#     :return:
-#     """
-#     tree_object = dendropy.Tree.get(data=tree, schema="newick", taxon_namespace=tns)
-#     tree_object.encode_bipartitions()
-#     bps = []
-#     size_check = True
-#     if filter_list == [i for i in range(2, ceil(num_taxa / 2) + 1)]:
-#         size_check = False
-#     for bbp in tree_object.encode_bipartitions():
-#         bp = bin(bbp.split_bitmask)[2:].zfill(num_taxa)
-#         if size_check:
-#             if bp.count('0') <= bp.count('1'):
-#                 char_count = bp.count('0')
-#             else:
-#                 char_count = bp.count('1')
-#             if char_count in filter_list:
-#                 bps.append(bp)
-#         else:
-#             bps.append(bp)
-#     return bps
-
-def parse_tree(tree):
-    """
-    Parse a tree (Newick str) and return Dendropy tree object w/ bipartitions.
-    :param tree:
+# pool workers: the worker's BFH and the shared segments of its pool, set by init_worker
+worker_bfh = None
+bfh_segment = None
+score_cache = None
+worker_stats = None
+rf_threshold = None
+rf_threshold_segment = None
+# profiling hooks of this process, set by start_instrumentation
+progress_interval = 0
+profile_dir = None
+trace_memory = False
+profiler = None
+index_magic = b'BFHRF-INDEX\n'
+index_version = 2
+
+
+# comments, quoted labels, punctuation, branch lengths, unquoted labels, whitespace
+newick_token = re.compile(r"\[[^\]]*\]|'(?:[^']|'')*'|[(),;]|:[^(),;\[]*|[^(),;:\[\s']+|\s+")
+# characters that start or end a comment, a quoted label or a statement
+statement_delimiter = re.compile(r"[\[\]';]")
+compression_magic = [(b'\x1f\x8b', "gzip"), (b'BZh', "bz2"), (b'\xfd7zXZ\x00', "xz"), (b'\x28\xb5\x2f\xfd', "zstd")]
+
+
+def newick_label(token):
+    """
+    Taxon label of a Newick label token, following Dendropy: quotes are stripped, underscores become spaces.
+    :param token:
+    :return:
+    """
+    if token[0] == "'":
+        return token[1:-1].replace("''", "'")
+    return token.replace('_', ' ')
+
+
+def newick_quote(label):
+    """
+    Writes a taxon label so that newick_label reads it back.
+    :param label:
+    :return:
+    """
+    if "_" in label or "'" in label or any(c in label for c in "(),:;[]"):
+        return "'" + label.replace("'", "''") + "'"
+    return label.replace(' ', '_')
+
+
+def newick_taxa(tree_str):
+    """
+    Leaf labels of a Newick tree in order of appearance, i.e. the order of Dendropy's taxon namespace.
+    :param tree_str:
+    :return:
+    """
+    labels = []
+    after_close = False
+    for token in newick_token.findall(tree_str):
+        c = token[0]
+        if c in '(,':
+            after_close = False
+        elif c == ')':
+            after_close = True
+        elif c == ';':
+            break
+        elif c not in ':[' and not c.isspace() and not after_close:
+            labels.append(newick_label(token))
+    return labels
+
+
+def newick_bitmasks(tree_str, taxa):
+    """
+    Tokenize a Newick tree and return its split bitmasks without building a tree object.
+    Matches Dendropy's encode_bipartitions(): unifurcations suppressed, unrooted splits normalized so that the
+    lowest taxon is 0, basal bifurcation of unrooted trees collapsed, root edge last.
+    Like Dendropy, rejects trees that are truncated (open parentheses or no ';') or repeat a taxon.
+    :param tree_str:
+    :param taxa: taxon label -> bit index
+    :return: list of split bitmasks, one per edge
+    """
+    is_rooted = False
+    leafsets = []
+    stack = []
+    children = []
+    tree_leafset = 0
+    after_close = False
+    root_closed = False
+    terminated = False
+    for token in newick_token.findall(tree_str):
+        c = token[0]
+        if root_closed and c in '(),':
+            raise ValueError("Unbalanced parentheses in tree: {}".format(tree_str.strip()))
+        if c == '(':
+            stack.append(children)
+            children = []
+            after_close = False
+        elif c == ',':
+            after_close = False
+        elif c == ')':
+            leafset = 0
+            for child in children:
+                leafset |= child
+            if not stack:
+                raise ValueError("Unbalanced parentheses in tree: {}".format(tree_str.strip()))
+            parent = stack.pop()
+            if stack:
+                if len(children) > 1:  # unifurcations are suppressed, their child edge stands in
+                    leafsets.append(leafset)
+                parent.append(leafset)
+                children = parent
+            else:
+                root_closed = True  # only the root's label, branch length and comments may follow
+            after_close = True
+        elif c == ';':
+            terminated = True
+            break
+        elif c == '[':
+            if not leafsets and not stack:
+                is_rooted = token[:3].upper() == '[&R'
+        elif c != ':' and not c.isspace() and not after_close:
+            try:
+                leafset = 1 << taxa[newick_label(token)]
+            except KeyError:
+                raise ValueError("Taxon '{}' is not in the taxon namespace of the first reference tree".format(
+                    newick_label(token)))
+            if tree_leafset & leafset:
+                raise ValueError("Taxon '{}' occurs more than once in tree: {}".format(newick_label(token),
+                                                                                      tree_str.strip()))
+            tree_leafset |= leafset
+            leafsets.append(leafset)
+            children.append(leafset)
+    if stack:
+        raise ValueError("Unbalanced parentheses in tree: {}".format(tree_str.strip()))
+    if not terminated:
+        raise ValueError("Tree is not terminated by ';': {}".format(tree_str.strip()))
+    if len(children) == 1:  # unifurcating root, its only child edge is the root edge
+        leafsets.pop()
+    elif not is_rooted and len(children) == 2 and any(child & (child - 1) for child in children):
+        leafsets.pop()  # both root children normalize to the same split, keep one
+    leafsets.append(tree_leafset)
+    if is_rooted:
+        return leafsets
+    lowest_bit = tree_leafset & -tree_leafset
+    return [tree_leafset & ~leafset if leafset & lowest_bit else leafset for leafset in leafsets]
+
+
+def dendropy_bitmasks(bfh, tree_str):
+    """
+    Split bitmasks of a Newick tree parsed through Dendropy.  Reference path for the Newick tokenizer.
+    :param bfh: BFH whose taxon namespace the tree is read into
+    :param tree_str:
     :return:
     """
-    tree_object = dendropy.Tree.get(data=tree, schema="newick", taxon_namespace=tns)
+    tree_object = dendropy.Tree.get(data=tree_str, schema="newick", taxon_namespace=bfh.tns)
     tree_object.encode_bipartitions()
-    return tree_object.bipartition_encoding
+    return [bp.split_bitmask for bp in tree_object.bipartition_encoding]
 
 
-def create_bipartition_set(ref_trees_files):
+def parse_tree(bfh, tree):
     """
-    Parse trees dynamically and build the bfh.
-    :param ref_trees_files:
+    Parse a tree (Newick str) and return the split bitmasks of its bipartitions.
+    :param bfh: BFH whose parser and taxon order are used
+    :param tree:
+    :return:
+    """
+    if bfh.tree_parser == "dendropy":
+        return dendropy_bitmasks(bfh, tree)
+    return newick_bitmasks(tree, bfh.taxon_map)
+
+
+def compression(trees_file):
+    """
+    :param trees_file:
+    :return: "gzip", "bz2", "xz" or "zstd" from the file's magic number, or None for an uncompressed file
+    """
+    with open(trees_file, 'rb') as ifh:
+        magic = ifh.read(6)
+    for prefix, name in compression_magic:
+        if magic.startswith(prefix):
+            return name
+    return None
+
+
+def open_trees(trees_file):
+    """
+    Opens a tree file as text, decompressing gzip, bz2, xz or zstd on the fly.
+    :param trees_file:
+    :return:
+    """
+    method = compression(trees_file)
+    if method == "gzip":
+        return gzip.open(trees_file, 'rt')
+    if method == "bz2":
+        return bz2.open(trees_file, 'rt')
+    if method == "xz":
+        return lzma.open(trees_file, 'rt')
+    if method == "zstd":
+        if zstandard is None:
+            raise ImportError("The zstandard package is required for zstd-compressed tree files")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(trees_file, 'rb'), closefd=True))
+    return open(trees_file, 'r')
+
+
+def split_statements(lines, numbered=False):
+    """
+    Splits text into ';'-terminated statements, e.g. Newick trees, ignoring ';' in [comments] and 'quoted labels'.
+    A line holding exactly one whole statement is yielded as it is; statements spanning or sharing lines are joined
+    onto one line.  Blank text between statements is skipped, and text after the last ';' is yielded if not blank.
+    :param lines: iterable of text lines
+    :param numbered: yield (0-based index of the line holding the statement's ';', statement) pairs
+    :return:
+    """
+    buffer = []
+    in_comment = False
+    in_quote = False
+    line_index = -1
+    for line_index, line in enumerate(lines):
+        if not buffer and line.count(';') == 1 and line.rstrip().endswith(';') and '[' not in line and \
+                "'" not in line:
+            yield (line_index, line) if numbered else line
+            continue
+        start = 0
+        for match in statement_delimiter.finditer(line):
+            c = match.group()
+            if in_comment:
+                in_comment = c != ']'
+            elif in_quote:
+                in_quote = c != "'"
+            elif c == '[':
+                in_comment = True
+            elif c == "'":
+                in_quote = True
+            elif c == ';':
+                buffer.append(line[start:match.end()])
+                statement = ' '.join(part.strip() for part in ''.join(buffer).splitlines()).strip() + "\n"
+                yield (line_index, statement) if numbered else statement
+                buffer = []
+                start = match.end()
+        if buffer or line[start:].strip():
+            buffer.append(line[start:])
+    if ''.join(buffer).strip():
+        statement = ' '.join(part.strip() for part in ''.join(buffer).splitlines()).strip() + "\n"
+        yield (line_index, statement) if numbered else statement
+
+
+def translate_labels(tree_str, translation):
+    """
+    Applies a Nexus TRANSLATE table to the leaf labels of a Newick string.
+    :param tree_str:
+    :param translation: token label -> taxon label
+    :return:
+    """
+    parts = []
+    after_close = False
+    for token in newick_token.findall(tree_str):
+        c = token[0]
+        if c in '(,':
+            after_close = False
+        elif c == ')':
+            after_close = True
+        elif c not in ':;[' and not c.isspace() and not after_close and newick_label(token) in translation:
+            token = newick_quote(translation[newick_label(token)])
+        parts.append(token)
+    return ''.join(parts)
+
+
+def nexus_trees(statements):
+    """
+    Trees of the TREES blocks of a Nexus file, as Newick strings with the TRANSLATE table applied.
+    :param statements: ';'-terminated statements of the file, from split_statements
+    :return:
+    """
+    in_trees = False
+    translation = {}
+    for statement in statements:
+        words = statement.split(None, 2)
+        command = words[0].lower() if words else ''
+        if command == "begin":
+            in_trees = len(words) > 1 and words[1].rstrip(';').lower() == "trees"
+        elif command in ("end", "endblock"):
+            in_trees = False
+        elif in_trees and command == "translate":
+            for entry in statement.strip()[len("translate"):].rstrip().rstrip(';').split(','):
+                tokens = [token for token in newick_token.findall(entry) if not token[0].isspace()]
+                if len(tokens) == 2:
+                    translation[newick_label(tokens[0])] = newick_label(tokens[1])
+        elif in_trees and command in ("tree", "utree"):
+            depth = 0
+            for i, c in enumerate(statement):  # the first '=' outside comments, e.g. tree t [&lnP=-5.2] = ...
+                depth += (c == '[') - (c == ']')
+                if c == '=' and depth == 0:
+                    break
+            tree_str = statement[i + 1:].strip() + "\n"
+            yield translate_labels(tree_str, translation) if translation else tree_str
+
+
+def iter_trees(trees_file):
+    """
+    Trees of a Newick (one or more trees per line, or trees spanning lines) or Nexus file, compressed or not.
+    :param trees_file:
+    :return:
+    """
+    with open_trees(trees_file) as ifh:
+        first_line = ''
+        for first_line in ifh:
+            if first_line.strip():
+                break
+        if first_line.strip().upper().startswith("#NEXUS"):
+            yield from nexus_trees(split_statements(ifh))
+        else:
+            yield from split_statements(chain([first_line], ifh))
+
+
+def produce_trees(trees_file, trees_queue, stop, chunk_size=256):
+    """
+    Producer stage of read_trees: decompresses and splits a tree file in its own thread and hands the trees over in
+    chunks through a bounded queue, ending with None, or with the exception it raised.
+    :param trees_file:
+    :param trees_queue:
+    :param stop: event set by the consumer when it stops reading
+    :param chunk_size: trees per queue item
+    :return:
+    """
+    try:
+        chunk = []
+        for tree in iter_trees(trees_file):
+            chunk.append(tree)
+            if len(chunk) == chunk_size:
+                if not put_chunk(trees_queue, chunk, stop):
+                    return
+                chunk = []
+        if chunk and not put_chunk(trees_queue, chunk, stop):
+            return
+        put_chunk(trees_queue, None, stop)
+    except Exception as e:
+        put_chunk(trees_queue, e, stop)
+
+
+def put_chunk(trees_queue, chunk, stop):
+    """
+    :return: False if the consumer stopped reading before the chunk could be queued
+    """
+    while not stop.is_set():
+        try:
+            trees_queue.put(chunk, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def is_plain_newick(trees_file):
+    """
+    :param trees_file:
+    :return: whether the file is uncompressed and not Nexus, so it can be read (and sharded) line by line
+    """
+    if compression(trees_file) is not None:
+        return False
+    with open(trees_file, 'r') as ifh:
+        for line in ifh:
+            if line.strip():
+                return not line.strip().upper().startswith("#NEXUS")
+    return True
+
+
+def read_trees(trees_file, line_range=None):
+    """
+    Lazily yields the trees of a tree file, skipping blank lines.  Plain Newick files are read line by line; trees
+    spanning lines or sharing a line are split at their ';'.  Compressed (gzip, bz2, xz, zstd) and Nexus files are
+    decompressed and split by a producer thread that stays at most 16 chunks of trees ahead, so the file is never
+    held in memory.
+    :param trees_file:
+    :param line_range: (first, end) 0-based half-open range to read, from shard_line_range: of file lines for plain
+                       Newick files, where a tree spanning lines belongs to the line of its ';', of trees otherwise
+    :return:
+    """
+    if is_plain_newick(trees_file):
+        with open(trees_file, 'r') as ifh:
+            if line_range is None:
+                yield from split_statements(ifh)
+                return
+            first, end = line_range
+            for line_index, tree in split_statements(islice(ifh, end), numbered=True):
+                # unterminated text at the end of the range is the start of a tree of the next range
+                if line_index >= first and (tree.rstrip().endswith(';') or next(ifh, None) is None):
+                    yield tree
+        return
+    trees_queue = queue.Queue(maxsize=16)
+    stop = threading.Event()
+    threading.Thread(target=produce_trees, args=(trees_file, trees_queue, stop), daemon=True).start()
+    trees = produced_trees(trees_queue)
+    try:
+        yield from (trees if line_range is None else islice(trees, *line_range))
+    finally:
+        stop.set()
+
+
+def produced_trees(trees_queue):
+    """
+    Consumer side of produce_trees.
+    :param trees_queue:
+    :return:
+    """
+    while True:
+        chunk = trees_queue.get()
+        if chunk is None:
+            return
+        if isinstance(chunk, Exception):
+            raise chunk
+        yield from chunk
+
+
+def shard_line_range(trees_file, shard=None, lines=None):
+    """
+    Line range of a -shard or -lines selection of a tree file, so that separate processes (e.g. one per node) can
+    each build a partial BFH or score a part of the query file.  A tree spanning lines is read by the selection
+    holding the line of its ';', so shards never cut a tree.  Compressed and Nexus files are sharded by trees rather
+    than lines, which takes a pass over the file to count them.
+    :param trees_file:
+    :param shard: "I/N": the I-th (0-based) of N contiguous, near-equal blocks of lines
+    :param lines: "START-END": 1-based file lines START to END inclusive, as in sed -n START,ENDp
+    :return: (first, end) 0-based half-open line range, or None for the whole file
+    """
+    if shard:
+        index, num_shards = [int(value) for value in shard.split('/')]
+        if not 0 <= index < num_shards:
+            raise ValueError("Shard {} is not in 0..{}".format(index, num_shards - 1))
+        if is_plain_newick(trees_file):
+            with open(trees_file, 'rb') as ifh:
+                num_lines = sum(1 for _ in ifh)
+        else:
+            num_lines = sum(1 for _ in read_trees(trees_file))
+        return index * num_lines // num_shards, (index + 1) * num_lines // num_shards
+    if lines:
+        first, last = [int(value) for value in lines.split('-')]
+        if first < 1 or last < first:
+            raise ValueError("Invalid line range {}".format(lines))
+        return first - 1, last
+    return None
+
+
+class BatchWindow(object):
+    """
+    Bounds how far a pool's task feeder reads ahead: the feeder takes a slot per batch and the consumer frees it once
+    the batch is done.  After an error the consumer closes the window, so a feeder waiting for a slot stops instead
+    of blocking the pool's shutdown.
+    """
+
+    def __init__(self, size):
+        self.slots = threading.Semaphore(size)
+        self.closed = False
+
+    def acquire(self):
+        """
+        Waits for a free slot.
+        :return: False once the window is closed
+        """
+        self.slots.acquire()
+        if self.closed:
+            self.slots.release()  # pass the wakeup on
+            return False
+        return True
+
+    def release(self):
+        self.slots.release()
+
+    def close(self):
+        self.closed = True
+        self.slots.release()
+
+
+def tree_batches(trees, batch_size, window=None):
+    """
+    Groups trees into (index of the first tree, trees) batches.  With a BatchWindow, each batch waits for a free
+    slot, which bounds how far a pool's task feeder reads ahead; consumers release a slot per finished batch.
+    :param trees:
+    :param batch_size:
+    :param window:
+    :return:
+    """
+    start = 0
+    batch = []
+    for tree in trees:
+        batch.append(tree)
+        if len(batch) == batch_size:
+            if window is not None and not window.acquire():
+                return
+            yield start, batch
+            start += len(batch)
+            batch = []
+    if batch:
+        if window is not None and not window.acquire():
+            return
+        yield start, batch
+
+
+def validate_parser(bfh, trees):
+    """
+    Checks the Newick tokenizer against Dendropy, tree by tree.
+    :param bfh:
+    :param trees:
+    :return: indices of the trees whose bipartitions differ
+    """
+    mismatches = []
+    for i, tree in enumerate(trees):
+        if sorted(newick_bitmasks(tree, bfh.taxon_map)) != sorted(dendropy_bitmasks(bfh, tree)):
+            mismatches.append(i)
+    return mismatches
+
+
+class BipartitionArray(object):
+    """
+    Compact BFH: split bitmasks as a sorted array of fixed-width keys (big-endian uint64 words, most significant
+    word first) with a parallel array of counts.  Lookups are vectorized with searchsorted.
+    The popcount of each split is stored in the spare high bits of its key, so the array is bucketed by split size:
+    each popcount is a contiguous run, and per-bucket sums of counts let size-filtered queries skip other buckets.
+    """
+
+    def __init__(self, keys, counts, num_taxa):
+        self.num_taxa = num_taxa
+        size_bits = max(num_taxa.bit_length(), 1)
+        self.num_words = max(ceil((num_taxa + size_bits) / 64), 1)
+        self.size_shift = 64 * self.num_words - size_bits
+        self.key_dtype = np.dtype((np.void, 8 * self.num_words))
+        self.keys_array = keys
+        self.counts = counts
+        self.bucket_offsets = None
+        self.bucket_sums = None
+        self.source = None  # index file, offsets and file identity when memory-mapped by read_index
+
+    @classmethod
+    def from_counts(cls, bitmask_counts, num_taxa):
+        """
+        Builds the sorted arrays from a dict of split bitmask -> count.
+        :param bitmask_counts:
+        :param num_taxa:
+        :return:
+        """
+        bfh = cls(None, None, num_taxa)
+        keys = bfh.encode(bitmask_counts.keys())
+        counts = np.fromiter(bitmask_counts.values(), dtype=np.uint32, count=len(bitmask_counts))
+        order = np.argsort(keys, kind='stable')
+        bfh.keys_array = keys[order]
+        bfh.counts = counts[order]
+        return bfh
+
+    def merge(self, other, subtract=False):
+        """
+        Sums two BFHs into a new one, or subtracts other from this one.  Bipartitions whose count reaches zero are
+        dropped.  Both key arrays are already sorted, so other's keys are located in this one with searchsorted: shared
+        keys get their counts added, new keys are inserted at their positions, and nothing is re-sorted.  The cost is
+        O(D log U) for the lookups plus one copy of the U counts (and keys, when keys are inserted or dropped).
+        :param other: BFH with keys of the same width, e.g. a delta counted from the trees to add or remove
+        :param subtract:
+        :return:
+        """
+        if len(other) == 0:
+            return BipartitionArray(self.keys_array, self.counts, self.num_taxa)
+        if len(self) == 0 and not subtract:
+            return BipartitionArray(other.keys_array, other.counts, self.num_taxa)
+        positions = np.searchsorted(self.keys_array, other.keys_array)
+        found = positions < len(self.keys_array)
+        found[found] = self.keys_array[positions[found]] == other.keys_array[found]
+        counts = self.counts.astype(np.int64)
+        delta = other.counts.astype(np.int64)
+        if subtract:
+            if not found.all() or (counts[positions] < delta).any():
+                raise ValueError("Cannot remove bipartitions that are not in the BFH")
+            counts[positions] -= delta
+            if counts[positions].all():
+                return BipartitionArray(self.keys_array, counts.astype(np.uint32), self.num_taxa)
+            keep = counts > 0
+            return BipartitionArray(self.keys_array[keep], counts[keep].astype(np.uint32), self.num_taxa)
+        counts[positions[found]] += delta[found]
+        new = ~found
+        keys = np.insert(self.keys_array, positions[new], other.keys_array[new])
+        counts = np.insert(counts, positions[new], delta[new])
+        return BipartitionArray(keys, counts.astype(np.uint32), self.num_taxa)
+
+    def widened(self, num_taxa):
+        """
+        The same BFH with keys sized for num_taxa.  Keys order by popcount and then bitmask at any width, so the
+        re-encoded keys stay sorted.
+        :param num_taxa: at least self.num_taxa
+        :return: BipartitionArray
+        """
+        if num_taxa == self.num_taxa:
+            return self
+        bfh = BipartitionArray(None, None, num_taxa)
+        bfh.keys_array = bfh.encode(self.decode(self.keys_array))
+        bfh.counts = np.asarray(self.counts)
+        return bfh
+
+    def encode(self, bitmasks):
+        """
+        Packs split bitmasks (ints) into an array of fixed-width keys, popcount in the high bits.
+        :param bitmasks:
+        :return:
+        """
+        num_bytes = 8 * self.num_words
+        shift = self.size_shift
+        return np.frombuffer(b''.join([((bin(b).count('1') << shift) | b).to_bytes(num_bytes, 'big')
+                                       for b in bitmasks]), dtype=self.key_dtype)
+
+    def decode(self, keys):
+        """
+        Unpacks fixed-width keys back into split bitmasks (ints).
+        :param keys:
+        :return:
+        """
+        mask = (1 << self.size_shift) - 1
+        return [int.from_bytes(key.tobytes(), 'big') & mask for key in keys]
+
+    def lookup(self, bitmasks):
+        """
+        BFH counts of the given split bitmasks, 0 for bipartitions not in the BFH.
+        :param bitmasks:
+        :return:
+        """
+        return self.lookup_keys(self.encode(bitmasks))
+
+    def lookup_keys(self, query):
+        """
+        BFH counts of already encoded keys, 0 for bipartitions not in the BFH.
+        :param query: array of keys from encode
+        :return:
+        """
+        if len(self.keys_array) == 0 or len(query) == 0:
+            return np.zeros(len(query), dtype=np.uint32)
+        idx = np.searchsorted(self.keys_array, query)
+        idx[idx == len(self.keys_array)] = 0
+        return np.where(self.keys_array[idx] == query, self.counts[idx], 0)
+
+    def buckets(self):
+        """
+        Start offset of each popcount bucket in the key array (popcount 0 to num_taxa, plus the end) and the sum of
+        counts in each bucket.  Computed once.
+        :return: (bucket_offsets, bucket_sums)
+        """
+        if self.bucket_offsets is None:
+            num_bytes = 8 * self.num_words
+            boundaries = np.frombuffer(b''.join([(popcount << self.size_shift).to_bytes(num_bytes, 'big')
+                                                 for popcount in range(self.num_taxa + 1)]), dtype=self.key_dtype)
+            offsets = np.append(np.searchsorted(self.keys_array, boundaries), len(self.keys_array))
+            cumulative = np.concatenate(([0], np.cumsum(self.counts, dtype=np.int64)))
+            self.bucket_offsets = offsets.astype(np.int64)
+            self.bucket_sums = cumulative[offsets[1:]] - cumulative[offsets[:-1]]
+        return self.bucket_offsets, self.bucket_sums
+
+    def total(self, popcounts=None):
+        """
+        Sum of all counts, i.e. the number of bipartitions over all reference trees, or over the given popcount
+        buckets only.
+        :param popcounts:
+        :return:
+        """
+        if popcounts is None:
+            return int(self.counts.sum(dtype=np.int64))
+        bucket_offsets, bucket_sums = self.buckets()
+        return int(sum(bucket_sums[popcount] for popcount in popcounts if popcount < len(bucket_sums)))
+
+    def bucket_maxima(self):
+        """
+        Largest count in each popcount bucket, 0 for empty buckets: an upper bound on the count of any split with
+        that popcount.
+        :return:
+        """
+        bucket_offsets, bucket_sums = self.buckets()
+        maxima = np.zeros(len(bucket_offsets) - 1, dtype=np.int64)
+        for popcount in range(len(maxima)):
+            if bucket_offsets[popcount + 1] > bucket_offsets[popcount]:
+                maxima[popcount] = self.counts[bucket_offsets[popcount]:bucket_offsets[popcount + 1]].max()
+        return maxima
+
+    def nbytes(self):
+        return self.keys_array.nbytes + self.counts.nbytes
+
+    def keys(self):
+        return self.keys_array
+
+    def __len__(self):
+        return len(self.keys_array)
+
+    def __contains__(self, bitmask):
+        return self.lookup([bitmask])[0] > 0
+
+    def __getitem__(self, bitmask):
+        count = self.lookup([bitmask])[0]
+        if count == 0:
+            raise KeyError(bitmask)
+        return int(count)
+
+
+class BipartitionSketch(object):
+    """
+    Approximate BFH in fixed memory: a count-min sketch of split bitmasks for collections whose exact BFH does not fit.
+    depth rows of width uint32 counters; a split adds its count to one counter per row, picked by a seeded hash of its
+    packed key, and its estimated count is the minimum over the rows.  Estimates never undercount, and with
+    width = ceil(e / epsilon) and depth = ceil(ln(1 / delta)) each one overcounts by more than epsilon * total with
+    probability at most delta.  The counters live in shared memory for the query workers; exact per-popcount sums are
+    kept alongside, so totals (and size-filtered totals) are exact.
+    """
+
+    def __init__(self, segment, depth, width, num_taxa):
+        self.segment = segment
+        self.depth = depth
+        self.width = width
+        self.num_taxa = num_taxa
+        self.table = np.ndarray((depth, width), dtype=np.uint32, buffer=segment.buf)
+        self.bucket_sums = np.zeros(num_taxa + 1, dtype=np.int64)
+        self.packer = BipartitionArray(None, None, num_taxa)
+
+    @classmethod
+    def create(cls, num_taxa, epsilon, delta, max_bytes=None):
+        """
+        :param num_taxa:
+        :param epsilon: relative error bound, as a fraction of the total count
+        :param delta: probability of a split exceeding the error bound
+        :param max_bytes: cap on the counter memory; narrows the rows, loosening epsilon
+        :return:
+        """
+        depth = max(ceil(log(1 / delta)), 1)
+        width = ceil(e / epsilon)
+        if max_bytes:
+            width = min(width, max(int(max_bytes) // (4 * depth), 1))
+        sketch = cls(shared_memory.SharedMemory(create=True, size=4 * depth * width), depth, width, num_taxa)
+        sketch.table[:] = 0
+        return sketch
+
+    @classmethod
+    def attach(cls, descriptor):
+        sketch = cls(shared_memory.SharedMemory(name=descriptor["sketch"]), descriptor["depth"], descriptor["width"],
+                     descriptor["num_taxa"])
+        sketch.table.flags.writeable = False
+        sketch.bucket_sums = np.array(descriptor["bucket_sums"], dtype=np.int64)
+        return sketch
+
+    def descriptor(self):
+        return {"sketch": self.segment.name, "depth": self.depth, "width": self.width, "num_taxa": self.num_taxa,
+                "bucket_sums": [int(bucket_sum) for bucket_sum in self.bucket_sums]}
+
+    def epsilon(self):
+        return e / self.width
+
+    def rows(self, keys):
+        """
+        Counter of each packed key in each row: a splitmix64-style hash of the key's words, seeded per row.
+        :param keys: keys from BipartitionArray.encode
+        :return: (depth, len(keys)) array of counter indices
+        """
+        words = np.frombuffer(keys.tobytes(), dtype='>u8').astype(np.uint64).reshape(len(keys), self.packer.num_words)
+        index = np.empty((self.depth, len(keys)), dtype=np.int64)
+        for row in range(self.depth):
+            h = np.full(len(keys), (row + 1) * 0x9E3779B97F4A7C15 % 2 ** 64, dtype=np.uint64)
+            for word in range(self.packer.num_words):
+                h ^= words[:, word]
+                h ^= h >> np.uint64(30)
+                h *= np.uint64(0xBF58476D1CE4E5B9)
+                h ^= h >> np.uint64(27)
+                h *= np.uint64(0x94D049BB133111EB)
+                h ^= h >> np.uint64(31)
+            index[row] = h % np.uint64(self.width)
+        return index
+
+    def add(self, partial_bfh):
+        """
+        Adds a partial BFH (BipartitionArray) into the sketch.
+        :param partial_bfh:
+        :return:
+        """
+        if len(partial_bfh) == 0:
+            return
+        index = self.rows(partial_bfh.keys_array)
+        for row in range(self.depth):
+            np.add.at(self.table[row], index[row], partial_bfh.counts)
+        bucket_offsets, bucket_sums = partial_bfh.buckets()
+        self.bucket_sums[:len(bucket_sums)] += bucket_sums
+
+    def lookup(self, bitmasks):
+        """
+        Estimated BFH counts of the given split bitmasks: never below the exact count.
+        :param bitmasks:
+        :return:
+        """
+        keys = self.packer.encode(bitmasks)
+        if len(keys) == 0:
+            return np.zeros(0, dtype=np.uint32)
+        index = self.rows(keys)
+        return np.min([self.table[row][index[row]] for row in range(self.depth)], axis=0)
+
+    def total(self, popcounts=None):
+        if popcounts is None:
+            return int(self.bucket_sums.sum())
+        return int(sum(self.bucket_sums[popcount] for popcount in popcounts if popcount < len(self.bucket_sums)))
+
+    def max_overcount(self):
+        """
+        Overcount that a split's estimate exceeds with probability at most delta: epsilon * total.
+        :return:
+        """
+        return int(self.epsilon() * self.total())
+
+    def nbytes(self):
+        return self.table.nbytes
+
+    def keys(self):
+        return None
+
+    def __len__(self):
+        """
+        Estimated number of distinct bipartitions, by linear counting on the empty counters of the first row.
+        :return:
+        """
+        empty = int(np.count_nonzero(self.table[0] == 0))
+        return int(round(-self.width * log(max(empty, 1) / self.width)))
+
+    def release(self):
+        """
+        Frees the segment; call from the creating process once the pools using it have been joined.
+        :return:
+        """
+        del self.table
+        self.segment.close()
+        self.segment.unlink()
+
+
+class ScoreCache(object):
+    """
+    Bounded memo of query scores keyed by topology, shared by all workers: a direct-mapped table in shared memory
+    whose slots hold (topology hash, score bits, hash ^ score bits).  A new topology replaces whatever its slot held.
+    There is no lock; racing writers can at worst leave a slot whose check word does not match, which reads as a miss.
+    """
+
+    def __init__(self, segment):
+        self.segment = segment
+        self.table = np.ndarray((segment.size // 24, 3), dtype=np.uint64, buffer=segment.buf)
+        self.hits = 0
+
+    @classmethod
+    def create(cls, num_slots):
+        cache = cls(shared_memory.SharedMemory(create=True, size=24 * num_slots))
+        cache.table[:] = 0
+        return cache
+
+    @classmethod
+    def attach(cls, name):
+        return cls(shared_memory.SharedMemory(name=name))
+
+    def get(self, topology):
+        """
+        :param topology: 64-bit topology hash, from topology_key
+        :return: cached score or None
+        """
+        key, score_bits, check = self.table[topology % len(self.table)]
+        if key == topology and key ^ score_bits == check:
+            self.hits += 1
+            return float(score_bits.view(np.float64))
+        return None
+
+    def put(self, topology, score):
+        score_bits = np.float64(score).view(np.uint64)
+        self.table[topology % len(self.table)] = (topology, score_bits, np.uint64(topology) ^ score_bits)
+
+    def release(self):
+        """
+        Frees the segment; call from the creating process once the pool using it has been joined.
+        :return:
+        """
+        del self.table
+        self.segment.close()
+        self.segment.unlink()
+
+
+def topology_key(keys):
+    """
+    64-bit hash of a tree's canonical form, its sorted bipartition set; independent of branch lengths and of the
+    order taxa and subtrees are written in.  Hashes the bytes of the packed keys, which the array backend needs for its
+    lookup anyway.  Never 0, which marks an empty ScoreCache slot.
+    :param keys: packed keys of the tree's bipartitions, from BipartitionArray.encode
+    :return:
+    """
+    digest = hashlib.blake2b(np.sort(keys).tobytes(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') or 1
+
+
+class WorkerStats(object):
+    """
+    Per-worker task counters of a pool, in shared memory with one row per worker: pid, tasks, trees, seconds busy in
+    tasks, seconds waiting on the pool's task queue, peak RSS (kB) and peak traced memory (bytes, with -trace_memory).
+    Each worker claims its row through a shared counter when the pool starts it and only ever writes that row.
+    """
+    columns = ["pid", "tasks", "trees", "busy_s", "wait_s", "peak_rss_kb", "traced_peak_bytes"]
+
+    def __init__(self, segment, next_slot):
+        self.segment = segment
+        self.next_slot = next_slot
+        self.table = np.ndarray((segment.size // (8 * len(self.columns)), len(self.columns)), dtype=np.float64,
+                                buffer=segment.buf)
+        self.row = None
+        self.last_end = None
+
+    @classmethod
+    def create(cls, num_slots, context):
+        stats = cls(shared_memory.SharedMemory(create=True, size=8 * len(cls.columns) * num_slots),
+                    context.Value('i', 0))
+        stats.table[:] = 0
+        return stats
+
+    @classmethod
+    def attach(cls, name, next_slot):
+        stats = cls(shared_memory.SharedMemory(name=name), next_slot)
+        with next_slot.get_lock():
+            slot = next_slot.value
+            next_slot.value += 1
+        stats.row = stats.table[slot % len(stats.table)]
+        stats.row[0] = os.getpid()
+        stats.last_end = time()
+        return stats
+
+    def task(self, task_start, num_trees):
+        """
+        Records a finished task of this worker.
+        :param task_start: time() when the task started
+        :param num_trees: trees the task parsed
+        :return:
+        """
+        task_end = time()
+        row = self.row
+        row[1] += 1
+        row[2] += num_trees
+        row[3] += task_end - task_start
+        row[4] += task_start - self.last_end
+        self.last_end = task_end
+        if resource is not None:
+            row[5] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if tracemalloc.is_tracing():
+            row[6] = tracemalloc.get_traced_memory()[1]
+
+    def rows(self):
+        """
+        :return: one dict per worker that started, with trees/s over its busy time
+        """
+        rows = []
+        for row in self.table:
+            if row[0]:
+                worker = dict(zip(self.columns, [int(row[0]), int(row[1]), int(row[2]), float(row[3]),
+                                                 float(row[4]), int(row[5]), int(row[6])]))
+                worker["trees_per_s"] = worker["trees"] / worker["busy_s"] if worker["busy_s"] else 0.0
+                rows.append(worker)
+        return rows
+
+    def release(self):
+        del self.row
+        del self.table
+        self.segment.close()
+        self.segment.unlink()
+
+
+class Metrics(object):
+    """
+    Structured run metrics for -metrics_file: one record per stage with wall and CPU time of this process and of its
+    reaped workers, peak RSS, stage counters, and the per-worker rows of the pools the stage ran.
+    Written as JSON, or as CSV (one row per stage and per worker) when the file name ends in .csv.
+    """
+
+    def __init__(self, metrics_file, command, num_cpu=None, start_method=None):
+        self.metrics_file = metrics_file
+        self.run = {"command": command, "num_cpu": num_cpu, "start_method": start_method, "pid": os.getpid(),
+                    "started": time()}
+        self.stages = []
+        self.pools = []
+
+    def add_stage(self, stage, start, fields):
+        wall_start, cpu_start, workers_cpu_start = start
+        record = {"stage": stage,
+                  "wall_s": time() - wall_start,
+                  "cpu_s": process_time() - cpu_start,
+                  "workers_cpu_s": children_cpu_time() - workers_cpu_start,
+                  "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None,
+                  "workers_peak_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss if resource else None}
+        record.update(fields)
+        if "num_trees" in record:
+            record["trees_per_s"] = record["num_trees"] / record["wall_s"] if record["wall_s"] else 0.0
+        record["workers"] = []
+        for stats in self.pools:
+            record["workers"].extend(stats.rows())
+            stats.release()
+        self.pools = []
+        self.stages.append(record)
+
+    def write(self):
+        if self.metrics_file.endswith(".csv"):
+            rows = []
+            for record in self.stages:
+                rows.append(dict(((key, value) for key, value in record.items() if key != "workers"),
+                                 record="stage"))
+                for worker in record["workers"]:
+                    rows.append(dict(worker, record="worker", stage=record["stage"]))
+            fields = ["record"]
+            for row in rows:
+                fields.extend(field for field in row if field not in fields)
+            with open(self.metrics_file, 'w', newline='') as ofh:
+                writer = csv.DictWriter(ofh, fieldnames=fields)
+                writer.writeheader()
+                writer.writerows(rows)
+        else:
+            with open(self.metrics_file, 'w') as ofh:
+                json.dump({"run": self.run, "stages": self.stages}, ofh, indent=1)
+
+
+def children_cpu_time():
+    """
+    CPU time of the reaped child processes, i.e. of the workers of joined pools.
+    :return:
+    """
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def stage_start():
+    """
+    :return: start token for stage_end
+    """
+    return time(), process_time(), children_cpu_time()
+
+
+def stage_end(metrics, stage, start, **fields):
+    """
+    Records a stage when -metrics_file is set.  Call after the stage's pools are joined.
+    :param metrics: Metrics of the run, e.g. a BFH's, or None
+    :param stage: stage name
+    :param start: token from stage_start
+    :param fields: stage counters, e.g. num_trees or unique_bipartitions
+    :return:
+    """
+    if metrics is not None:
+        metrics.add_stage(stage, start, fields)
+
+
+def task_begin():
+    """
+    Worker side: start time of a task when the pool collects per-worker stats, else None.
+    :return:
+    """
+    return time() if worker_stats is not None else None
+
+
+def task_end(task_start, num_trees):
+    if task_start is not None:
+        worker_stats.task(task_start, num_trees)
+
+
+def report_progress(num_done, num_total, start_time, last_report):
+    """
+    Prints a progress line at most every progress_interval seconds.
+    :param num_done: trees finished so far
+    :param num_total: total number of trees, or None when streaming
+    :param start_time: time() when the phase started
+    :param last_report: time() of the previous report
+    :return: time() of the last report
+    """
+    now = time()
+    if progress_interval <= 0 or now - last_report < progress_interval:
+        return last_report
+    rate = num_done / max(now - start_time, 1e-9)
+    if num_total:
+        print("||Progress: {}/{} trees ({}%)\t{} trees/s\tETA: {}s".format(
+            num_done, num_total, np.around(100.0 * num_done / num_total, 1), np.around(rate, 2),
+            np.around((num_total - num_done) / max(rate, 1e-9), 1)))
+    else:
+        print("||Progress: {} trees\t{} trees/s".format(num_done, np.around(rate, 2)))
+    sys.stdout.flush()
+    return now
+
+
+def start_profiling(name):
+    """
+    Starts cProfile (with -profile_dir) and tracemalloc (with -trace_memory) in this process.  The results are
+    written to profile_dir as <name>.<pid>.prof and <name>.<pid>.tracemalloc.txt when the process exits, which for
+    pool workers is when the pool is closed and joined.
+    :param name: "main" or "worker"
+    :return:
+    """
+    global profiler
+    if profiler is not None:  # inherited from the parent by a forked worker
+        profiler.disable()
+        profiler = None
+    if profile_dir is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if profile_dir is None:
+        return
+    path = os.path.join(profile_dir, "{}.{}".format(name, os.getpid()))
+
+    def dump():
+        profiler.disable()
+        profiler.dump_stats(path + ".prof")
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            with open(path + ".tracemalloc.txt", 'w') as ofh:
+                ofh.write("current {} bytes, peak {} bytes\n".format(current, peak))
+                for stat in tracemalloc.take_snapshot().statistics('lineno')[:25]:
+                    ofh.write("{}\n".format(stat))
+
+    util.Finalize(None, dump, exitpriority=100)
+
+
+def start_instrumentation(args, command):
+    """
+    Sets up -metrics_file, -progress, -profile_dir and -trace_memory for a command.  Progress and profiling are
+    settings of this process; the metrics go to the command's BFH.
+    :param args:
+    :param command:
+    :return: (Metrics or None, start token of the whole run for finish_instrumentation)
+    """
+    global progress_interval
+    global profile_dir
+    global trace_memory
+    progress_interval = float(args.progress)
+    profile_dir = args.profile_dir
+    trace_memory = args.trace_memory
+    metrics = None
+    if args.metrics_file:
+        metrics = Metrics(args.metrics_file, command, int(args.num_cpu) if hasattr(args, "num_cpu") else None,
+                          getattr(args, "start_method", None))
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+    if profile_dir is not None or trace_memory:
+        start_profiling("main")
+    return metrics, stage_start()
+
+
+def finish_instrumentation(metrics, start):
+    """
+    Records the total and writes the metrics file.
+    :param metrics: from start_instrumentation
+    :param start: token from start_instrumentation
+    :return:
+    """
+    stage_end(metrics, "total", start)
+    if metrics is not None:
+        metrics.write()
+        print('|Wrote metrics {}'.format(metrics.metrics_file))
+
+
+def num_bitmask_taxa(bfh):
+    """
+    Number of bits of a split bitmask over the taxon set.
+    :param bfh:
+    :return:
+    """
+    return max(bfh.num_taxa, len(bfh.taxon_map))
+
+
+def in_bipartition_range(bfh, popcount):
+    """
+    Bipartition size filter: the size of a split is its smaller side, min(popcount, n - popcount), and is kept when
+    bipartition_range[0] <= size < bipartition_range[1].
+    :param bfh:
+    :param popcount:
     :return:
     """
-    global ref_trees_bipartitions
-    chunk_size = max(ceil(num_cpu / 10), 1)
-    pool = Pool(processes=num_cpu)
-    for r in pool.imap_unordered(parse_tree, ref_trees_files, chunk_size):
-        for bp in r:
+    size = min(popcount, len(bfh.taxon_map) - popcount)
+    return bfh.bipartition_range[0] <= size < bfh.bipartition_range[1]
+
+
+def bipartition_range_popcounts(bfh):
+    """
+    Popcounts of the splits kept by the bipartition size filter, i.e. the BFH buckets a filtered query touches.
+    :param bfh:
+    :return:
+    """
+    return [popcount for popcount in range(len(bfh.taxon_map) + 1) if in_bipartition_range(bfh, popcount)]
+
+
+def worker_task(function, item):
+    """
+    Pool task: function(worker_bfh, item), on the BFH that init_worker set up in this worker.  Pools map
+    partial(worker_task, function) so that only the task's items cross process boundaries, not the BFH.
+    :param function: module function taking (bfh, item)
+    :param item:
+    :return:
+    """
+    return function(worker_bfh, item)
+
+
+def count_bipartitions(bfh, ref_trees_chunk):
+    """
+    Worker body: parse a chunk of reference trees and count their bipartitions into a local frequency table.
+    :param bfh:
+    :param ref_trees_chunk:
+    :return: partial BFH of the same type as the final one
+    """
+    task_start = task_begin()
+    partial_bfh = {}
+    for tree in ref_trees_chunk:
+        for bitmask in parse_tree(bfh, tree):
+            if bfh.bfh_backend == "dict":
+                bitmask = bin(bitmask)[2:].zfill(bfh.num_taxa)
             try:
-                ref_trees_bipartitions[bin(bp.split_bitmask)[2:].zfill(num_taxa)] += 1
+                partial_bfh[bitmask] += 1
             except KeyError:
-                ref_trees_bipartitions[bin(bp.split_bitmask)[2:].zfill(num_taxa)] = 1
-    pool.close()
-    pool.join()
+                partial_bfh[bitmask] = 1
+    if bfh.bfh_backend != "dict":  # the sketch backend adds array partials into the sketch
+        partial_bfh = BipartitionArray.from_counts(partial_bfh, num_bitmask_taxa(bfh))
+    task_end(task_start, len(ref_trees_chunk))
+    return partial_bfh
+
+
+def count_bipartitions_batch(bfh, batch):
+    """
+    Worker body for create_bipartition_set_stream.
+    :param bfh:
+    :param batch: (index of the first tree, trees)
+    :return: (number of trees, partial BFH)
+    """
+    start, trees = batch
+    return len(trees), count_bipartitions(bfh, trees)
+
+
+def merge_bipartition_sets(pair):
+    """
+    Worker body: merge two partial BFHs, one step of the tree-reduction.  Array partials are merged into a new
+    array, dict partials into the larger one.
+    :param pair: (partial_bfh, partial_bfh or None)
+    :return:
+    """
+    left, right = pair
+    if right is None:
+        return left
+    task_start = task_begin()
+    if isinstance(left, BipartitionArray):
+        left = left.merge(right)
+    else:
+        if len(left) < len(right):
+            left, right = right, left
+        for key, count in right.items():
+            try:
+                left[key] += count
+            except KeyError:
+                left[key] = count
+    task_end(task_start, 0)
+    return left
+
+
+def create_bipartition_set_stream(bfh, ref_trees, batch_size):
+    """
+    Streaming version of create_bipartition_set: reference trees are pulled lazily in batches, at most
+    2 * num_cpu batches are in the pool, and the partial BFHs are merged as they arrive in binary-counter order
+    (a partial only meets partials covering as many batches), so memory stays O(|BFH| log(batches)).
+    :param bfh:
+    :param ref_trees: iterable of Newick strings, e.g. read_trees()
+    :param batch_size: trees per pool task
+    :return: number of reference trees
+    """
+    num_trees, bfh.ref_trees_bipartitions = count_bipartition_stream(bfh, ref_trees, batch_size)
+    return num_trees
+
+
+def count_bipartition_stream(bfh, trees, batch_size, in_process=False):
+    """
+    Counts the bipartitions of an iterable of trees into a new BFH, batch by batch, see
+    create_bipartition_set_stream.
+    :param bfh: BFH whose taxon order, backend and pool settings are used
+    :param trees: iterable of Newick strings
+    :param batch_size: trees per batch
+    :param in_process: count in this process instead of a pool
+    :return: (number of trees, BFH)
+    """
+    window = None if in_process else BatchWindow(2 * bfh.num_cpu)
+    levels = []
+    num_trees = 0
+    start_time = time()
+    last_report = start_time
+    batches = tree_batches(trees, batch_size, window)
+    with nullcontext() if in_process else worker_pool(bfh, window=window) as pool:
+        for batch_len, partial_bfh in (map(partial(count_bipartitions_batch, bfh), batches) if in_process else
+                                       pool.imap_unordered(partial(worker_task, count_bipartitions_batch), batches)):
+            if window is not None:
+                window.release()
+            num_trees += batch_len
+            last_report = report_progress(num_trees, None, start_time, last_report)
+            add_partial_bfh(levels, partial_bfh)
+    return num_trees, merge_partial_bfhs(bfh, levels)
+
+
+def add_partial_bfh(levels, partial_bfh):
+    """
+    Adds a partial BFH to binary-counter levels: level i holds None or a partial covering 2^i batches, and a new
+    partial is merged upwards through the occupied levels.
+    :param levels: list of partial BFHs or None, updated in place
+    :param partial_bfh:
+    :return:
+    """
+    level = 0
+    while level < len(levels) and levels[level] is not None:
+        partial_bfh = merge_bipartition_sets((levels[level], partial_bfh))
+        levels[level] = None
+        level += 1
+    if level == len(levels):
+        levels.append(partial_bfh)
+    else:
+        levels[level] = partial_bfh
+
+
+def merge_partial_bfhs(bfh, levels):
+    """
+    Merges the binary-counter levels of add_partial_bfh into the final BFH.
+    :param bfh: BFH whose backend an empty result gets
+    :param levels:
+    :return: BFH, empty if there were no partials
+    """
+    partial_bfh = None
+    for level_bfh in levels:
+        if level_bfh is not None:
+            partial_bfh = level_bfh if partial_bfh is None else merge_bipartition_sets((partial_bfh, level_bfh))
+    if partial_bfh is not None:
+        return partial_bfh
+    if bfh.bfh_backend == "array":
+        return BipartitionArray.from_counts({}, num_bitmask_taxa(bfh))
+    return {}
+
+
+def create_bipartition_sketch(bfh, ref_trees, batch_size):
+    """
+    Sketch version of create_bipartition_set_stream: the partial BFHs of batches are added into a count-min sketch
+    as they arrive, so memory is the sketch plus at most 2 * num_cpu partials however many bipartitions there are.
+    :param bfh: BFH with the sketch settings
+    :param ref_trees: iterable of Newick strings
+    :param batch_size: trees per pool task
+    :return: number of reference trees
+    """
+    sketch = BipartitionSketch.create(num_bitmask_taxa(bfh), bfh.sketch_epsilon, bfh.sketch_delta, bfh.sketch_memory)
+    bfh.ref_trees_bipartitions = sketch
+    print("|Count-min sketch: {} x {} counters ({} bytes), epsilon {}, delta {}".format(
+        sketch.depth, sketch.width, sketch.nbytes(), sketch.epsilon(), np.around(np.exp(-sketch.depth), 4)))
+    window = BatchWindow(2 * bfh.num_cpu)
+    num_trees = 0
+    start_time = time()
+    last_report = start_time
+    with worker_pool(bfh, window=window) as pool:
+        for batch_len, partial_bfh in pool.imap_unordered(partial(worker_task, count_bipartitions_batch),
+                                                          tree_batches(ref_trees, batch_size, window)):
+            window.release()
+            sketch.add(partial_bfh)
+            num_trees += batch_len
+            last_report = report_progress(num_trees, None, start_time, last_report)
+    return num_trees
+
+
+def create_bipartition_set(bfh, ref_trees_files):
+    """
+    Parse trees dynamically and build the bfh.
+    The dict backend keys bipartitions by zero-padded binary strings, the array backend by packed bitmasks.
+    :param bfh:
+    :param ref_trees_files:
+    :return:
+    """
+    bfh.ref_trees_bipartitions = count_bipartition_set(bfh, ref_trees_files)
     return
 
 
-def rf_bfh(query_trees_files):
+def count_bipartition_set(bfh, ref_trees_files):
+    """
+    Counts the bipartitions of a list of trees into a new BFH.
+    Each worker counts a whole chunk of trees into a partial BFH and the partials are merged pairwise in the pool,
+    so only frequency tables cross process boundaries.
+    :param bfh: BFH whose taxon order, backend and pool settings are used
+    :param ref_trees_files:
+    :return:
+    """
+    chunk_size = max(ceil(len(ref_trees_files) / bfh.num_cpu), 1)
+    chunks = [ref_trees_files[i:i + chunk_size] for i in range(0, len(ref_trees_files), chunk_size)]
+    with worker_pool(bfh) as pool:
+        partial_bfhs = pool.map(partial(worker_task, count_bipartitions), chunks, 1)
+        while len(partial_bfhs) > 1:
+            pairs = [(partial_bfhs[i], partial_bfhs[i + 1] if i + 1 < len(partial_bfhs) else None)
+                     for i in range(0, len(partial_bfhs), 2)]
+            partial_bfhs = pool.map(merge_bipartition_sets, pairs, 1)
+    if partial_bfhs:
+        return partial_bfhs[0]
+    return merge_partial_bfhs(bfh, [])
+
+
+def apply_bfh_delta(bfh, delta_bfh, num_trees, subtract=False):
+    """
+    Adds a BFH counted from num_trees trees to the BFH, or subtracts it, keeping num_ref_trees consistent.
+    Bipartitions whose count reaches zero are dropped: the array backend merges the delta into its sorted keys (see
+    BipartitionArray.merge), the dict backend updates in place once every count has been checked, so a failed
+    removal leaves the BFH unchanged.  Call set_bfh_keys afterwards.
+    :param bfh:
+    :param delta_bfh:
+    :param num_trees:
+    :param subtract:
+    :return:
+    """
+    bipartitions = bfh.ref_trees_bipartitions
+    if bfh.bfh_backend == "array":
+        bfh.ref_trees_bipartitions = bipartitions.merge(delta_bfh, subtract)
+    elif subtract:
+        if any(bipartitions.get(key, 0) < count for key, count in delta_bfh.items()):
+            raise ValueError("Cannot remove bipartitions that are not in the BFH")  # checked before any change
+        for key, count in delta_bfh.items():
+            remaining = bipartitions[key] - count
+            if remaining == 0:
+                del bipartitions[key]
+            else:
+                bipartitions[key] = remaining
+    else:
+        bfh.ref_trees_bipartitions = merge_bipartition_sets((bipartitions, delta_bfh))
+    bfh.num_ref_trees += -num_trees if subtract else num_trees
+
+
+def worker_state(bfh, bfh_descriptor=None, cache=None, stats=None, threshold=None):
+    """
+    The part of a BFH and of the process settings a pool worker needs, passed through init_worker so that workers
+    do not depend on fork-inherited state (and work with the spawn start method).  An array BFH travels as a shared
+    memory descriptor.
+    :param bfh:
+    :param bfh_descriptor: from publish_bfh, or None for pools that do not read the BFH
+    :param cache: ScoreCache for the workers to attach
+    :param stats: WorkerStats for the workers to record their tasks in
+    :param threshold: shared memory segment of the RF threshold, from publish_threshold
+    :return:
+    """
+    state = {"taxon_map": bfh.taxon_map,
+             "tree_parser": bfh.tree_parser,
+             "bfh_backend": bfh.bfh_backend,
+             "num_taxa": bfh.num_taxa,
+             "num_ref_trees": bfh.num_ref_trees,
+             "ref_trees_sum": bfh.ref_trees_sum,
+             "bipartition_range": bfh.bipartition_range,
+             "bfh_descriptor": bfh_descriptor,
+             "score_cache": cache.segment.name if cache is not None else None,
+             "worker_stats": (stats.segment.name, stats.next_slot) if stats is not None else None,
+             "rf_threshold": threshold.name if threshold is not None else None,
+             "profile_dir": profile_dir,
+             "trace_memory": trace_memory,
+             "ref_trees_bipartitions": None}
+    if bfh_descriptor is None and bfh.bfh_backend == "dict":
+        state["ref_trees_bipartitions"] = bfh.ref_trees_bipartitions
+    return state
+
+
+def init_worker(state):
+    """
+    Pool initializer: sets worker_bfh from worker_state() and attaches the shared BFH, score cache, worker stats and
+    RF threshold of the pool.
+    :param state:
+    :return:
+    """
+    global worker_bfh
+    global bfh_segment
+    global score_cache
+    global worker_stats
+    global profile_dir
+    global trace_memory
+    global rf_threshold
+    global rf_threshold_segment
+    worker_bfh = BFH(parser=state["tree_parser"], backend=state["bfh_backend"], num_taxa=state["num_taxa"])
+    worker_bfh.taxon_map = state["taxon_map"]
+    worker_bfh.num_ref_trees = state["num_ref_trees"]
+    worker_bfh.ref_trees_sum = state["ref_trees_sum"]
+    worker_bfh.bipartition_range = state["bipartition_range"]
+    if worker_bfh.tree_parser == "dendropy":
+        worker_bfh.tns = dendropy.TaxonNamespace(worker_bfh.taxa)
+    if state["score_cache"] is not None:
+        score_cache = ScoreCache.attach(state["score_cache"])
+    profile_dir = state["profile_dir"]
+    trace_memory = state["trace_memory"]
+    if profile_dir is not None or trace_memory:
+        start_profiling("worker")
+    if state["worker_stats"] is not None:
+        worker_stats = WorkerStats.attach(*state["worker_stats"])
+    if state["rf_threshold"] is not None:
+        rf_threshold_segment = shared_memory.SharedMemory(name=state["rf_threshold"])
+        rf_threshold = np.ndarray((1,), dtype=np.float64, buffer=rf_threshold_segment.buf)
+    if state["bfh_descriptor"] is not None:
+        bfh_segment, worker_bfh.ref_trees_bipartitions = attach_bfh(state["bfh_descriptor"])
+        worker_bfh.ref_trees_keys = worker_bfh.ref_trees_bipartitions.keys()
+    elif state["ref_trees_bipartitions"] is not None:
+        worker_bfh.ref_trees_bipartitions = state["ref_trees_bipartitions"]
+        worker_bfh.ref_trees_keys = worker_bfh.ref_trees_bipartitions.keys()
+
+
+def create_pool(bfh, bfh_descriptor=None, cache=None, threshold=None):
+    """
+    Pool of the BFH's num_cpu workers using its start method.  With metrics the workers record their tasks in a
+    WorkerStats table that the next stage_end collects.
+    :param bfh:
+    :param bfh_descriptor: shared BFH for the workers to attach, from publish_bfh
+    :param cache: ScoreCache for the workers to attach
+    :param threshold: shared RF threshold for the workers to attach, from publish_threshold
+    :return:
+    """
+    context = get_context(bfh.start_method)
+    stats = None
+    if bfh.metrics is not None:
+        stats = WorkerStats.create(bfh.num_cpu, context)
+        bfh.metrics.pools.append(stats)
+    return context.Pool(processes=bfh.num_cpu, initializer=init_worker,
+                        initargs=(worker_state(bfh, bfh_descriptor, cache, stats, threshold),))
+
+
+@contextmanager
+def worker_pool(bfh, publish=False, cache_size=0, threshold=None, window=None):
+    """
+    create_pool as a context: the pool is closed and joined on success, so workers write their stats and profiles,
+    and terminated after an error, e.g. a malformed tree in a worker.  A BFH published for it and its score cache are
+    always released.
+    :param bfh:
+    :param publish: share the BFH with the workers, see publish_bfh
+    :param cache_size: slots of a ScoreCache shared by the workers, 0 for none
+    :param threshold: shared RF threshold for the workers to attach, from publish_threshold
+    :param window: BatchWindow of the pool's task feeder, closed after an error so the feeder stops
+    :return: pool
+    """
+    segment, bfh_descriptor = publish_bfh(bfh) if publish else (None, None)
+    cache = None
+    pool = None
+    try:
+        cache = ScoreCache.create(cache_size) if cache_size > 0 else None
+        pool = create_pool(bfh, bfh_descriptor, cache, threshold)
+        yield pool
+        pool.close()
+    except BaseException:
+        if window is not None:
+            window.close()
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+        release_bfh(segment)
+        if cache is not None:
+            cache.release()
+
+
+def publish_bfh(bfh):
+    """
+    Copies the array BFH (sorted keys followed by counts) once into a read-only shared memory segment that all
+    query workers attach to, so resident memory is O(|BFH|) in total rather than per worker.
+    A sketch BFH already lives in shared memory and is not copied; its segment is freed with the sketch.  Neither is
+    a BFH memory-mapped from an index file: the workers map the file themselves and share its page cache.
+    :param bfh:
+    :return: (segment, descriptor), or (None, None) for the dict backend
+    """
+    ref_trees_bipartitions = bfh.ref_trees_bipartitions
+    if bfh.bfh_backend == "sketch":
+        return None, ref_trees_bipartitions.descriptor()
+    if bfh.bfh_backend != "array":
+        return None, None
+    if ref_trees_bipartitions.source is not None:
+        return None, dict(ref_trees_bipartitions.source, num_taxa=ref_trees_bipartitions.num_taxa,
+                          num_keys=len(ref_trees_bipartitions))
+    keys = np.ascontiguousarray(ref_trees_bipartitions.keys_array)
+    counts = np.ascontiguousarray(ref_trees_bipartitions.counts, dtype=np.uint32)
+    segment = shared_memory.SharedMemory(create=True, size=max(keys.nbytes + counts.nbytes, 1))
+    shared = np.ndarray((keys.nbytes + counts.nbytes,), dtype=np.uint8, buffer=segment.buf)
+    shared[:keys.nbytes] = keys.view(np.uint8)
+    shared[keys.nbytes:] = counts.view(np.uint8)
+    del shared
+    return segment, {"name": segment.name, "num_taxa": ref_trees_bipartitions.num_taxa, "num_keys": len(keys)}
+
+
+def attach_bfh(descriptor):
+    """
+    Attaches to a BFH published with publish_bfh.
+    :param descriptor:
+    :return: (segment, BipartitionArray or BipartitionSketch viewing the segment); keep the segment referenced
+             while the BFH is in use
+    """
+    if "sketch" in descriptor:
+        sketch = BipartitionSketch.attach(descriptor)
+        return sketch.segment, sketch
+    if "index_file" in descriptor:
+        if index_identity(descriptor["index_file"]) != descriptor["identity"]:
+            raise ValueError("BFH index {} was replaced or modified after it was loaded".format(
+                descriptor["index_file"]))
+        bfh = BipartitionArray(None, None, descriptor["num_taxa"])
+        bfh.keys_array = np.memmap(descriptor["index_file"], dtype=bfh.key_dtype, mode='r',
+                                   offset=descriptor["keys_offset"], shape=(descriptor["num_keys"],))
+        bfh.counts = np.memmap(descriptor["index_file"], dtype='<u4', mode='r', offset=descriptor["counts_offset"],
+                               shape=(descriptor["num_keys"],))
+        return None, bfh
+    segment = shared_memory.SharedMemory(name=descriptor["name"])
+    bfh = BipartitionArray(None, None, descriptor["num_taxa"])
+    num_keys = descriptor["num_keys"]
+    bfh.keys_array = np.ndarray((num_keys,), dtype=bfh.key_dtype, buffer=segment.buf)
+    bfh.keys_array.flags.writeable = False
+    bfh.counts = np.ndarray((num_keys,), dtype=np.uint32, buffer=segment.buf, offset=bfh.keys_array.nbytes)
+    bfh.counts.flags.writeable = False
+    return segment, bfh
+
+
+def release_bfh(segment):
+    """
+    Frees a segment created by publish_bfh once the pool using it has been joined.
+    :param segment:
+    :return:
+    """
+    if segment is not None:
+        segment.close()
+        segment.unlink()
+
+
+def set_bfh_keys(bfh):
+    """
+    Sets the BFH's ref_trees_keys and ref_trees_sum used by rf_bfh_mp once the BFH is complete.
+    With a bipartition size filter, ref_trees_sum only covers the bipartitions that pass it, taken from the
+    per-popcount bucket sums of the array or sketch BFH.
+    :param bfh:
+    :return:
+    """
+    ref_trees_bipartitions = bfh.ref_trees_bipartitions
+    bfh.ref_trees_keys = ref_trees_bipartitions.keys()
+    if bfh.bfh_backend != "dict":
+        bfh.ref_trees_sum = ref_trees_bipartitions.total(bipartition_range_popcounts(bfh) if bfh.bipartition_range
+                                                         else None)
+    elif bfh.bipartition_range:
+        bfh.ref_trees_sum = sum(count for key, count in ref_trees_bipartitions.items()
+                                if in_bipartition_range(bfh, key.count('1')))
+    else:
+        bfh.ref_trees_sum = sum(ref_trees_bipartitions.values())
+    bfh.bucket_max_counts = None
+
+
+def rf_bfh(bfh, query_trees_files):
     """
     Computes RF of Query trees dynamically against BFH_R.
+    :param bfh:
     :param query_trees_files:
+    :return: [(tree_str, rf), ...] in input order, one per query tree
+    """
+    set_bfh_keys(bfh)
+    start_time = time()
+    chunk_size = max(ceil(len(query_trees_files) / (bfh.num_cpu * 10)), 1)
+    tree_rf_dist = []
+    last_report = start_time
+    with worker_pool(bfh, publish=True, cache_size=bfh.score_cache_size) as pool:
+        for result in pool.imap(partial(worker_task, rf_bfh_mp), query_trees_files, chunk_size):
+            tree_rf_dist.append(result)
+            last_report = report_progress(len(tree_rf_dist), len(query_trees_files), start_time, last_report)
+    end_time = time() - start_time
+    trees_per_min = np.around(len(query_trees_files) / (end_time / 60), 2)
+    total_rf_time = np.around(len(query_trees_files) / trees_per_min, 2)
+    print("||BHRF: Average(total): {} trees/m\tEstimated total RF time: {}m".format(
+        trees_per_min, total_rf_time))
+    return tree_rf_dist
+
+
+def rf_bfh_stream(bfh, query_trees, output_file, batch_size, ordered=False):
+    """
+    Computes RF of Query trees against BFH_R with bounded memory: trees are pulled lazily from query_trees, at most
+    2 * num_cpu batches are in the pool or waiting to be written, and rows are written as soon as they are ready.
+    :param bfh:
+    :param query_trees: iterable of Newick strings, e.g. read_trees()
+    :param output_file:
+    :param batch_size: trees per pool task
+    :param ordered: write rows in input order using a reorder buffer of batches
+    :return: number of query trees
+    """
+    set_bfh_keys(bfh)
+    start_time = time()
+    window = BatchWindow(2 * bfh.num_cpu)
+    reorder_buffer = {}
+    next_start = 0
+    num_query_trees = 0
+    last_report = start_time
+    with open(output_file, 'w') as ofh, \
+            worker_pool(bfh, publish=True, cache_size=bfh.score_cache_size, window=window) as pool:
+        for start, results in pool.imap_unordered(partial(worker_task, rf_bfh_batch),
+                                                  tree_batches(query_trees, batch_size, window)):
+            if ordered:
+                reorder_buffer[start] = results
+                while next_start in reorder_buffer:
+                    results = reorder_buffer.pop(next_start)
+                    for tree_name, avg_norm_rf in results:
+                        ofh.write("{},{}\n".format(tree_name, format_rf(avg_norm_rf)))
+                    next_start += len(results)
+                    num_query_trees += len(results)
+                    window.release()
+            else:
+                for tree_name, avg_norm_rf in results:
+                    ofh.write("{},{}\n".format(tree_name, format_rf(avg_norm_rf)))
+                num_query_trees += len(results)
+                window.release()
+            last_report = report_progress(num_query_trees, None, start_time, last_report)
+    end_time = time() - start_time
+    trees_per_min = np.around(num_query_trees / (end_time / 60), 2)
+    print("||BHRF: Average(total): {} trees/m\tStreamed {} query trees".format(trees_per_min, num_query_trees))
+    return num_query_trees
+
+
+def rf_bfh_batch(bfh, batch):
+    """
+    Worker body for rf_bfh_stream.
+    :param bfh:
+    :param batch: (index of the first tree, trees)
+    :return: (index of the first tree, [(tree_str, rf), ...])
+    """
+    start, trees = batch
+    return start, [rf_bfh_mp(bfh, tree_str) for tree_str in trees]
+
+
+def pipeline_tasks(ref_trees, query_trees, sizing, window, pending):
+    """
+    Task feeder of rf_bfh_pipeline: reference batches, then query batches, each of the current
+    sizing["batch_size"] trees and waiting for a free window slot.  Query batches are kept in pending until their
+    rows are written, and sizing["num_ref_batches"] is set once the reference trees are exhausted.  Without
+    query_trees, the reference batches are fed as self batches that are both counted and scored.
+    :param ref_trees: iterable of Newick strings
+    :param query_trees: iterable of Newick strings, or None for a self comparison
+    :param sizing: adaptive batch sizing state, see adapt_batch_size
+    :param window: BatchWindow bounding the batches read ahead
+    :param pending: query batch start -> trees
+    :return:
+    """
+    for kind, trees in ((("ref", ref_trees), ("query", query_trees)) if query_trees is not None else
+                        (("self", ref_trees),)):
+        start = 0
+        num_batches = 0
+        batch = []
+        for tree in trees:
+            batch.append(tree)
+            if len(batch) >= sizing["batch_size"]:
+                if not window.acquire():
+                    return
+                if kind != "ref":
+                    pending[start] = batch
+                yield kind, start, batch
+                start += len(batch)
+                num_batches += 1
+                batch = []
+        if batch:
+            if not window.acquire():
+                return
+            if kind != "ref":
+                pending[start] = batch
+            yield kind, start, batch
+            num_batches += 1
+        if kind != "query":
+            sizing["num_ref_batches"] = num_batches
+
+
+def adapt_batch_size(sizing, num_trees, seconds):
+    """
+    Adaptive batch sizing: keeps a moving average of the seconds per tree reported by the workers and sizes the
+    next batches to take about sizing["target_seconds"], so cheap trees travel in large batches (few IPC round trips)
+    and expensive ones in small batches that keep the workers evenly loaded.
+    :param sizing: {"batch_size", "per_tree", "target_seconds"}, updated in place
+    :param num_trees: trees of the finished batch
+    :param seconds: time the worker spent on it
+    :return:
+    """
+    per_tree = seconds / max(num_trees, 1)
+    if sizing["per_tree"] is not None:
+        per_tree = 0.8 * sizing["per_tree"] + 0.2 * per_tree
+    sizing["per_tree"] = per_tree
+    sizing["batch_size"] = int(min(max(sizing["target_seconds"] / max(per_tree, 1e-7), 1), 100000))
+
+
+def pipeline_task(bfh, task):
+    """
+    Worker body for rf_bfh_pipeline: a reference batch is counted into a partial BFH, a query batch is parsed into
+    the encoded keys of its trees' bipartition sets (after the size filter), ready to be looked up once the BFH is
+    final.  A self batch is parsed once for both.
+    :param bfh:
+    :param task: ("ref", "query" or "self", index of the first tree, trees)
+    :return: (kind, index of the first tree, number of trees, seconds, partial BFH, (keys, bipartitions per tree) or
+              for self batches both)
+    """
+    kind, start, trees = task
+    batch_start = time()
+    if kind == "ref":
+        result = count_bipartitions(bfh, trees)
+    else:
+        task_start = task_begin()
+        partial_bfh = {}
+        bitmasks = []
+        sizes = np.zeros(len(trees), dtype=np.int64)
+        for i, tree_str in enumerate(trees):
+            split_bitmasks = list(parse_tree(bfh, tree_str))
+            if kind == "self":
+                for bitmask in split_bitmasks:
+                    try:
+                        partial_bfh[bitmask] += 1
+                    except KeyError:
+                        partial_bfh[bitmask] = 1
+            tree1_bitmasks = filter_bitmasks(bfh, split_bitmasks)
+            bitmasks.extend(tree1_bitmasks)
+            sizes[i] = len(tree1_bitmasks)
+        result = BipartitionArray(None, None, num_bitmask_taxa(bfh)).encode(bitmasks), sizes
+        if kind == "self":
+            result = BipartitionArray.from_counts(partial_bfh, num_bitmask_taxa(bfh)), result
+        task_end(task_start, len(trees))
+    return kind, start, len(trees), time() - batch_start, result
+
+
+def rf_bfh_parsed(bfh, keys, sizes):
+    """
+    Average RF of a batch of query trees parsed by pipeline_task, with one vectorized lookup of all their keys:
+    each tree's RF is (|B_q| * R + ref_trees_sum - 2 * sum of its BFH counts) / R, as in rf_bfh_score.
+    :param bfh:
+    :param keys: encoded keys of the trees' bipartitions, concatenated
+    :param sizes: number of keys of each tree
+    :return: float array, one RF per tree
+    """
+    counts = bfh.ref_trees_bipartitions.lookup_keys(keys).astype(np.int64)
+    shared = np.zeros(len(sizes), dtype=np.int64)
+    nonempty = sizes > 0
+    if nonempty.any():
+        offsets = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+        shared[nonempty] = np.add.reduceat(counts, offsets[nonempty])
+    return (sizes * bfh.num_ref_trees + bfh.ref_trees_sum - 2 * shared) / bfh.num_ref_trees
+
+
+def rf_bfh_pipeline(bfh, ref_trees, query_trees, output_file, target_seconds=0.2):
+    """
+    Builds the BFH and computes RF of the Query trees against it with one persistent pool.  Reference batches are
+    fed first and query batches right behind them, so workers parse and tokenize queries while the last partial BFHs
+    are counted and merged.  As soon as the BFH is final, the parsed queries are scored with vectorized lookups in the
+    main process and their rows written in input order.  At most 2 * num_cpu batches are read ahead and batch sizes
+    adapt to the measured cost per tree.  Array backend only.
+    Without query_trees, the reference trees are also the queries: each is parsed once, counted into the BFH, and
+    its encoded bipartition set kept until the BFH is final, so memory grows with the number of trees.
+    :param bfh: BFH to fill, with its taxon order set
+    :param ref_trees: iterable of Newick strings, e.g. read_trees()
+    :param query_trees: iterable of Newick strings, or None for a self comparison
+    :param output_file:
+    :param target_seconds: worker time per batch that adaptive batch sizing aims for
+    :return: (number of query trees, seconds until the BFH was final)
+    """
+    start_time = time()
+    last_report = start_time
+    window = BatchWindow(2 * bfh.num_cpu)
+    sizing = {"batch_size": 16, "per_tree": None, "target_seconds": target_seconds}
+    pending = {}  # query batch start -> trees, until written
+    parsed = {}  # query batch start -> (keys, sizes), until the BFH is final and the rows before it are written
+    levels = []
+    num_trees = 0
+    num_ref_batches = 0
+    bfh_time = None
+    next_start = 0
+    write_window = window if query_trees is not None else None  # self batches free their slot once counted
+    with open(output_file, 'w') as ofh:
+        with worker_pool(bfh, window=window) as pool:
+            for kind, start, batch_len, seconds, result in pool.imap_unordered(
+                    partial(worker_task, pipeline_task),
+                    pipeline_tasks(ref_trees, query_trees, sizing, window, pending)):
+                adapt_batch_size(sizing, batch_len, seconds)
+                if kind == "self":
+                    result, parsed[start] = result
+                if kind != "query":
+                    window.release()
+                    num_trees += batch_len
+                    num_ref_batches += 1
+                    add_partial_bfh(levels, result)
+                else:
+                    parsed[start] = result
+                if bfh_time is None and sizing.get("num_ref_batches") == num_ref_batches:
+                    bfh_time = finish_pipeline_bfh(bfh, levels, num_trees, start_time)
+                if bfh_time is not None:
+                    next_start = write_parsed(bfh, ofh, parsed, pending, next_start, write_window)
+                last_report = report_progress(next_start if bfh_time is not None else num_trees, None, start_time,
+                                              last_report)
+        if bfh_time is None:
+            bfh_time = finish_pipeline_bfh(bfh, levels, num_trees, start_time)
+        next_start = write_parsed(bfh, ofh, parsed, pending, next_start, write_window)
+    end_time = time() - start_time
+    trees_per_min = np.around(next_start / (max(end_time - bfh_time, 1e-9) / 60), 2)
+    print("||BHRF: Average(after BFH): {} trees/m\tPipelined {} query trees, final batch size {}".format(
+        trees_per_min, next_start, sizing["batch_size"]))
+    return next_start, bfh_time
+
+
+def finish_pipeline_bfh(bfh, levels, num_trees, start_time):
+    """
+    Sets the BFH of rf_bfh_pipeline once every reference batch is counted.
+    :param bfh:
+    :param levels: binary-counter levels of partial BFHs
+    :param num_trees: number of reference trees
+    :param start_time:
+    :return: seconds from start_time until the BFH was final
+    """
+    bfh.ref_trees_bipartitions = merge_partial_bfhs(bfh, levels)
+    levels.clear()
+    bfh.num_ref_trees = num_trees
+    set_bfh_keys(bfh)
+    bfh_time = time() - start_time
+    print('|Parsed {} reference trees, generated bipartitions, and created bfh: {}s\tRate:{} trees/s'.format(
+        num_trees, np.around(bfh_time, 2), np.around(num_trees / bfh_time, 2)))
+    sys.stdout.flush()
+    return bfh_time
+
+
+def write_parsed(bfh, ofh, parsed, pending, next_start, window):
+    """
+    Scores and writes the parsed query batches of rf_bfh_pipeline that are next in input order.
+    :param bfh:
+    :param ofh:
+    :param parsed: query batch start -> (keys, sizes)
+    :param pending: query batch start -> trees
+    :param next_start: index of the next query tree to write
+    :param window: BatchWindow of the task feeder, released per written batch, or None
+    :return: new next_start
+    """
+    while next_start in parsed:
+        keys, sizes = parsed.pop(next_start)
+        trees = pending.pop(next_start)
+        for tree_name, avg_norm_rf in zip(trees, rf_bfh_parsed(bfh, keys, sizes)):
+            ofh.write("{},{}\n".format(tree_name, str(float(avg_norm_rf))))
+        next_start += len(trees)
+        if window is not None:
+            window.release()
+    return next_start
+
+
+def rf_bfh_mp(bfh, tree_str):
+    """
+    Body for computing RF of a tree against ref_trees BFH using MP
+    The tree is reduced to its canonical bipartition set, so repeated topologies (differing only in branch lengths
+    or in the order the string lists taxa) are scored once when the pool's shared score cache is enabled.
+    bipartition size_filtering included
+    :param bfh:
+    :param tree_str:
+    :return:
+    """
+    task_start = task_begin()
+    tree1_bitmasks = query_bitmasks(bfh, tree_str)
+    if score_cache is None:
+        avg_norm_rf = rf_bfh_score(bfh, tree1_bitmasks)
+    else:
+        keys = key_packer(bfh).encode(tree1_bitmasks)
+        topology = topology_key(keys)
+        avg_norm_rf = score_cache.get(topology)
+        if avg_norm_rf is None:
+            avg_norm_rf = rf_bfh_score(bfh, tree1_bitmasks, keys)
+            score_cache.put(topology, avg_norm_rf)
+    task_end(task_start, 1)
+    return tree_str, avg_norm_rf
+
+
+def format_rf(avg_norm_rf):
+    """
+    Output column(s) of a score: the average RF, or with the sketch backend the approximate average RF and its error
+    bound.
+    :param avg_norm_rf:
+    :return:
+    """
+    if isinstance(avg_norm_rf, tuple):
+        return "{},{}".format(*avg_norm_rf)
+    return str(avg_norm_rf)
+
+
+def query_bitmasks(bfh, tree_str):
+    """
+    Set of split bitmasks of a query tree that pass the bipartition size filter.
+    :param bfh:
+    :param tree_str:
+    :return:
+    """
+    return filter_bitmasks(bfh, parse_tree(bfh, tree_str))
+
+
+def filter_bitmasks(bfh, split_bitmasks):
+    """
+    Set of the split bitmasks that pass the bipartition size filter.
+    :param bfh:
+    :param split_bitmasks:
+    :return:
+    """
+    tree1_bitmasks = set()
+    for split_bitmask in split_bitmasks:
+        if len(bfh.bipartition_range) > 0:
+            if in_bipartition_range(bfh, bin(split_bitmask).count('1')):
+                tree1_bitmasks.add(split_bitmask)
+        else:
+            tree1_bitmasks.add(split_bitmask)
+    return tree1_bitmasks
+
+
+def key_packer(bfh):
+    """
+    BipartitionArray that packs split bitmasks into keys: the array BFH itself, or an empty one of the same width for
+    the other backends.
+    :param bfh:
     :return:
     """
-    global ref_trees_keys
-    global ref_trees_sum
-    tree_rf_dist = {}
-    ref_trees_keys = ref_trees_bipartitions.keys()
-    ref_trees_sum = sum(ref_trees_bipartitions.values())
-    start_time = time()
-    chunk_size = max(ceil(num_cpu / 10), 1)
-    pool = Pool(processes=num_cpu)
-    for r in pool.imap_unordered(rf_bfh_mp, query_trees_files, chunk_size):
-        tree_name, avg_norm_rf = r
-        tree_rf_dist[tree_name] = avg_norm_rf
-    pool.close()
-    pool.join()
-    end_time = time() - start_time
-    trees_per_min = np.around(len(query_trees_files) / (end_time / 60), 2)
-    total_rf_time = np.around(len(query_trees_files) / trees_per_min, 2)
-    print("||BHRF: Average(total): {} trees/m\tEstimated total RF time: {}m".format(
-        trees_per_min, total_rf_time))
-    return tree_rf_dist
+    if bfh.bfh_backend == "array":
+        return bfh.ref_trees_bipartitions
+    return BipartitionArray(None, None, num_bitmask_taxa(bfh))
 
 
-def rf_bfh_mp(tree_str):
+def rf_bfh_score(bfh, tree1_bitmasks, keys=None):
     """
-    Body for computing RF of a tree against ref_trees BFH using MP
+    Average RF of a bipartition set against the ref_trees BFH.
     Done using tree1 keys since there are n-1 keys whereas bfh has a minimum of n-1
-    bipartition size_filtering included
-    :param tree_str:
-    :return:
+    The reference side subtracts each shared bipartition's count, not num_ref_trees as releases before the matrix
+    command did, so the score is the mean of the per-tree RF distances.
+    With the sketch backend the counts are estimates, capped at num_ref_trees, that never undercount, so the RF is
+    never overestimated; the error bound adds up min(estimate, max_overcount) over the bipartitions, which exceeds the
+    true error only with probability at most delta per bipartition.
+    :param bfh:
+    :param tree1_bitmasks: set of split bitmasks
+    :param keys: the bitmasks already packed by key_packer, to save the array backend encoding them again
+    :return: average RF, or (approximate average RF, error bound) for the sketch backend
     """
-    tree1 = dendropy.Tree.get(data=tree_str, label=tree_str, schema="newick", taxon_namespace=tns)
-    tree1.encode_bipartitions()
-    tree1_bp = {}
-    for bp in tree1.bipartition_encoding:
-        bitmask = bin(bp.split_bitmask)[2:].zfill(num_taxa)
-        if len(bipartition_range) > 0:
-            if bipartition_range[0] <= sum([int(c) for c in bitmask]) <= bipartition_range[1]:
-                tree1_bp[bitmask] = num_ref_trees
-        else:
-            tree1_bp[bitmask] = num_ref_trees
+    bfh_backend = bfh.bfh_backend
+    ref_trees_bipartitions = bfh.ref_trees_bipartitions
+    num_ref_trees = bfh.num_ref_trees
+    ref_trees_sum = bfh.ref_trees_sum
+    if bfh_backend == "sketch":
+        counts = np.minimum(ref_trees_bipartitions.lookup(tree1_bitmasks), num_ref_trees).astype(np.int64)
+        shared = int(counts.sum())
+        error = 2 * int(np.minimum(counts, ref_trees_bipartitions.max_overcount()).sum()) / num_ref_trees
+        return (len(tree1_bitmasks) * num_ref_trees + ref_trees_sum - 2 * shared) / num_ref_trees, error
+    if bfh_backend == "array":
+        counts = ref_trees_bipartitions.lookup(tree1_bitmasks) if keys is None else \
+            ref_trees_bipartitions.lookup_keys(keys)
+        rf_left = len(tree1_bitmasks) * num_ref_trees - int(counts.sum(dtype=np.int64))
+        rf_right = ref_trees_sum - int(counts.sum(dtype=np.int64))
+        return (rf_left + rf_right) / num_ref_trees
+    tree1_bp = {bin(split_bitmask)[2:].zfill(bfh.num_taxa): num_ref_trees for split_bitmask in tree1_bitmasks}
     tree1_keys = tree1_bp.keys()
+    ref_trees_keys = bfh.ref_trees_keys
     # # Sym Diff Left
     # rf_left = sum(tree1_bp.values())
     # for key1 in tree1_keys:
@@ -139,90 +2092,1519 @@ def rf_bfh_mp(tree_str):
     # rf_right = ref_trees_sum
     # for key1 in tree1_keys:
     #     if key1 in ref_trees_keys:
-    #         rf_right -= tree1_bp[key1]
+    #         rf_right -= ref_trees_bipartitions[key1]  # each of the count ref trees shares key1 with tree1
     # Joined Sym Diff
     rf_left = sum(tree1_bp.values())
     rf_right = ref_trees_sum
     for key1 in tree1_keys:
         if key1 in ref_trees_keys:
             rf_left -= ref_trees_bipartitions[key1]  # tree1 is num_ref_trees where tree2 is at most num_ref_trees
-            rf_right -= tree1_bp[key1]
+            rf_right -= ref_trees_bipartitions[key1]
     # note that the below is NOT divided by 2
-    return tree1.label, (rf_left + rf_right) / num_ref_trees
+    return (rf_left + rf_right) / num_ref_trees
 
 
-def main(args):
+def bfh_counts(bfh, bitmasks):
     """
-    :param args:
+    BFH counts of split bitmasks for either backend, 0 for bipartitions not in the BFH.
+    :param bfh:
+    :param bitmasks: sequence of split bitmasks
+    :return: list of int counts, in the order of bitmasks
+    """
+    if bfh.bfh_backend != "dict":
+        return [int(count) for count in bfh.ref_trees_bipartitions.lookup(bitmasks)]
+    return [bfh.ref_trees_bipartitions.get(bin(split_bitmask)[2:].zfill(bfh.num_taxa), 0)
+            for split_bitmask in bitmasks]
+
+
+def split_count_bounds(bfh, bitmasks):
+    """
+    Upper bounds on the BFH counts of splits: the largest count of the split's popcount bucket, or num_ref_trees for
+    the dict backend.  The bucket maxima are computed once per BFH.
+    :param bfh:
+    :param bitmasks:
     :return:
     """
-    global num_taxa
-    global num_cpu
-    global tns
-    global ref_trees_bipartitions
-    global num_ref_trees
-    global bipartition_range
-    num_taxa = int(args.num_taxa)
-    num_cpu = int(args.num_cpu)
-    begin_time = time()
+    if bfh.bfh_backend != "array":
+        return [bfh.num_ref_trees] * len(bitmasks)
+    if bfh.bucket_max_counts is None:
+        bfh.bucket_max_counts = bfh.ref_trees_bipartitions.bucket_maxima()
+    bucket_max_counts = bfh.bucket_max_counts
+    bounds = []
+    for split_bitmask in bitmasks:
+        popcount = bin(split_bitmask).count('1')
+        bounds.append(int(bucket_max_counts[popcount]) if popcount < len(bucket_max_counts) else 0)
+    return bounds
+
+
+def rf_bfh_bounded_score(bfh, tree1_bitmasks, threshold, block_size=16):
+    """
+    Average RF like rf_bfh_score, or None as soon as it provably exceeds threshold.
+    Bipartitions are looked up in blocks.  rf_left only grows and rf_right only shrinks as counts are seen, and an
+    unseen bipartition can at most have the largest count of its popcount bucket, so the RF is bounded from below
+    after every block.  Trivial bipartitions, which nearly all reference trees share, are looked up last.
+    :param bfh:
+    :param tree1_bitmasks: set of split bitmasks
+    :param threshold: RF above which the exact score is not needed
+    :param block_size: bipartitions per lookup
+    :return:
+    """
+    n = len(bfh.taxon_map)
+    bitmasks = sorted(tree1_bitmasks, key=lambda split_bitmask: bin(split_bitmask).count('1') in (0, 1, n - 1, n))
+    bounds = split_count_bounds(bfh, bitmasks)
+    limit = threshold * bfh.num_ref_trees
+    rf_base = len(bitmasks) * bfh.num_ref_trees + bfh.ref_trees_sum  # rf_left + rf_right before subtracting counts
+    seen = 0
+    unseen_bound = sum(bounds)
+    for i in range(0, len(bitmasks), block_size):
+        seen += sum(bfh_counts(bfh, bitmasks[i:i + block_size]))
+        unseen_bound -= sum(bounds[i:i + block_size])
+        if rf_base - 2 * (seen + unseen_bound) > limit:
+            return None
+    return (rf_base - 2 * seen) / bfh.num_ref_trees
+
+
+def rf_bfh_bounded(bfh, tree_str, threshold):
+    """
+    Worker body for top-k/threshold queries: rf_bfh_mp with early termination.
+    :param bfh:
+    :param tree_str:
+    :param threshold: current RF threshold
+    :return: average RF, or None if the tree was pruned
+    """
+    task_start = task_begin()
+    tree1_bitmasks = query_bitmasks(bfh, tree_str)
+    avg_norm_rf = None
+    if score_cache is not None:
+        topology = topology_key(key_packer(bfh).encode(tree1_bitmasks))
+        avg_norm_rf = score_cache.get(topology)
+    if avg_norm_rf is None:
+        avg_norm_rf = rf_bfh_bounded_score(bfh, tree1_bitmasks, threshold)
+        if avg_norm_rf is not None and score_cache is not None:
+            score_cache.put(topology, avg_norm_rf)
+    task_end(task_start, 1)
+    return avg_norm_rf
+
+
+def rf_bfh_bounded_batch(bfh, batch):
+    """
+    Worker body for rf_bfh_select.  The threshold is re-read from shared memory for every tree, so it tightens as
+    the parent collects better results.
+    :param bfh:
+    :param batch: (index of the first tree, trees)
+    :return: ([(index, tree_str, rf), ...] of the trees within the threshold, number of trees, number pruned)
+    """
+    start, trees = batch
+    results = []
+    num_pruned = 0
+    for i, tree_str in enumerate(trees):
+        threshold = float(rf_threshold[0])
+        avg_norm_rf = rf_bfh_bounded(bfh, tree_str, threshold)
+        if avg_norm_rf is None:
+            num_pruned += 1
+        elif avg_norm_rf <= threshold:
+            results.append((start + i, tree_str, avg_norm_rf))
+    return results, len(trees), num_pruned
+
+
+def publish_threshold(max_rf=None):
+    """
+    Shared RF threshold that rf_bfh_select lowers as top-k results come in and workers read before every tree.
+    :param max_rf: initial threshold, default infinity
+    :return: (segment, 1-element float64 array viewing it)
+    """
+    segment = shared_memory.SharedMemory(create=True, size=8)
+    threshold = np.ndarray((1,), dtype=np.float64, buffer=segment.buf)
+    threshold[0] = np.inf if max_rf is None else max_rf
+    return segment, threshold
+
+
+def rf_bfh_select(bfh, query_trees, batch_size, top_k=None, max_rf=None):
+    """
+    Computes RF of Query trees against BFH_R keeping only the top_k lowest and/or those with RF <= max_rf.
+    A heap holds the best top_k results; once it is full its worst RF becomes the workers' threshold, and trees whose
+    lower bound exceeds it are dropped before all of their bipartitions are looked up.
+    :param bfh:
+    :param query_trees: iterable of Newick strings, e.g. read_trees()
+    :param batch_size: trees per pool task
+    :param top_k:
+    :param max_rf:
+    :return: ([(tree_str, rf), ...] sorted by RF (ties in input order) with top_k, else in input order,
+              number of query trees)
+    """
+    set_bfh_keys(bfh)
+    start_time = time()
+    last_report = start_time
+    window = BatchWindow(2 * bfh.num_cpu)
+    best = []  # top_k: max-heap of (-rf, -index, tree_str); otherwise (index, tree_str, rf)
+    num_query_trees = 0
+    num_pruned = 0
+    threshold_segment, threshold = publish_threshold(max_rf)
+    try:
+        with worker_pool(bfh, publish=True, cache_size=bfh.score_cache_size, threshold=threshold_segment,
+                         window=window) as pool:
+            for results, batch_len, batch_pruned in pool.imap_unordered(partial(worker_task, rf_bfh_bounded_batch),
+                                                                        tree_batches(query_trees, batch_size,
+                                                                                     window)):
+                window.release()
+                num_query_trees += batch_len
+                num_pruned += batch_pruned
+                for index, tree_str, avg_norm_rf in results:
+                    if not top_k:
+                        best.append((index, tree_str, avg_norm_rf))
+                    elif len(best) < top_k:
+                        heapq.heappush(best, (-avg_norm_rf, -index, tree_str))
+                    elif (-avg_norm_rf, -index) > best[0][:2]:
+                        heapq.heapreplace(best, (-avg_norm_rf, -index, tree_str))
+                if top_k and len(best) == top_k:
+                    threshold[0] = min(threshold[0], -best[0][0])
+                last_report = report_progress(num_query_trees, None, start_time, last_report)
+    finally:
+        del threshold  # the segment cannot be closed while the array still exports its buffer
+        release_bfh(threshold_segment)
+    if top_k:
+        rows = [(tree_str, -negative_rf) for negative_rf, negative_index, tree_str in sorted(best, reverse=True)]
+    else:
+        rows = [(tree_str, avg_norm_rf) for index, tree_str, avg_norm_rf in sorted(best)]
+    print("||BHRF: Selected {} of {} query trees, {} pruned early: {}s".format(
+        len(rows), num_query_trees, num_pruned, np.around(time() - start_time, 2)))
+    return rows, num_query_trees
+
+
+def incidence_row(bfh, tree_str):
+    """
+    Worker body for incidence_matrix: a tree's bipartitions as sorted column indices into the BFH's sorted
+    unique-bipartition array.  Bipartitions not in the BFH get no column but still count towards the tree's size.
+    :param bfh:
+    :param tree_str:
+    :return: (column indices, number of bipartitions)
+    """
+    task_start = task_begin()
+    bitmasks = query_bitmasks(bfh, tree_str)
+    ref_trees_bipartitions = bfh.ref_trees_bipartitions
+    if len(ref_trees_bipartitions) == 0:
+        columns = np.zeros(0, dtype=np.int32)
+    else:
+        keys = ref_trees_bipartitions.encode(bitmasks)
+        columns = np.searchsorted(ref_trees_bipartitions.keys_array, keys)
+        columns[columns == len(ref_trees_bipartitions)] = 0
+        columns = np.sort(columns[ref_trees_bipartitions.keys_array[columns] == keys]).astype(np.int32)
+    task_end(task_start, 1)
+    return columns, len(bitmasks)
+
+
+def incidence_matrix(bfh, trees):
+    """
+    Sparse 0/1 tree x unique-bipartition matrix over the array BFH, rows parsed in the pool, or in this process
+    when the BFH has no num_cpu.
+    :param bfh:
+    :param trees:
+    :return: (CSR matrix, array of bipartition counts per tree)
+    """
+    if bfh.num_cpu is None:
+        rows = [incidence_row(bfh, tree_str) for tree_str in trees]
+        return incidence_csr(bfh, rows)
+    chunk_size = max(ceil(len(trees) / (bfh.num_cpu * 10)), 1)
+    with worker_pool(bfh, publish=True) as pool:
+        rows = pool.map(partial(worker_task, incidence_row), trees, chunk_size)
+    return incidence_csr(bfh, rows)
+
+
+def incidence_csr(bfh, rows):
+    """
+    :param bfh:
+    :param rows: incidence_row of each tree
+    :return: (CSR matrix, array of bipartition counts per tree)
+    """
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(columns) for columns, size in rows])
+    indices = np.concatenate([columns for columns, size in rows]) if rows else np.zeros(0, dtype=np.int32)
+    sizes = np.array([size for columns, size in rows], dtype=np.int64)
+    matrix = sparse.csr_matrix((np.ones(len(indices), dtype=np.int32), indices, indptr),
+                               shape=(len(rows), len(bfh.ref_trees_bipartitions)))
+    return matrix, sizes
+
+
+def rf_matrix(bfh, query_trees_files, ref_trees_files, output_file, block_size):
+    """
+    All-pairs RF between query and reference trees: RF(i,j) = |Bi| + |Bj| - 2 * shared(i,j), where the shared counts
+    come from blocked sparse products of the bipartition incidence matrices.  Written tile by tile into a .npy file
+    opened as a memmap, so the matrix does not have to fit in memory.
+    :param bfh: array BFH of the reference trees, whose unique bipartitions are the matrix columns
+    :param query_trees_files:
+    :param ref_trees_files:
+    :param output_file:
+    :param block_size: rows/columns per tile
+    :return:
+    """
+    start = stage_start()
+    start_time = time()
+    query_matrix, query_sizes = incidence_matrix(bfh, query_trees_files)
+    ref_matrix, ref_sizes = incidence_matrix(bfh, ref_trees_files)
+    print("|Built incidence matrices of {} query and {} reference trees: {}s".format(
+        len(query_sizes), len(ref_sizes), np.around(time() - start_time, 2)))
+    stage_end(bfh.metrics, "incidence_matrix", start, num_trees=len(query_sizes) + len(ref_sizes))
+    start = stage_start()
+    start_time = time()
+    rf = np.lib.format.open_memmap(output_file, mode='w+', dtype=np.uint32, shape=(len(query_sizes), len(ref_sizes)))
+    for j in range(0, len(ref_sizes), block_size):
+        ref_block = ref_matrix[j:j + block_size].T.tocsc()
+        for i in range(0, len(query_sizes), block_size):
+            shared = (query_matrix[i:i + block_size] @ ref_block).toarray()
+            rf[i:i + block_size, j:j + block_size] = \
+                query_sizes[i:i + block_size, None] + ref_sizes[None, j:j + block_size] - 2 * shared
+    rf.flush()
+    del rf
+    print("|RF matrix {} x {} written to {}: {}s".format(len(query_sizes), len(ref_sizes), output_file,
+                                                         np.around(time() - start_time, 2)))
+    stage_end(bfh.metrics, "rf_matrix", start, num_pairs=len(query_sizes) * len(ref_sizes))
+
+
+def consensus_splits(bfh, method="majority", min_support=0.0):
+    """
+    Consensus clades straight from the BFH, most frequent first, with compatibility checked on bitmasks: two clades
+    are compatible when they are disjoint or one contains the other.  Normalized unrooted splits are the clades of the
+    trees rooted at the first taxon.  Majority-rule keeps the clades in more than half of the reference trees, which
+    are always pairwise compatible; greedy keeps adding the most frequent clade compatible with all kept so far.
+    Trivial splits are skipped and the scan stops once the tree is fully resolved.
+    :param bfh: array BFH
+    :param method: "majority" or "greedy"
+    :param min_support: only clades in at least this fraction of the reference trees
+    :return: (clades, counts)
+    """
+    ref_trees_bipartitions = bfh.ref_trees_bipartitions
+    num_ref_trees = bfh.num_ref_trees
+    taxon_map = bfh.taxon_map
+    counts = ref_trees_bipartitions.counts
+    keep = counts.astype(np.int64) >= min_support * num_ref_trees
+    if method == "majority":
+        keep &= counts.astype(np.int64) * 2 > num_ref_trees
+    candidates = np.flatnonzero(keep)
+    candidates = candidates[np.argsort(-counts[candidates].astype(np.int64), kind='stable')]
+    full = (1 << len(taxon_map)) - 1
+    max_clades = len(taxon_map) - 2
+    clades = []
+    clade_counts = []
+    for block in range(0, len(candidates), 4096):
+        index = candidates[block:block + 4096]
+        for clade, count in zip(ref_trees_bipartitions.decode(ref_trees_bipartitions.keys_array[index]), counts[index]):
+            if len(clades) == max_clades:
+                return clades, clade_counts
+            if clade & (clade - 1) == 0 or clade == full or clade == full ^ 1:  # no, one or all but taxon 0
+                continue
+            if all(clade & other in (0, clade, other) for other in clades):
+                clades.append(clade)
+                clade_counts.append(int(count))
+    return clades, clade_counts
+
+
+def consensus_newick(bfh, clades, labels):
+    """
+    Newick string of a set of pairwise compatible clades over the taxon set, with a label on each clade's node.
+    Clades are placed largest first, each below the innermost placed clade holding its taxa.
+    :param bfh: BFH whose taxa are the leaves
+    :param clades: split bitmasks
+    :param labels: node label of each clade, e.g. its support
+    :return:
+    """
+    taxa = bfh.taxa
+    innermost = [-1] * len(taxa)  # node of each taxon: index of its innermost clade, -1 for the root
+    children = {-1: []}
+    for i in sorted(range(len(clades)), key=lambda i: -bin(clades[i]).count('1')):
+        clade = clades[i]
+        children[innermost[(clade & -clade).bit_length() - 1]].append(i)
+        children[i] = []
+        while clade:
+            lowest_bit = clade & -clade
+            innermost[lowest_bit.bit_length() - 1] = i
+            clade ^= lowest_bit
+    for taxon, node in enumerate(innermost):
+        children[node].append(-2 - taxon)  # leaves are -2 - taxon
+    parts = []
+    stack = [-1]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            parts.append(item)
+        elif item <= -2:
+            parts.append(newick_quote(taxa[-2 - item]))
+        else:
+            nodes = sorted(children[item], key=lambda node: -2 - node if node <= -2 else
+                           (clades[node] & -clades[node]).bit_length() - 1)
+            parts.append('(')
+            stack.append(')' + (labels[item] if item >= 0 else ''))
+            for j in range(len(nodes) - 1, -1, -1):
+                stack.append(nodes[j])
+                if j:
+                    stack.append(',')
+    return ''.join(parts) + ';'
+
+
+def annotate_support(bfh, tree_str):
+    """
+    Labels each internal node of a tree with the reference support of its bipartition, count / num_ref_trees,
+    replacing any existing internal label and keeping the rest of the Newick string (branch lengths, comments).
+    Splits are derived and normalized as in newick_bitmasks.
+    :param bfh:
+    :param tree_str:
+    :return: annotated Newick string
+    """
+    task_start = task_begin()
+    taxon_map = bfh.taxon_map
+    is_rooted = False
+    parts = []
+    slots = []  # (index in parts, leafset) of each labelled node
+    stack = []
+    children = []
+    tree_leafset = 0
+    after_close = False
+    skip_label = False
+    for token in newick_token.findall(tree_str):
+        c = token[0]
+        if c == '(':
+            stack.append(children)
+            children = []
+            after_close = False
+        elif c == ',':
+            after_close = False
+        elif c == ')':
+            leafset = 0
+            for child in children:
+                leafset |= child
+            if not stack:
+                raise ValueError("Unbalanced parentheses in tree: {}".format(tree_str.strip()))
+            parent = stack.pop()
+            parts.append(token)
+            if stack and len(children) > 1:
+                slots.append((len(parts), leafset))
+                parts.append('')
+                skip_label = True
+            parent.append(leafset)
+            children = parent
+            after_close = True
+            continue
+        elif c == '[':
+            if not slots and not stack:
+                is_rooted = token[:3].upper() == '[&R'
+        elif c not in ':;' and not c.isspace():
+            if not after_close:
+                try:
+                    leafset = 1 << taxon_map[newick_label(token)]
+                except KeyError:
+                    raise ValueError("Taxon '{}' is not in the taxon namespace of the reference trees".format(
+                        newick_label(token)))
+                tree_leafset |= leafset
+                children.append(leafset)
+            elif skip_label:  # old internal label, replaced by the support
+                skip_label = False
+                continue
+        if c != '[' and not c.isspace():
+            skip_label = False
+        parts.append(token)
+    lowest_bit = tree_leafset & -tree_leafset
+    splits = [leafset if is_rooted or not leafset & lowest_bit else tree_leafset & ~leafset
+              for slot, leafset in slots]
+    for (slot, leafset), count in zip(slots, bfh_counts(bfh, splits)):
+        parts[slot] = "{:.4g}".format(count / bfh.num_ref_trees)
+    task_end(task_start, 1)
+    return ''.join(parts)
 
-    # Sets global tns and gets ref_trees, assumes all trees in q and r have the same tns
-    start_time = begin_time
-    ref_trees_files = open(args.ref_trees, 'r').readlines()
-    num_ref_trees = len(ref_trees_files)
-    print("|Get Reference Trees Files: {}s".format(np.around(time() - start_time, 2)))
-    first_tree = dendropy.Tree.get(data=ref_trees_files[0], schema="newick")
-    tns = first_tree.taxon_namespace  # sets global taxon_namespace
+
+def parse_bipartition_range(bipartition_filter):
+    """
+    Parses a -bipartition_filter value, min-max, into bipartition_range.
+    :param bipartition_filter:
+    :return: [min, max], or [] for no filter
+    """
+    if not bipartition_filter:
+        return []
+    low, high = bipartition_filter.split('-')
+    return [int(low), int(high)]
+
+
+def set_taxa(bfh, taxa):
+    """
+    Sets the taxon order (and Dendropy taxon namespace) of a BFH from a list of labels, and an empty BFH over them.
+    :param bfh:
+    :param taxa:
+    :return:
+    """
+    bfh.taxon_map = {label: i for i, label in enumerate(taxa)}
+    bfh.num_taxa = max(bfh.num_taxa, len(taxa))
+    if dendropy is not None:
+        bfh.tns = dendropy.TaxonNamespace(list(taxa))
+    bfh.ref_trees_bipartitions = BipartitionArray.from_counts({}, num_bitmask_taxa(bfh)) \
+        if bfh.bfh_backend == "array" else {}
+
+
+def set_taxon_order(bfh, first_tree_str):
+    """
+    Sets the taxon order (and Dendropy taxon namespace) of a BFH from a tree, assumes all trees in q and r have the
+    same taxa.
+    :param bfh:
+    :param first_tree_str:
+    :return:
+    """
+    bfh.taxon_map = {label: i for i, label in enumerate(newick_taxa(first_tree_str))}
+    if dendropy is not None:
+        first_tree = dendropy.Tree.get(data=first_tree_str, schema="newick")
+        bfh.tns = first_tree.taxon_namespace
+
+
+def build_reference_bfh(bfh, ref_trees_file, validate=False, batch_size=None, line_range=None, taxa_file=None):
+    """
+    Reads the reference trees, sets the taxon order and builds the BFH.
+    The taxon order is that of the first tree of taxa_file (default: of ref_trees_file, even when only a line range
+    is read), so that partial BFHs of the shards of a file, or of files split from it, can be merged.
+    :param bfh: BFH to fill
+    :param ref_trees_file:
+    :param validate: check the Newick tokenizer against Dendropy first
+    :param batch_size: stream the file in batches of this many trees instead of reading it whole
+    :param line_range: only read these lines of ref_trees_file, from shard_line_range
+    :param taxa_file: tree file whose first tree sets the taxon order
+    :return:
+    """
+    # Sets tns and gets ref_trees, assumes all trees in q and r have the same tns
+    start = stage_start()
+    start_time = time()
+    first_tree_str = next(read_trees(taxa_file if taxa_file else ref_trees_file))
+    if batch_size:
+        ref_trees_files = read_trees(ref_trees_file, line_range)
+    else:
+        ref_trees_files = list(read_trees(ref_trees_file, line_range))
+        bfh.num_ref_trees = len(ref_trees_files)
+        print("|Get Reference Trees Files: {}s".format(np.around(time() - start_time, 2)))
+    set_taxon_order(bfh, first_tree_str)
+    if validate:
+        mismatches = validate_parser(bfh, read_trees(ref_trees_file, line_range) if batch_size else ref_trees_files)
+        if mismatches:
+            raise ValueError("Newick parser disagrees with Dendropy on reference trees (lines): {}".format(
+                [i + 1 for i in mismatches]))
+        print("|Validated Newick parser against Dendropy on the reference trees")
 
     # Dynamically read and fill BFH
-    create_bipartition_set(ref_trees_files)
+    if bfh.bfh_backend == "sketch":
+        bfh.num_ref_trees = create_bipartition_sketch(bfh, ref_trees_files, batch_size or 1000)
+    elif batch_size:
+        bfh.num_ref_trees = create_bipartition_set_stream(bfh, ref_trees_files, batch_size)
+    else:
+        create_bipartition_set(bfh, ref_trees_files)
     bipartition_time = time() - start_time
     print('|Parsed {} reference trees, generated bipartitions, and created bfh: {}s\tRate:{} trees/s'.format(
-        num_ref_trees,
+        bfh.num_ref_trees,
         np.around(bipartition_time, 2),
-        np.around(num_ref_trees / bipartition_time, 2)))
-    del ref_trees_files  # explicit memory save
+        np.around(bfh.num_ref_trees / bipartition_time, 2)))
+    stage_end(bfh.metrics, "build_bfh", start, num_trees=bfh.num_ref_trees,
+              unique_bipartitions=len(bfh.ref_trees_bipartitions),
+              bfh_bytes=bfh.ref_trees_bipartitions.nbytes() if bfh.bfh_backend != "dict" else None)
+
 
+def score_query_trees(bfh, query_trees_file, output_file, batch_size=None, ordered=False, line_range=None,
+                      top_k=None, max_rf=None):
+    """
+    Reads the query trees, computes their RF against the BFH and writes the output file.
+    :param bfh:
+    :param query_trees_file:
+    :param output_file:
+    :param batch_size: stream the file in batches of this many trees and write rows as they finish
+    :param ordered: when streaming, write rows in input order
+    :param line_range: only score these lines of query_trees_file, from shard_line_range
+    :param top_k: only write the top_k trees of lowest RF, best first
+    :param max_rf: only write trees with RF <= max_rf
+    :return:
+    """
+    if top_k or max_rf is not None:
+        start = stage_start()
+        start_time = time()
+        rows, num_query_trees = rf_bfh_select(bfh, read_trees(query_trees_file, line_range), batch_size or 100,
+                                              top_k, max_rf)
+        ofh = open(output_file, 'w')
+        for tree_name, avg_norm_rf in rows:
+            ofh.write("{},{}\n".format(tree_name, str(avg_norm_rf)))
+        ofh.close()
+        stage_end(bfh.metrics, "rf_bfh_select", start, num_trees=num_query_trees, num_selected=len(rows))
+        print('|BFHRF: Wrote {} of {} query_trees against {} ref_trees to {}: {}s'.format(
+            len(rows), num_query_trees, bfh.num_ref_trees, output_file, np.around(time() - start_time, 2)))
+        return
+    if batch_size:
+        start = stage_start()
+        start_time = time()
+        num_query_trees = rf_bfh_stream(bfh, read_trees(query_trees_file, line_range), output_file, batch_size,
+                                        ordered)
+        stage_end(bfh.metrics, "rf_bfh_stream", start, num_trees=num_query_trees, cache_size=bfh.score_cache_size)
+        print('|BFHRF: Streamed RF of {} query_trees against {} ref_trees to {}: {}s'.format(
+            num_query_trees, bfh.num_ref_trees, output_file, np.around(time() - start_time, 2)))
+        print('|Number of unique bipartitions: {}'.format(len(bfh.ref_trees_bipartitions)))
+        return
     # Get query trees.
+    start = stage_start()
     start_time = time()
-    query_trees_files = open(args.query_trees, 'r').readlines()
+    query_trees_files = list(read_trees(query_trees_file, line_range))
     print("|Get Query Trees Files: {}s".format(np.around(time() - start_time, 2)))
+    stage_end(bfh.metrics, "read_query", start, num_trees=len(query_trees_files))
 
     # Parse, bipartitions, RF vs BFH calc.
+    start = stage_start()
     start_time = time()
-    query_trees_rf_dist = rf_bfh(query_trees_files)
+    query_trees_rf_dist = rf_bfh(bfh, query_trees_files)
+    stage_end(bfh.metrics, "rf_bfh", start, num_trees=len(query_trees_rf_dist), cache_size=bfh.score_cache_size)
     bfh_time = time() - start_time
     print(
-        '|BFHRF: Computed RF of {} query_trees against {} ref_trees: {}s'.format(len(query_trees_rf_dist.keys()),
-                                                                                 num_ref_trees,
+        '|BFHRF: Computed RF of {} query_trees against {} ref_trees: {}s'.format(len(query_trees_rf_dist),
+                                                                                 bfh.num_ref_trees,
                                                                                  np.around(bfh_time, 2)))
-    print('|Number of unique bipartitions: {}'.format(len(ref_trees_keys)))
+    print('|Number of unique bipartitions: {}{}'.format(len(bfh.ref_trees_bipartitions),
+                                                      " (estimated)" if bfh.bfh_backend == "sketch" else ""))
+    if bfh.bfh_backend == "array":
+        print('|BFH array size: {} bytes'.format(bfh.ref_trees_bipartitions.nbytes()))
+    elif bfh.bfh_backend == "sketch":
+        print('|BFH sketch size: {} bytes, max overcount per bipartition: {}'.format(
+            bfh.ref_trees_bipartitions.nbytes(), bfh.ref_trees_bipartitions.max_overcount()))
     # write file
+    start = stage_start()
     start_time = time()
-    ofh = open(args.output_file, 'w')
-    for key in sorted(query_trees_rf_dist.keys()):
-        ofh.write("{},{}\n".format(key, str(query_trees_rf_dist[key])))
+    ofh = open(output_file, 'w')
+    for tree_name, avg_norm_rf in query_trees_rf_dist:
+        ofh.write("{},{}\n".format(tree_name, format_rf(avg_norm_rf)))
     ofh.close()
     file_time = time() - start_time
     print('|File Output: {}s'.format(np.around(file_time, 2)))
+    stage_end(bfh.metrics, "output", start, num_trees=len(query_trees_rf_dist))
+
+
+def run_pipeline(bfh, ref_trees_file, query_trees_file, output_file, validate=False):
+    """
+    -pipeline run: builds the BFH and scores the query trees with one persistent pool, see rf_bfh_pipeline.
+    :param bfh: BFH to fill
+    :param ref_trees_file:
+    :param query_trees_file: None to score the reference trees against their own BFH, parsing each once
+    :param output_file:
+    :param validate: check the Newick tokenizer against Dendropy first
+    :return:
+    """
+    start = stage_start()
+    start_time = time()
+    set_taxon_order(bfh, next(read_trees(ref_trees_file)))
+    if validate:
+        mismatches = validate_parser(bfh, read_trees(ref_trees_file))
+        if mismatches:
+            raise ValueError("Newick parser disagrees with Dendropy on reference trees (lines): {}".format(
+                [i + 1 for i in mismatches]))
+        print("|Validated Newick parser against Dendropy on the reference trees")
+    if query_trees_file is None:
+        print("|Self comparison: parsing each reference tree once for the BFH and as a query")
+    num_query_trees, bfh_time = rf_bfh_pipeline(bfh, read_trees(ref_trees_file),
+                                                read_trees(query_trees_file) if query_trees_file else None,
+                                                output_file)
+    stage_end(bfh.metrics, "rf_bfh_pipeline", start, num_trees=num_query_trees, num_ref_trees=bfh.num_ref_trees,
+              bfh_seconds=bfh_time, unique_bipartitions=len(bfh.ref_trees_bipartitions),
+              bfh_bytes=bfh.ref_trees_bipartitions.nbytes())
+    print('|BFHRF: Pipelined RF of {} query_trees against {} ref_trees to {}: {}s'.format(
+        num_query_trees, bfh.num_ref_trees, output_file, np.around(time() - start_time, 2)))
+    print('|Number of unique bipartitions: {}'.format(len(bfh.ref_trees_keys)))
+
+
+def write_index(bfh, index_file):
+    """
+    Writes the BFH to an index file: magic, header length, JSON header (taxon order, num_ref_trees, ref_trees_sum,
+    key width and count, popcount buckets), padding to 8 bytes, then the sorted keys and the uint32 counts.
+    :param bfh: array BFH
+    :param index_file:
+    :return:
+    """
+    ref_trees_bipartitions = bfh.ref_trees_bipartitions
+    bucket_offsets, bucket_sums = ref_trees_bipartitions.buckets()
+    header = json.dumps({"version": index_version,
+                         "num_taxa": bfh.num_taxa,
+                         "taxa": bfh.taxa,
+                         "num_ref_trees": bfh.num_ref_trees,
+                         "ref_trees_sum": ref_trees_bipartitions.total(),
+                         "key_taxa": ref_trees_bipartitions.num_taxa,
+                         "num_words": ref_trees_bipartitions.num_words,
+                         "num_keys": len(ref_trees_bipartitions),
+                         "bucket_offsets": [int(offset) for offset in bucket_offsets],
+                         "bucket_sums": [int(bucket_sum) for bucket_sum in bucket_sums]}).encode()
+    header += b' ' * (-(len(index_magic) + 8 + len(header)) % 8)
+    with open(index_file + '.tmp', 'wb') as ofh:
+        ofh.write(index_magic)
+        ofh.write(len(header).to_bytes(8, 'little'))
+        ofh.write(header)
+        ofh.write(ref_trees_bipartitions.keys_array.tobytes())
+        ofh.write(ref_trees_bipartitions.counts.astype('<u4').tobytes())
+    os.replace(index_file + '.tmp', index_file)  # the old index may still be memory-mapped
+
+
+def read_index(index_file):
+    """
+    Memory-maps an index file written by write_index.
+    :param index_file:
+    :return: (header, BipartitionArray backed by the file)
+    """
+    with open(index_file, 'rb') as ifh:
+        if ifh.read(len(index_magic)) != index_magic:
+            raise ValueError("{} is not a BFH index file".format(index_file))
+        header_len = int.from_bytes(ifh.read(8), 'little')
+        header = json.loads(ifh.read(header_len).decode())
+    if header["version"] != index_version:
+        raise ValueError("{} is a version {} BFH index, rebuild it with build-index".format(index_file,
+                                                                                          header["version"]))
+    keys_offset = len(index_magic) + 8 + header_len
+    bfh = BipartitionArray(None, None, header["key_taxa"])
+    bfh.bucket_offsets = np.array(header["bucket_offsets"], dtype=np.int64)
+    bfh.bucket_sums = np.array(header["bucket_sums"], dtype=np.int64)
+    num_keys = header["num_keys"]
+    if num_keys == 0:
+        bfh.keys_array = np.zeros(0, dtype=bfh.key_dtype)
+        bfh.counts = np.zeros(0, dtype=np.uint32)
+        return header, bfh
+    counts_offset = keys_offset + num_keys * bfh.key_dtype.itemsize
+    bfh.keys_array = np.memmap(index_file, dtype=bfh.key_dtype, mode='r', offset=keys_offset, shape=(num_keys,))
+    bfh.counts = np.memmap(index_file, dtype='<u4', mode='r', offset=counts_offset, shape=(num_keys,))
+    bfh.source = {"index_file": os.path.abspath(index_file), "identity": index_identity(index_file),
+                  "keys_offset": keys_offset, "counts_offset": counts_offset}
+    return header, bfh
+
+
+def index_identity(index_file):
+    """
+    Inode, size and modification time of an index file, so that workers mapping it can tell it was not replaced
+    (write_index replaces index files rather than rewriting them).
+    :param index_file:
+    :return:
+    """
+    stat = os.stat(index_file)
+    return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+
+def load_index(bfh, index_file):
+    """
+    Sets a BFH, its taxon order and reference tree statistics from an index file.
+    :param bfh:
+    :param index_file:
+    :return:
+    """
+    start = stage_start()
+    start_time = time()
+    header, bfh.ref_trees_bipartitions = read_index(index_file)
+    bfh.bfh_backend = "array"
+    bfh.num_taxa = header["num_taxa"]
+    bfh.num_ref_trees = header["num_ref_trees"]
+    bfh.ref_trees_sum = header["ref_trees_sum"]
+    bfh.taxon_map = {label: i for i, label in enumerate(header["taxa"])}
+    if dendropy is not None:
+        bfh.tns = dendropy.TaxonNamespace(header["taxa"])
+    print("|Loaded BFH index of {} reference trees, {} unique bipartitions: {}s".format(
+        bfh.num_ref_trees, len(bfh.ref_trees_bipartitions), np.around(time() - start_time, 2)))
+    stage_end(bfh.metrics, "load_index", start, unique_bipartitions=len(bfh.ref_trees_bipartitions),
+              bfh_bytes=bfh.ref_trees_bipartitions.nbytes())
+
+
+def merge_indexes(bfh, index_files):
+    """
+    Sets a BFH to the sum of partial BFH index files, e.g. one per shard of the reference trees, merged pairwise in a
+    tree reduction.  The partials must share their taxon order, which they do when built from shards of the same file
+    or with the same -taxa_from file.  Partials built with different num_taxa have keys of different widths; they are
+    re-encoded to the widest.
+    :param bfh:
+    :param index_files:
+    :return:
+    """
+    load_index(bfh, index_files[0])
+    taxa = bfh.taxa
+    partial_bfhs = [bfh.ref_trees_bipartitions]
+    for index_file in index_files[1:]:
+        header, partial_bfh = read_index(index_file)
+        if header["taxa"] != taxa:
+            raise ValueError("{} has a different taxon order than {}; build the partials from shards of one file or "
+                             "with the same -taxa_from file".format(index_file, index_files[0]))
+        bfh.num_taxa = max(bfh.num_taxa, header["num_taxa"])
+        bfh.num_ref_trees += header["num_ref_trees"]
+        partial_bfhs.append(partial_bfh)
+    key_taxa = max(partial_bfh.num_taxa for partial_bfh in partial_bfhs)
+    partial_bfhs = [partial_bfh.widened(key_taxa) for partial_bfh in partial_bfhs]
+    while len(partial_bfhs) > 1:
+        partial_bfhs = [partial_bfhs[i].merge(partial_bfhs[i + 1]) if i + 1 < len(partial_bfhs) else partial_bfhs[i]
+                        for i in range(0, len(partial_bfhs), 2)]
+    bfh.ref_trees_bipartitions = partial_bfhs[0]
+    bfh.ref_trees_sum = bfh.ref_trees_bipartitions.total()
+
+
+def is_index_file(bfh_file):
+    """
+    :param bfh_file:
+    :return: whether the file is a BFH index file rather than a tree file
+    """
+    with open(bfh_file, 'rb') as ifh:
+        return ifh.read(len(index_magic)) == index_magic
+
+
+def handle_request(bfh, pool, request):
+    """
+    Answers one server request; runs in an executor thread so the event loop keeps serving other connections.
+    :param bfh: the served BFH
+    :param pool: persistent pool of rf_bfh_mp workers
+    :param request: {"trees": [newick, ...]} or {"command": "info"}
+    :return: response dict
+    """
+    if request.get("command") == "info":
+        return {"num_ref_trees": bfh.num_ref_trees, "unique_bipartitions": len(bfh),
+                "taxa": bfh.taxa, "bipartition_range": bfh.bipartition_range}
+    trees = request["trees"]
+    if isinstance(trees, str):
+        raise TypeError("trees must be a list of Newick strings")
+    chunk_size = max(ceil(len(trees) / (bfh.num_cpu * 4)), 1)
+    return {"rf": [avg_norm_rf for tree_str, avg_norm_rf in pool.map(partial(worker_task, rf_bfh_mp), trees,
+                                                                     chunk_size)]}
+
+
+async def serve_client(bfh, pool, reader, writer, stop, counters):
+    """
+    One connection: newline-delimited JSON requests, each answered by one JSON line, in order.
+    :param bfh:
+    :param pool:
+    :param reader:
+    :param writer:
+    :param stop: event that shuts the server down, set by {"command": "shutdown"}
+    :param counters: requests/trees served
+    :return:
+    """
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        line = await reader.readline()
+        if not line:
+            break
+        request = None
+        try:
+            request = json.loads(line)
+            if request.get("command") == "shutdown":
+                response = {"shutdown": True}
+                stop.set()
+            else:
+                response = await loop.run_in_executor(None, handle_request, bfh, pool, request)
+                counters["requests"] += 1
+                counters["trees"] += len(response.get("rf", []))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            response = {"error": "{}: {}".format(type(e).__name__, e)}
+        if isinstance(request, dict) and "id" in request:
+            response["id"] = request["id"]
+        writer.write((json.dumps(response) + "\n").encode())
+        await writer.drain()
+    writer.close()
+
+
+async def serve_requests(bfh, pool, socket_path, host, port, counters):
+    """
+    Serves scoring requests on a Unix socket (socket_path) or TCP (host, port) until SIGINT/SIGTERM or a shutdown
+    request.
+    :param bfh:
+    :param pool:
+    :param socket_path:
+    :param host:
+    :param port:
+    :param counters:
+    :return:
+    """
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signal_number, stop.set)
+        except (NotImplementedError, RuntimeError):  # e.g. on Windows
+            pass
+
+    def client_connected(reader, writer):
+        return serve_client(bfh, pool, reader, writer, stop, counters)
+
+    if socket_path:
+        server = await asyncio.start_unix_server(client_connected, path=socket_path, limit=1 << 30)
+        address = socket_path
+    else:
+        server = await asyncio.start_server(client_connected, host, port, limit=1 << 30)
+        address = "{}:{}".format(*server.sockets[0].getsockname()[:2])
+    print("|Serving BFH of {} reference trees on {}".format(bfh.num_ref_trees, address))
+    sys.stdout.flush()
+    async with server:
+        await stop.wait()
+
+
+def query_server(address, trees, timeout=None):
+    """
+    Client for the serve command: scores trees against a running server.
+    :param address: Unix socket path, or (host, port)
+    :param trees: Newick strings
+    :param timeout: socket timeout in seconds
+    :return: average RF of each tree, in order
+    """
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    with socket.socket(family, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(address)
+        client.sendall((json.dumps({"trees": list(trees)}) + "\n").encode())
+        with client.makefile('rb') as response_file:
+            response = json.loads(response_file.readline())
+    if "error" in response:
+        raise ValueError(response["error"])
+    return response["rf"]
+
+
+class BFH(object):
+    """
+    Importable BFHRF: one BFH with its taxon order, reference tree count and settings.  The module functions take the
+    BFH they work on as their first argument, so instances are independent: several can be used at the same time,
+    e.g. from different threads (one call at a time per instance).  Pools receive what they need through init_worker.
+    With num_cpu=None everything runs in the calling process.
+
+        bfh = BFH.from_trees(read_trees("reference.tre"))
+        rfs = bfh.score_many(read_trees("query.tre"))
+        bfh.save("reference.bfh")
+    """
+
+    def __init__(self, taxa=None, bipartition_filter=None, parser="newick", backend="array", num_cpu=None,
+                 start_method=None, cache_size=0, num_taxa=0, sketch_epsilon=1e-6, sketch_delta=0.01,
+                 sketch_memory=None, metrics=None):
+        """
+        :param taxa: taxon labels in bit order, default: those of the first tree added
+        :param bipartition_filter: "min-max" or (min, max): only score bipartitions whose smaller side has min to
+                                   max-1 taxa
+        :param parser: "newick" or "dendropy"
+        :param backend: "array" or "dict", or "sketch" for build_file
+        :param num_cpu: workers for building and scoring, None to run in this process
+        :param start_method: multiprocessing start method of the pools
+        :param cache_size: slots of the score cache of parallel scoring, 0 disables it
+        :param num_taxa: minimum number of bitmask bits
+        :param sketch_epsilon: sketch backend: counts are overestimated by at most epsilon x the total count
+        :param sketch_delta: sketch backend: probability of a count exceeding that bound
+        :param sketch_memory: sketch backend: cap on the sketch size in bytes, None for no cap
+        :param metrics: Metrics that the stages and pools of this BFH are recorded in, e.g. from start_instrumentation
+        """
+        if backend not in ("array", "dict", "sketch"):
+            raise ValueError("BFH backend must be array, dict or sketch, not {}".format(backend))
+        if dendropy is None and parser == "dendropy":
+            raise ImportError("Dendropy is required for parser dendropy")
+        if isinstance(bipartition_filter, str):
+            bipartition_filter = parse_bipartition_range(bipartition_filter)
+        self.tns = None
+        self.taxon_map = {}
+        self.tree_parser = parser
+        self.bfh_backend = backend
+        self.ref_trees_bipartitions = None
+        self.num_taxa = num_taxa
+        self.num_ref_trees = 0
+        self.ref_trees_keys = []
+        self.ref_trees_sum = 0
+        self.bipartition_range = list(bipartition_filter) if bipartition_filter else []
+        self.bucket_max_counts = None
+        self.num_cpu = num_cpu
+        self.start_method = start_method
+        self.score_cache_size = cache_size
+        self.sketch_epsilon = sketch_epsilon
+        self.sketch_delta = sketch_delta
+        self.sketch_memory = sketch_memory
+        self.metrics = metrics
+        if taxa is not None:
+            set_taxa(self, taxa)
+
+    @classmethod
+    def from_trees(cls, trees, batch_size=1000, **settings):
+        """
+        Builds a BFH from an iterable of Newick strings, e.g. read_trees() or a list.
+        :param trees:
+        :param batch_size: trees per batch
+        :param settings: see __init__
+        :return:
+        """
+        bfh = cls(**settings)
+        bfh.update(add=trees, batch_size=batch_size)
+        return bfh
+
+    @classmethod
+    def load(cls, index_file, **settings):
+        """
+        Memory-maps a BFH index file, from save or the build-index command.
+        :param index_file:
+        :param settings: see __init__, the taxa come from the index
+        :return:
+        """
+        bfh = cls(**settings)
+        load_index(bfh, index_file)
+        set_bfh_keys(bfh)
+        return bfh
+
+    @classmethod
+    def merge_files(cls, index_files, **settings):
+        """
+        Sum of partial BFH index files, see merge_indexes.
+        :param index_files:
+        :param settings: see __init__
+        :return:
+        """
+        bfh = cls(**settings)
+        merge_indexes(bfh, index_files)
+        set_bfh_keys(bfh)
+        return bfh
+
+    def update(self, add=(), remove=(), batch_size=1000):
+        """
+        Adds and/or removes reference trees.  The first tree ever added sets the taxon order unless taxa were given.
+        :param add: iterable of Newick strings
+        :param remove: iterable of Newick strings that were added before
+        :param batch_size: trees per batch
+        :return: self
+        """
+        if self.bfh_backend == "sketch":
+            raise ValueError("A sketch BFH cannot be updated")
+        trees = iter(add)
+        first_tree_str = next(trees, None)
+        if first_tree_str is not None:
+            if not self.taxon_map:
+                set_taxon_order(self, first_tree_str)
+            trees = chain([first_tree_str], trees)
+        if self.ref_trees_bipartitions is None:
+            if not self.taxon_map:
+                return self
+            set_taxa(self, self.taxa)
+        for delta_trees, subtract in ((trees, False), (remove, True)):
+            delta_trees = iter(delta_trees)
+            first_tree_str = next(delta_trees, None)
+            if first_tree_str is None:
+                continue  # nothing to count, so no pool to start
+            num_trees, delta_bfh = count_bipartition_stream(self, chain([first_tree_str], delta_trees), batch_size,
+                                                            self.num_cpu is None)
+            apply_bfh_delta(self, delta_bfh, num_trees, subtract)
+        set_bfh_keys(self)
+        return self
+
+    def score(self, tree_str):
+        """
+        :param tree_str: Newick string
+        :return: average RF of the tree against the reference trees
+        """
+        return self.score_many([tree_str])[0]
+
+    def score_many(self, trees, batch_size=1000):
+        """
+        Average RF of each tree against the reference trees, in order.  In this process, the array backend looks up
+        a whole batch at once; with num_cpu, batches are scored by a pool.
+        :param trees: iterable of Newick strings
+        :param batch_size: trees per batch
+        :return: list of floats
+        """
+        if self.num_ref_trees == 0:
+            raise ValueError("The BFH has no reference trees")
+        if self.bfh_backend == "sketch":
+            raise ValueError("score_many needs an exact BFH, score sketch BFHs with score_file")
+        rfs = []
+        if self.num_cpu is None:
+            for start, batch in tree_batches(trees, batch_size):
+                if self.bfh_backend == "array":
+                    tree1_bitmasks = [query_bitmasks(self, tree_str) for tree_str in batch]
+                    keys = self.ref_trees_bipartitions.encode([bitmask for bitmasks in tree1_bitmasks
+                                                               for bitmask in bitmasks])
+                    sizes = np.array([len(bitmasks) for bitmasks in tree1_bitmasks], dtype=np.int64)
+                    rfs.extend(float(avg_norm_rf) for avg_norm_rf in rf_bfh_parsed(self, keys, sizes))
+                else:
+                    rfs.extend(rf_bfh_score(self, query_bitmasks(self, tree_str)) for tree_str in batch)
+            return rfs
+        window = BatchWindow(2 * self.num_cpu)
+        with worker_pool(self, publish=True, cache_size=self.score_cache_size, window=window) as pool:
+            for start, results in pool.imap(partial(worker_task, rf_bfh_batch), tree_batches(trees, batch_size,
+                                                                                                window)):
+                window.release()
+                rfs.extend(avg_norm_rf for tree_str, avg_norm_rf in results)
+        return rfs
+
+    def save(self, index_file):
+        """
+        Writes the BFH to an index file (array backend), readable with load and by the query command.
+        :param index_file:
+        :return:
+        """
+        if self.bfh_backend != "array":
+            raise ValueError("Only the array backend can be saved")
+        write_index(self, index_file)
+
+    def consensus(self, method="majority", min_support=0.0):
+        """
+        Consensus tree of the reference trees, see consensus_splits (array backend).
+        :param method: "majority" or "greedy"
+        :param min_support:
+        :return: Newick string with clade supports as internal node labels
+        """
+        if self.bfh_backend != "array":
+            raise ValueError("Only the array backend can build consensus trees")
+        clades, counts = consensus_splits(self, method, min_support)
+        return consensus_newick(self, clades, ["{:.4g}".format(count / self.num_ref_trees) for count in counts])
+
+    def annotate(self, tree_str):
+        """
+        :param tree_str: Newick string
+        :return: the tree with the reference support of each bipartition as internal node labels
+        """
+        return annotate_support(self, tree_str)
+
+    def build_file(self, ref_trees_file, validate=False, batch_size=None, line_range=None, taxa_file=None):
+        """
+        Builds the BFH from a tree file, see build_reference_bfh.  Used by the command line.
+        :return: self
+        """
+        build_reference_bfh(self, ref_trees_file, validate, batch_size, line_range, taxa_file)
+        set_bfh_keys(self)
+        return self
+
+    def score_file(self, query_trees_file, output_file, batch_size=None, ordered=False, line_range=None, top_k=None,
+                   max_rf=None):
+        """
+        Scores a tree file and writes the output file, see score_query_trees.  Used by the command line.
+        :return:
+        """
+        score_query_trees(self, query_trees_file, output_file, batch_size, ordered, line_range, top_k, max_rf)
+
+    def pipeline_file(self, ref_trees_file, query_trees_file, output_file, validate=False):
+        """
+        Builds the BFH and scores the query trees with one pool, see run_pipeline.  Used by the command line.
+        :return: self
+        """
+        run_pipeline(self, ref_trees_file, query_trees_file, output_file, validate)
+        return self
+
+    def matrix_file(self, query_trees_file, ref_trees_file, output_file, block_size=2048):
+        """
+        All-pairs RF matrix of two tree files, see rf_matrix (array backend, needs SciPy).  Used by the command line.
+        :param query_trees_file:
+        :param ref_trees_file: the reference trees this BFH was built from, whose bipartitions are its columns
+        :param output_file: .npy file
+        :param block_size: rows/columns per tile
+        :return:
+        """
+        if sparse is None:
+            raise ImportError("SciPy is required for the RF matrix")
+        if self.bfh_backend != "array":
+            raise ValueError("Only the array backend can compute RF matrices")
+        rf_matrix(self, list(read_trees(query_trees_file)), list(read_trees(ref_trees_file)), output_file,
+                  block_size)
+
+    def consensus_file(self, output_file, method="majority", min_support=0.0):
+        """
+        Writes the consensus tree, see consensus.  Used by the command line.
+        :return:
+        """
+        if self.bfh_backend != "array":
+            raise ValueError("Only the array backend can build consensus trees")
+        start = stage_start()
+        start_time = time()
+        clades, counts = consensus_splits(self, method, min_support)
+        tree_str = consensus_newick(self, clades, ["{:.4g}".format(count / self.num_ref_trees) for count in counts])
+        with open(output_file, 'w') as ofh:
+            ofh.write(tree_str + "\n")
+        print("|{} consensus of {} reference trees, {} clades, written to {}: {}s".format(
+            method.capitalize(), self.num_ref_trees, len(clades), output_file, np.around(time() - start_time, 2)))
+        stage_end(self.metrics, "consensus", start, num_clades=len(clades))
+
+    def annotate_file(self, trees_file, output_file):
+        """
+        Writes the trees of a tree file annotated with reference support, see annotate, in a pool with num_cpu.  Used
+        by the command line.
+        :param trees_file:
+        :param output_file:
+        :return: number of trees
+        """
+        start = stage_start()
+        start_time = time()
+        num_trees = 0
+        last_report = start_time
+        with open(output_file, 'w') as ofh, \
+                nullcontext() if self.num_cpu is None else worker_pool(self, publish=True) as pool:
+            if pool is None:
+                annotated_trees = (annotate_support(self, tree_str) for tree_str in read_trees(trees_file))
+            else:
+                annotated_trees = pool.imap(partial(worker_task, annotate_support), read_trees(trees_file), 64)
+            for annotated in annotated_trees:
+                ofh.write(annotated)
+                num_trees += 1
+                last_report = report_progress(num_trees, None, start_time, last_report)
+        print("|Annotated {} query trees with reference support, written to {}: {}s".format(
+            num_trees, output_file, np.around(time() - start_time, 2)))
+        stage_end(self.metrics, "annotate", start, num_trees=num_trees)
+        return num_trees
+
+    def serve(self, socket_path=None, host="127.0.0.1", port=0):
+        """
+        Answers scoring requests on a Unix socket or TCP with a persistent pool of num_cpu workers until
+        SIGINT/SIGTERM or a shutdown request, see serve_requests.  Used by the command line.
+        :param socket_path: Unix socket path, None for TCP
+        :param host:
+        :param port: 0 for any free port
+        :return: {"requests": ..., "trees": ...} served
+        """
+        if self.num_cpu is None:
+            raise ValueError("Serving needs num_cpu workers")
+        start = stage_start()
+        counters = {"requests": 0, "trees": 0}
+        try:
+            with worker_pool(self, publish=True, cache_size=self.score_cache_size) as pool:
+                try:
+                    asyncio.run(serve_requests(self, pool, socket_path, host, port, counters))
+                except KeyboardInterrupt:
+                    pass
+        finally:
+            if socket_path and os.path.exists(socket_path):
+                os.remove(socket_path)
+        print('|Served {} requests, {} trees: {}s'.format(counters["requests"], counters["trees"],
+                                                          np.around(time() - start[0], 2)))
+        stage_end(self.metrics, "serve", start, num_trees=counters["trees"], num_requests=counters["requests"])
+        return counters
+
+    def release(self):
+        """
+        Frees the shared memory of a sketch BFH.
+        :return:
+        """
+        if isinstance(self.ref_trees_bipartitions, BipartitionSketch):
+            self.ref_trees_bipartitions.release()
+
+    @property
+    def taxa(self):
+        return sorted(self.taxon_map, key=self.taxon_map.get)
+
+    def __len__(self):
+        """
+        :return: number of unique bipartitions
+        """
+        return len(self.ref_trees_bipartitions) if self.ref_trees_bipartitions is not None else 0
+
+
+def main(args):
+    """
+    :param args:
+    :return:
+    """
+    if dendropy is None and args.validate:
+        raise ImportError("Dendropy is required for -validate")
+    score_cache_size = int(args.cache_size)
+    if args.bfh_backend == "sketch":
+        if args.pipeline or args.top_k or args.max_rf:
+            raise ValueError("-bfh_backend sketch does not combine with -pipeline, -top_k or -max_rf")
+        score_cache_size = 0  # the cache holds exact scores only
+    begin_time = time()
+    metrics, run_start = start_instrumentation(args, "default")
+    bfh = BFH(bipartition_filter=args.bipartition_filter, parser=args.parser, backend=args.bfh_backend,
+              num_cpu=int(args.num_cpu), start_method=args.start_method, cache_size=score_cache_size,
+              num_taxa=int(args.num_taxa), sketch_epsilon=float(args.sketch_epsilon),
+              sketch_delta=float(args.sketch_delta),
+              sketch_memory=int(float(args.sketch_memory) * 2 ** 20) if args.sketch_memory else None, metrics=metrics)
+    # Same file on both sides: parse each tree once, unless the options need the two-pass paths
+    self_mode = (not args.no_self and os.path.samefile(args.ref_trees, args.query_trees)
+                 and args.bfh_backend == "array" and not (args.stream or args.top_k or args.max_rf))
+    if args.pipeline or self_mode:
+        if args.bfh_backend != "array" or args.stream or args.top_k or args.max_rf:
+            raise ValueError("-pipeline needs -bfh_backend array and does not combine with -stream, -top_k or "
+                             "-max_rf")
+        bfh.pipeline_file(args.ref_trees, None if self_mode else args.query_trees, args.output_file, args.validate)
+        finish_instrumentation(metrics, run_start)
+        print('|STATS: TOTAL TIME: {}s'.format(np.around(time() - begin_time, 2)))
+        return
+    batch_size = int(args.batch_size) if args.stream else None
+    try:
+        bfh.build_file(args.ref_trees, args.validate, batch_size)
+        bfh.score_file(args.query_trees, args.output_file, batch_size, args.ordered, None,
+                       int(args.top_k) if args.top_k else None, float(args.max_rf) if args.max_rf else None)
+    finally:
+        bfh.release()
+    finish_instrumentation(metrics, run_start)
+    print('|STATS: TOTAL TIME: {}s'.format(np.around(time() - begin_time, 2)))
+
+
+def build_index_main(args):
+    """
+    build-index: build the BFH of the reference trees and write it to an index file.
+    :param args:
+    :return:
+    """
+    if dendropy is None and args.validate:
+        raise ImportError("Dendropy is required for -validate")
+    begin_time = time()
+    metrics, run_start = start_instrumentation(args, "build-index")
+    bfh = BFH(parser=args.parser, num_cpu=int(args.num_cpu), start_method=args.start_method,
+              num_taxa=int(args.num_taxa), metrics=metrics)
+    bfh.build_file(args.ref_trees, args.validate, int(args.batch_size) if args.stream else None,
+                   shard_line_range(args.ref_trees, args.shard, args.lines), args.taxa_from)
+    start = stage_start()
+    start_time = time()
+    bfh.save(args.index_file)
+    print('|Wrote BFH index {}: {}s'.format(args.index_file, np.around(time() - start_time, 2)))
+    stage_end(metrics, "write_index", start, unique_bipartitions=len(bfh))
+    finish_instrumentation(metrics, run_start)
+    print('|STATS: TOTAL TIME: {}s'.format(np.around(time() - begin_time, 2)))
+
+
+def query_main(args):
+    """
+    query: compute RF of the query trees against a BFH index file, without the reference trees.
+    :param args:
+    :return:
+    """
+    begin_time = time()
+    metrics, run_start = start_instrumentation(args, "query")
+    bfh = BFH.load(args.index_file, bipartition_filter=args.bipartition_filter, parser=args.parser,
+                   num_cpu=int(args.num_cpu), start_method=args.start_method, cache_size=int(args.cache_size),
+                   metrics=metrics)
+    bfh.score_file(args.query_trees, args.output_file, int(args.batch_size) if args.stream else None,
+                   args.ordered, shard_line_range(args.query_trees, args.shard, args.lines),
+                   int(args.top_k) if args.top_k else None, float(args.max_rf) if args.max_rf else None)
+    finish_instrumentation(metrics, run_start)
+    print('|STATS: TOTAL TIME: {}s'.format(np.around(time() - begin_time, 2)))
+
+
+def update_main(args):
+    """
+    update: add and/or remove reference trees in a BFH index file without rebuilding it.
+    :param args:
+    :return:
+    """
+    begin_time = time()
+    metrics, run_start = start_instrumentation(args, "update")
+    bfh = BFH.load(args.index_file, parser=args.parser, num_cpu=int(args.num_cpu), start_method=args.start_method,
+                   metrics=metrics)
+    add_trees = list(read_trees(args.add)) if args.add else []
+    remove_trees = list(read_trees(args.remove)) if args.remove else []
+    start = stage_start()
+    start_time = time()
+    bfh.update(add_trees, remove_trees)
+    print('|Added {} and removed {} reference trees: {}s\tNow {} reference trees, {} unique bipartitions'.format(
+        len(add_trees), len(remove_trees), np.around(time() - start_time, 2), bfh.num_ref_trees, len(bfh)))
+    stage_end(metrics, "update_bfh", start, num_trees=len(add_trees) + len(remove_trees), unique_bipartitions=len(bfh))
+    output_index = args.output_index if args.output_index else args.index_file
+    start = stage_start()
+    bfh.save(output_index)
+    print('|Wrote BFH index {}'.format(output_index))
+    stage_end(metrics, "write_index", start, unique_bipartitions=len(bfh))
+    finish_instrumentation(metrics, run_start)
+    print('|STATS: TOTAL TIME: {}s'.format(np.around(time() - begin_time, 2)))
+
+
+def matrix_main(args):
+    """
+    matrix: full query x reference RF matrix instead of per-query averages.
+    :param args:
+    :return:
+    """
+    if sparse is None:
+        raise ImportError("SciPy is required for the matrix command")
+    if dendropy is None and args.validate:
+        raise ImportError("Dendropy is required for -validate")
+    begin_time = time()
+    metrics, run_start = start_instrumentation(args, "matrix")
+    bfh = BFH(bipartition_filter=args.bipartition_filter, parser=args.parser, num_cpu=int(args.num_cpu),
+              start_method=args.start_method, num_taxa=int(args.num_taxa), metrics=metrics)
+    bfh.build_file(args.ref_trees, args.validate)
+    bfh.matrix_file(args.query_trees, args.ref_trees, args.output_file, int(args.block_size))
+    finish_instrumentation(metrics, run_start)
+    print('|STATS: TOTAL TIME: {}s'.format(np.around(time() - begin_time, 2)))
+
+
+def merge_main(args):
+    """
+    merge: sum partial BFH index files into one index.
+    :param args:
+    :return:
+    """
+    begin_time = time()
+    metrics, run_start = start_instrumentation(args, "merge")
+    start = stage_start()
+    bfh = BFH.merge_files(args.partial_indexes, metrics=metrics)
+    print('|Merged {} partial BFHs: {}s\tNow {} reference trees, {} unique bipartitions'.format(
+        len(args.partial_indexes), np.around(time() - begin_time, 2), bfh.num_ref_trees, len(bfh)))
+    stage_end(metrics, "merge", start, num_trees=bfh.num_ref_trees, unique_bipartitions=len(bfh))
+    start = stage_start()
+    bfh.save(args.index_file)
+    print('|Wrote BFH index {}'.format(args.index_file))
+    stage_end(metrics, "write_index", start, unique_bipartitions=len(bfh))
+    finish_instrumentation(metrics, run_start)
+    print('|STATS: TOTAL TIME: {}s'.format(np.around(time() - begin_time, 2)))
+
+
+def load_or_build(bfh_file, **settings):
+    """
+    BFH of the serve and consensus commands: loaded from an index file, or built from a reference tree file.
+    :param bfh_file:
+    :param settings: see BFH
+    :return:
+    """
+    if is_index_file(bfh_file):
+        return BFH.load(bfh_file, **settings)
+    return BFH(**settings).build_file(bfh_file)
+
+
+def serve_main(args):
+    """
+    serve: load (or build) the BFH once and answer scoring requests over a Unix socket or localhost TCP.
+    :param args:
+    :return:
+    """
+    begin_time = time()
+    metrics, run_start = start_instrumentation(args, "serve")
+    bfh = load_or_build(args.bfh_file, bipartition_filter=args.bipartition_filter, parser=args.parser,
+                        num_cpu=int(args.num_cpu), start_method=args.start_method, cache_size=int(args.cache_size),
+                        metrics=metrics)
+    bfh.serve(args.socket, args.host, int(args.port))
+    finish_instrumentation(metrics, run_start)
+    print('|STATS: TOTAL TIME: {}s'.format(np.around(time() - begin_time, 2)))
+
+
+def consensus_main(args):
+    """
+    consensus: majority-rule or greedy consensus tree straight from the BFH, with clade supports, and optionally the
+    query trees annotated with reference support.
+    :param args:
+    :return:
+    """
+    begin_time = time()
+    metrics, run_start = start_instrumentation(args, "consensus")
+    bfh = load_or_build(args.bfh_file, parser=args.parser, num_cpu=int(args.num_cpu), start_method=args.start_method,
+                        metrics=metrics)
+    bfh.consensus_file(args.output_file, args.method, float(args.min_support))
+    if args.annotate:
+        bfh.annotate_file(args.annotate, args.annotate_file)
+    finish_instrumentation(metrics, run_start)
     print('|STATS: TOTAL TIME: {}s'.format(np.around(time() - begin_time, 2)))
 
 
+commands = {"build-index": build_index_main, "query": query_main, "update": update_main, "matrix": matrix_main,
+            "merge": merge_main, "serve": serve_main, "consensus": consensus_main}
+
+
 if __name__ == "__main__":
     """Bipartition Frequency Hash Robinson Foulds (BFHRF).  In calculating RF between 2 disparate lists of trees, 
     Q and R, we employ a BFH that computes a q vs BFH_R for all trees in Q.  Bipartition filtering is implemented 
-    here,  however it has been moved to another repo. It will be available in BPSTERF. """
-    parser = argparse.ArgumentParser(description='')
-    parser.add_argument("ref_trees",
-                        help="Required reference tree file.  Assumes one newick tree per line.")
-    parser.add_argument("query_trees",
-                        help="Required query tree file.  Assumes one newick tree per line.")
-    parser.add_argument("num_taxa", help="Number of taxa")
-    parser.add_argument("num_cpu", help="Number of CPUs")
-    parser.add_argument("-output_file", help="Output file, default=bfhrf_output.txt", default="bfhrf_output.txt")
-    # parser.add_argument("-bipartition_filter", help="Optional bipartition filtering by size.  Value can be 1 to "
-    #                                                 "floor(n/2).  Values entered as range: min-max and does not "
-    #                                                 "include max", type=str, default=[])
-    input_args = parser.parse_args()
+    here: -bipartition_filter min-max only scores bipartitions whose smaller side has min to max-1 taxa.
+    The optional first argument selects a command: build-index, query, update, matrix, merge, serve or consensus.
+    Without one, the classic ref_trees query_trees num_taxa num_cpu run is done."""
+    command = sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] in commands else None
+    prog = " ".join([os.path.basename(sys.argv[0])] + ([command] if command else []))
+    parser = argparse.ArgumentParser(prog=prog, description='')
+    if command == "build-index":
+        parser.add_argument("ref_trees",
+                            help="Required reference tree file.  Newick or Nexus, optionally compressed.")
+        parser.add_argument("index_file", help="BFH index file to write")
+        parser.add_argument("num_taxa", help="Number of taxa")
+        parser.add_argument("num_cpu", help="Number of CPUs")
+    elif command == "query":
+        parser.add_argument("index_file", help="BFH index file written by build-index")
+        parser.add_argument("query_trees",
+                            help="Required query tree file.  Newick or Nexus, optionally compressed.")
+        parser.add_argument("num_cpu", help="Number of CPUs")
+    elif command == "update":
+        parser.add_argument("index_file", help="BFH index file written by build-index")
+        parser.add_argument("num_cpu", help="Number of CPUs")
+        parser.add_argument("-add", help="Tree file to add to the reference trees.  Newick or Nexus, optionally "
+                                         "compressed.")
+        parser.add_argument("-remove", help="Tree file to remove from the reference trees.  Newick or Nexus, "
+                                            "optionally compressed.")
+        parser.add_argument("-output_index", help="Index file to write, default=overwrite index_file")
+    elif command == "serve":
+        parser.add_argument("bfh_file", help="BFH index file written by build-index, or a reference tree file to "
+                                             "build the BFH from.  Newick or Nexus, optionally compressed.")
+        parser.add_argument("num_cpu", help="Number of CPUs")
+        parser.add_argument("-socket", help="Unix socket path to listen on instead of TCP", default=None)
+        parser.add_argument("-host", help="TCP host to listen on, default=127.0.0.1", default="127.0.0.1")
+        parser.add_argument("-port", help="TCP port to listen on, default=0 (any free port)", default=0)
+    elif command == "consensus":
+        parser.add_argument("bfh_file", help="BFH index file written by build-index, or a reference tree file to "
+                                             "build the BFH from.  Newick or Nexus, optionally compressed.")
+        parser.add_argument("num_cpu", help="Number of CPUs")
+        parser.add_argument("-method", help="Majority-rule (clades in more than half of the reference trees) or "
+                                            "greedy consensus, default=majority", choices=["majority", "greedy"],
+                            default="majority")
+        parser.add_argument("-min_support", help="Only clades in at least this fraction of the reference trees, "
+                                                 "default=0", default=0.0)
+        parser.add_argument("-output_file", help="Consensus tree file, default=bfhrf_consensus.tre",
+                            default="bfhrf_consensus.tre")
+        parser.add_argument("-annotate", help="Tree file whose trees are written with the reference support of each "
+                                              "bipartition as internal node labels.  Newick or Nexus, optionally "
+                                              "compressed.", default=None)
+        parser.add_argument("-annotate_file", help="Output file of -annotate, default=bfhrf_support.tre",
+                            default="bfhrf_support.tre")
+    elif command == "merge":
+        parser.add_argument("index_file", help="BFH index file to write")
+        parser.add_argument("partial_indexes", nargs='+', help="Partial BFH index files written by build-index, e.g. "
+                                                               "with -shard")
+    else:
+        parser.add_argument("ref_trees",
+                            help="Required reference tree file.  Newick or Nexus, optionally compressed.")
+        parser.add_argument("query_trees",
+                            help="Required query tree file.  Newick or Nexus, optionally compressed.")
+        parser.add_argument("num_taxa", help="Number of taxa")
+        parser.add_argument("num_cpu", help="Number of CPUs")
+    if command == "matrix":
+        parser.add_argument("-output_file", help="Output .npy file (query x reference uint32 RF), "
+                                                 "default=bfhrf_matrix.npy", default="bfhrf_matrix.npy")
+        parser.add_argument("-block_size", help="Rows/columns per tile of the matrix, default=2048", default=2048)
+    elif command not in ("build-index", "update", "merge", "serve", "consensus"):
+        parser.add_argument("-output_file", help="Output file, default=bfhrf_output.txt",
+                            default="bfhrf_output.txt")
+    if command != "merge":
+        parser.add_argument("-parser", help="Tree parser: the built-in Newick tokenizer or Dendropy, default=newick",
+                            choices=["newick", "dendropy"], default="newick")
+    if command is None:
+        parser.add_argument("-bfh_backend", help="BFH storage: sorted NumPy arrays of packed bitmasks, the dict of "
+                                                 "zero-padded binary strings, or a fixed-memory count-min sketch that "
+                                                 "gives approximate RFs with an error bound, default=array",
+                            choices=["array", "dict", "sketch"], default="array")
+        parser.add_argument("-sketch_epsilon", help="With -bfh_backend sketch, bipartition counts are overestimated "
+                                                    "by at most epsilon x the total count, default=1e-6",
+                            default=1e-6)
+        parser.add_argument("-sketch_delta", help="With -bfh_backend sketch, probability of a count exceeding that "
+                                                  "bound, default=0.01", default=0.01)
+        parser.add_argument("-sketch_memory", help="With -bfh_backend sketch, cap on the sketch memory in MB; "
+                                                   "loosens epsilon when it binds", default=None)
+    if command in (None, "build-index", "matrix"):
+        parser.add_argument("-validate", help="Check the Newick tokenizer against Dendropy on the reference trees "
+                                              "before building the BFH", action="store_true")
+    if command != "merge":
+        parser.add_argument("-start_method", help="Multiprocessing start method, default=platform default",
+                            choices=["fork", "spawn", "forkserver"], default=None)
+    if command in ("build-index", "query"):
+        parser.add_argument("-shard", help="Only read shard I/N of the {} file: the I-th (0-based) of N contiguous "
+                                           "blocks of lines".format("reference" if command == "build-index" else
+                                                                    "query"), default=None)
+        parser.add_argument("-lines", help="Only read lines START-END (1-based, inclusive) of the {} file".format(
+            "reference" if command == "build-index" else "query"), default=None)
+    if command == "build-index":
+        parser.add_argument("-taxa_from", help="Tree file whose first tree sets the taxon order, default=ref_trees.  "
+                                               "Partial indexes must share it to be merged", default=None)
+    if command not in ("update", "matrix", "merge", "serve", "consensus"):
+        parser.add_argument("-stream", help="Read trees lazily and feed the pool in bounded batches; query rows are "
+                                            "written as they finish, so memory does not grow with the input files",
+                            action="store_true")
+        parser.add_argument("-batch_size", help="Trees per batch with -stream, default=1000", default=1000)
+    if command in (None, "query"):
+        parser.add_argument("-ordered", help="With -stream, write query rows in input order", action="store_true")
+        parser.add_argument("-top_k", help="Only write the top_k query trees of lowest average RF, best first",
+                            default=None)
+        parser.add_argument("-max_rf", help="Only write query trees with average RF <= max_rf", default=None)
+    if command is None:
+        parser.add_argument("-pipeline", help="Build the BFH and score the query trees with one persistent pool: "
+                                              "queries are parsed while the BFH is finished and scored as soon as "
+                                              "it is, in adaptively sized batches", action="store_true")
+        parser.add_argument("-no_self", help="Parse the trees twice even when ref_trees and query_trees are the "
+                                             "same file", action="store_true")
+    if command in (None, "query", "serve"):
+        parser.add_argument("-cache_size", help="Slots of the score cache shared by the workers, which scores each "
+                                                "distinct query topology once; 0 disables it, default=65536",
+                            default=65536)
+    if command in (None, "query", "matrix", "serve"):
+        parser.add_argument("-bipartition_filter", help="Optional bipartition filtering by size.  Value can be 1 to "
+                                                        "floor(n/2).  Values entered as range: min-max and does not "
+                                                        "include max", type=str, default=None)
+    parser.add_argument("-metrics_file", help="Write per-stage metrics (wall/CPU time, peak RSS, per-worker trees/s "
+                                              "and queue wait, BFH size) to this .json or .csv file", default=None)
+    parser.add_argument("-progress", help="Seconds between progress lines during long phases; 0 disables them, "
+                                          "default=60", default=60)
+    parser.add_argument("-profile_dir", help="Write cProfile stats of the main process and of every worker to this "
+                                             "directory", default=None)
+    parser.add_argument("-trace_memory", help="Trace Python allocations with tracemalloc in the main process and "
+                                              "workers; peaks go to the metrics, top allocations to -profile_dir",
+                        action="store_true")
+    input_args = parser.parse_args(sys.argv[2:] if command else sys.argv[1:])
     print(input_args)
-    main(input_args)
+    commands.get(command, main)(input_args)
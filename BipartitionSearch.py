@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+"""
+Tree search against a Bipartition Frequency Hash (BFH).
+The average RF of a tree q against the reference trees R is (S + |Bq| * |R| - 2 * sum of BFH counts of Bq) / |R|,
+with S the sum of all BFH counts, so each bipartition of q contributes |R| - 2 * count on its own.  An NNI changes
+exactly one bipartition and an SPR only those on the path between the pruned and regrafted positions, so the score
+delta of a neighbor is a difference of a few BFH counts instead of a full re-parse and rescore.
+"""
+
+import argparse
+import numpy as np
+from time import time
+import BipartitionFrequencyHash as bfhrf
+
+__author__ = "Alvin Chon"
+__email__ = "achon@iastate.edu"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+class SearchTree(object):
+    """
+    An unrooted tree held rooted at the leaf of taxon 0.  Every other node's clade bitmask then never contains taxon
+    0, so it is exactly the normalized split of the edge above it, as produced by newick_bitmasks.
+    Nodes are integer ids into the parent/children/clade/taxon lists.
+    """
+
+    def __init__(self, tree_str, taxa):
+        """
+        :param tree_str: Newick string
+        :param taxa: taxon label -> bit index, e.g. BipartitionFrequencyHash.taxon_map
+        """
+        self.taxa = taxa
+        self.labels = sorted(taxa, key=taxa.get)
+        adjacency = []
+        self.taxon = []
+        stack = []
+        after_close = False
+        root_closed = False
+        terminated = False
+        tree_taxa = set()
+        for token in bfhrf.newick_token.findall(tree_str):
+            c = token[0]
+            if root_closed and c in '(),':
+                raise ValueError("Unbalanced parentheses in tree: {}".format(tree_str.strip()))
+            if c == '(':
+                node = len(adjacency)
+                adjacency.append([])
+                self.taxon.append(-1)
+                if stack:
+                    adjacency[stack[-1]].append(node)
+                    adjacency[node].append(stack[-1])
+                stack.append(node)
+                after_close = False
+            elif c == ',':
+                after_close = False
+            elif c == ')':
+                if not stack:
+                    raise ValueError("Unbalanced parentheses in tree: {}".format(tree_str.strip()))
+                stack.pop()
+                root_closed = not stack  # only the root's label, branch length and comments may follow
+                after_close = True
+            elif c == ';':
+                terminated = True
+                break
+            elif c not in ':[' and not c.isspace() and not after_close:
+                label = bfhrf.newick_label(token)
+                if label not in taxa:
+                    raise ValueError("Taxon '{}' is not in the taxon namespace of the BFH".format(label))
+                if label in tree_taxa:
+                    raise ValueError("Taxon '{}' occurs more than once in tree: {}".format(label, tree_str.strip()))
+                tree_taxa.add(label)
+                node = len(adjacency)
+                adjacency.append([])
+                self.taxon.append(taxa[label])
+                if stack:
+                    adjacency[stack[-1]].append(node)
+                    adjacency[node].append(stack[-1])
+        if stack:
+            raise ValueError("Unbalanced parentheses in tree: {}".format(tree_str.strip()))
+        if not terminated:
+            raise ValueError("Tree is not terminated by ';': {}".format(tree_str.strip()))
+        if 0 not in self.taxon:
+            raise ValueError("Tree does not contain taxon '{}'".format(self.labels[0]))
+        # orient away from the leaf of taxon 0
+        self.root = self.taxon.index(0)
+        self.parent = [-1] * len(adjacency)
+        self.children = [[] for _ in adjacency]
+        visited = [False] * len(adjacency)
+        visited[self.root] = True
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            for neighbor in adjacency[node]:
+                if not visited[neighbor]:
+                    visited[neighbor] = True
+                    self.parent[neighbor] = node
+                    self.children[node].append(neighbor)
+                    stack.append(neighbor)
+        # suppress degree-2 nodes, e.g. the Newick root of a tree written with a basal bifurcation
+        for node in range(len(adjacency)):
+            if node != self.root and visited[node] and len(self.children[node]) == 1:
+                self.splice(node)
+        self.clade = [0] * len(adjacency)
+        self.update_clades()
+
+    def splice(self, node):
+        """
+        Removes a node with a single child, connecting the child to the node's parent.
+        :param node:
+        :return:
+        """
+        child = self.children[node][0]
+        parent = self.parent[node]
+        self.children[parent][self.children[parent].index(node)] = child
+        self.parent[child] = parent
+        self.children[node] = []
+        self.parent[node] = -1
+
+    def top(self):
+        """
+        The neighbor of the taxon 0 leaf.
+        :return:
+        """
+        return self.children[self.root][0]
+
+    def postorder(self):
+        """
+        Nodes below the root, children before parents.
+        :return:
+        """
+        order = []
+        stack = [self.top()]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            stack.extend(self.children[node])
+        return order[::-1]
+
+    def update_clades(self):
+        """
+        Recomputes every clade bitmask.
+        :return:
+        """
+        for node in self.postorder():
+            if self.taxon[node] >= 0:
+                self.clade[node] = 1 << self.taxon[node]
+            else:
+                clade = 0
+                for child in self.children[node]:
+                    clade |= self.clade[child]
+                self.clade[node] = clade
+
+    def splits(self):
+        """
+        The tree's split bitmasks, the same set as set(newick_bitmasks(newick)).
+        :return:
+        """
+        return set(self.clade[node] for node in self.postorder()) | {0}
+
+    def ancestors(self, node):
+        """
+        Strict ancestors of a node, nearest first, excluding the taxon 0 leaf.
+        :param node:
+        :return:
+        """
+        ancestors = []
+        node = self.parent[node]
+        while node != self.root:
+            ancestors.append(node)
+            node = self.parent[node]
+        return ancestors
+
+    def nni_moves(self):
+        """
+        All NNIs as ("nni", node, child, sibling): a child of an internal node swaps places with a sibling of the node.
+        Around a binary edge this gives the two alternative topologies.  Only the split above node changes.
+        :return: list of (move, old split, new split)
+        """
+        moves = []
+        for node in self.postorder():
+            parent = self.parent[node]
+            if self.taxon[node] >= 0 or parent == self.root:
+                continue
+            for child in self.children[node]:
+                for sibling in self.children[parent]:
+                    if sibling != node:
+                        new_split = self.clade[node] ^ self.clade[child] ^ self.clade[sibling]
+                        moves.append((("nni", node, child, sibling), [self.clade[node]], [new_split]))
+        return moves
+
+    def spr_moves(self):
+        """
+        All SPRs as ("spr", node, target): prune the subtree below node and regraft it onto the edge above target.
+        The splits that change are those of the pruned attachment point and of the nodes on the path between the
+        old and new positions, which lose or gain the pruned clade.
+        :return: list of (move, old splits, new splits)
+        """
+        moves = []
+        nodes = self.postorder()
+        ancestors = dict((node, self.ancestors(node)) for node in nodes)
+        for node in nodes:
+            parent = self.parent[node]
+            if parent == self.root:
+                continue
+            pruned = self.clade[node]
+            parent_removed = len(self.children[parent]) == 2
+            node_ancestors = set(ancestors[node])
+            for target in nodes:
+                if target == node or target == parent and parent_removed:
+                    continue
+                if parent_removed and self.parent[target] == parent:  # the sibling: same tree
+                    continue
+                if self.clade[target] & pruned and target not in node_ancestors:  # inside the pruned subtree
+                    continue
+                old_splits = []
+                new_splits = []
+                target_ancestors = set(ancestors[target])
+                for ancestor in ancestors[node]:
+                    if ancestor == parent and parent_removed:
+                        old_splits.append(self.clade[parent])
+                    elif ancestor not in target_ancestors:
+                        old_splits.append(self.clade[ancestor])
+                        new_splits.append(self.clade[ancestor] & ~pruned)
+                for ancestor in ancestors[target]:
+                    if ancestor != parent and ancestor not in node_ancestors:
+                        old_splits.append(self.clade[ancestor])
+                        new_splits.append(self.clade[ancestor] | pruned)
+                target_clade = self.clade[target] & ~pruned if target in node_ancestors else self.clade[target]
+                new_splits.append(target_clade | pruned)
+                moves.append((("spr", node, target), old_splits, new_splits))
+        return moves
+
+    def apply(self, move):
+        """
+        Applies a move from nni_moves or spr_moves.
+        :param move:
+        :return:
+        """
+        if move[0] == "nni":
+            kind, node, child, sibling = move
+            parent = self.parent[node]
+            self.children[node][self.children[node].index(child)] = sibling
+            self.children[parent][self.children[parent].index(sibling)] = child
+            self.parent[child] = parent
+            self.parent[sibling] = node
+            self.clade[node] ^= self.clade[child] ^ self.clade[sibling]
+            return
+        kind, node, target = move
+        parent = self.parent[node]
+        self.children[parent].remove(node)
+        if len(self.children[parent]) == 1:
+            self.splice(parent)
+            graft = parent
+        else:
+            graft = len(self.parent)
+            self.parent.append(-1)
+            self.children.append([])
+            self.clade.append(0)
+            self.taxon.append(-1)
+        target_parent = self.parent[target]
+        self.children[target_parent][self.children[target_parent].index(target)] = graft
+        self.parent[graft] = target_parent
+        self.children[graft] = [target, node]
+        self.parent[target] = graft
+        self.parent[node] = graft
+        self.update_clades()
+
+    def newick(self):
+        """
+        Newick string of the tree, written from the neighbor of the taxon 0 leaf.
+        :return:
+        """
+        parts = ['(', bfhrf.newick_quote(self.labels[0]), ',']
+        stack = [')']
+        for i, child in enumerate(reversed(self.children[self.top()])):
+            stack.extend([',', child] if i else [child])
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                parts.append(item)
+            elif self.taxon[item] >= 0:
+                parts.append(bfhrf.newick_quote(self.labels[self.taxon[item]]))
+            else:
+                parts.append('(')
+                stack.append(')')
+                for i, child in enumerate(reversed(self.children[item])):
+                    stack.extend([',', child] if i else [child])
+        return ''.join(parts) + ';'
+
+
+class Scorer(object):
+    """
+    Scores trees and neighbor moves against a complete BipartitionFrequencyHash.BFH (e.g. from BFH.load), honoring
+    its bipartition_range.
+    Scores are kept as integer numerators over num_ref_trees, so deltas are exact.
+    """
+
+    def __init__(self, bfh):
+        """
+        :param bfh: BipartitionFrequencyHash.BFH
+        """
+        self.bfh = bfh
+        self.num_ref_trees = bfh.num_ref_trees
+        self.contributions = {}
+
+    def contribution(self, splits):
+        """
+        num_ref_trees - 2 * BFH count of each split, 0 for splits outside the bipartition size filter.
+        BFH counts are looked up once per distinct split, in one batch for all new ones.
+        :param splits:
+        :return:
+        """
+        missing = [split for split in set(splits) if split not in self.contributions]
+        if missing:
+            for split, count in zip(missing, bfhrf.bfh_counts(self.bfh, missing)):
+                if self.bfh.bipartition_range and not bfhrf.in_bipartition_range(self.bfh, bin(split).count('1')):
+                    self.contributions[split] = 0
+                else:
+                    self.contributions[split] = self.num_ref_trees - 2 * count
+        return [self.contributions[split] for split in splits]
+
+    def score_numerator(self, tree):
+        return self.bfh.ref_trees_sum + sum(self.contribution(list(tree.splits())))
+
+    def score(self, tree):
+        """
+        Average RF of the tree against the reference trees, the same value rf_bfh_mp gives for its Newick string.
+        :param tree:
+        :return:
+        """
+        return self.score_numerator(tree) / self.num_ref_trees
+
+    def neighbor_deltas(self, tree, moves=("nni",)):
+        """
+        Score change of every neighbor of the tree.
+        :param tree:
+        :param moves: move types to enumerate, "nni" and/or "spr"
+        :return: list of (move, score delta); negative deltas are improvements
+        """
+        candidates = []
+        if "nni" in moves:
+            candidates.extend(tree.nni_moves())
+        if "spr" in moves:
+            candidates.extend(tree.spr_moves())
+        self.contribution([split for move, old, new in candidates for split in old + new])
+        deltas = []
+        for move, old_splits, new_splits in candidates:
+            delta = sum(self.contribution(new_splits)) - sum(self.contribution(old_splits))
+            deltas.append((move, delta / self.num_ref_trees))
+        return deltas
+
+
+def hill_climb(tree, scorer, moves=("nni",), max_iterations=None):
+    """
+    Steepest-descent search: applies the best improving neighbor until none improves the average RF.
+    :param tree: SearchTree, modified in place
+    :param scorer:
+    :param moves: move types, "nni" and/or "spr"
+    :param max_iterations:
+    :return: (final score, number of moves applied, number of neighbors scored)
+    """
+    score = scorer.score(tree)
+    iterations = 0
+    num_neighbors = 0
+    while max_iterations is None or iterations < max_iterations:
+        deltas = scorer.neighbor_deltas(tree, moves)
+        num_neighbors += len(deltas)
+        if not deltas:
+            break
+        move, delta = min(deltas, key=lambda move_delta: move_delta[1])
+        if delta >= 0:
+            break
+        tree.apply(move)
+        score = scorer.score(tree)
+        iterations += 1
+    return score, iterations, num_neighbors
+
+
+def main(args):
+    """
+    :param args:
+    :return:
+    """
+    begin_time = time()
+    bfh = bfhrf.BFH.load(args.index_file, bipartition_filter=args.bipartition_filter)
+    scorer = Scorer(bfh)
+    moves = ("nni", "spr") if args.moves == "both" else (args.moves,)
+    max_iterations = int(args.max_iterations) if args.max_iterations else None
+    ofh = open(args.output_file, 'w')
+    for tree_str in bfhrf.read_trees(args.start_trees):
+        start_time = time()
+        tree = SearchTree(tree_str, bfh.taxon_map)
+        start_score = scorer.score(tree)
+        score, iterations, num_neighbors = hill_climb(tree, scorer, moves, max_iterations)
+        search_time = time() - start_time
+        print("||Hill climb: {} -> {} in {} moves, {} neighbors scored: {}s\tRate: {} neighbors/s".format(
+            start_score, score, iterations, num_neighbors, np.around(search_time, 2),
+            np.around(num_neighbors / max(search_time, 1e-9), 2)))
+        ofh.write("{},{}\n".format(tree.newick(), str(score)))
+    ofh.close()
+    print('|STATS: TOTAL TIME: {}s'.format(np.around(time() - begin_time, 2)))
+
+
+if __name__ == "__main__":
+    """Hill-climbing species tree search against a BFH index written by BipartitionFrequencyHash.py build-index."""
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument("index_file", help="BFH index file written by BipartitionFrequencyHash.py build-index")
+    parser.add_argument("start_trees", help="Starting tree file.  Assumes one newick tree per line.")
+    parser.add_argument("-moves", help="Neighborhood: nni, spr or both, default=nni", choices=["nni", "spr", "both"],
+                        default="nni")
+    parser.add_argument("-max_iterations", help="Maximum number of moves per starting tree, default=unlimited",
+                        default=None)
+    parser.add_argument("-bipartition_filter", help="Optional bipartition filtering by size.  Value can be 1 to "
+                                                    "floor(n/2).  Values entered as range: min-max and does not "
+                                                    "include max", type=str, default=None)
+    parser.add_argument("-output_file", help="Output file of final trees and scores, default=bfhrf_search.txt",
+                        default="bfhrf_search.txt")
+    input_args = parser.parse_args()
+    print(input_args)
+    main(input_args)
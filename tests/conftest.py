@@ -0,0 +1,51 @@
+"""
+Shared fixtures: small synthetic tree files from Benchmark.generate_trees and a runner for the command line.
+"""
+
+import os
+import subprocess
+import sys
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+import Benchmark
+
+
+@pytest.fixture(scope="session")
+def tree_files(tmp_path_factory):
+    """
+    Reference and query files over taxa t0..t11, one tree per line.  Each file's trees are one random species tree
+    with a few leaf swaps, so they share bipartitions with each other in varying numbers.
+    :return: (ref_trees file, query_trees file)
+    """
+    data_dir = tmp_path_factory.mktemp("trees")
+    ref_trees = str(data_dir / "ref.tre")
+    query_trees = str(data_dir / "query.tre")
+    Benchmark.generate_trees(ref_trees, 12, 60, 3, 1)
+    Benchmark.generate_trees(query_trees, 12, 25, 2, 2)
+    return ref_trees, query_trees
+
+
+@pytest.fixture
+def run_bfhrf(tmp_path):
+    """
+    :return: function running BipartitionFrequencyHash.py with the given arguments in tmp_path
+    """
+    def run(*args):
+        subprocess.run([sys.executable, os.path.join(root, "BipartitionFrequencyHash.py")] + [str(a) for a in args],
+                       cwd=str(tmp_path), check=True, stdout=subprocess.DEVNULL)
+    return run
+
+
+@pytest.fixture
+def read_rows():
+    """
+    :return: function reading an output file into [(tree, average RF), ...]; every tree is followed by a line holding
+             ",average RF"
+    """
+    def read(output_file):
+        with open(output_file) as ifh:
+            lines = ifh.read().splitlines()
+        return [(tree_str, float(rf[1:])) for tree_str, rf in zip(lines[0::2], lines[1::2])]
+    return read
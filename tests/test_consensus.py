@@ -0,0 +1,55 @@
+"""
+Consensus and support straight from the BFH against Dendropy's majority-rule consensus and split frequencies of the
+same reference trees.
+"""
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Benchmark
+import BipartitionFrequencyHash as bfhrf
+
+dendropy = pytest.importorskip("dendropy")
+
+
+def test_majority_consensus_matches_dendropy(tmp_path):
+    ref_trees = str(tmp_path / "ref.tre")
+    Benchmark.generate_trees(ref_trees, 12, 61, 2, 3)  # few enough swaps for majority clades, no ties at one half
+    bfh = bfhrf.BFH.from_trees(bfhrf.read_trees(ref_trees))
+    tree_list = dendropy.TreeList.get(path=ref_trees, schema="newick", rooting="force-unrooted",
+                                      taxon_namespace=dendropy.TaxonNamespace(bfh.taxa))
+    split_distribution = tree_list.split_distribution()
+    frequencies = split_distribution.split_frequencies
+    consensus = split_distribution.consensus_tree(min_freq=dendropy.utility.constants.GREATER_THAN_HALF)
+    consensus.encode_bipartitions()
+    full = (1 << len(bfh.taxa)) - 1
+    expected = {bipartition.split_bitmask for bipartition in consensus.bipartition_encoding
+                if 1 < bin(bipartition.split_bitmask).count('1') < len(bfh.taxa) - 1}
+    expected = {split if not split & 1 else full ^ split for split in expected}
+    clades, counts = bfhrf.consensus_splits(bfh)
+    assert set(clades) == expected
+    assert clades
+    for clade, count in zip(clades, counts):
+        assert count / bfh.num_ref_trees == pytest.approx(frequencies[clade])
+    # the consensus tree written by BFH.consensus has the same splits
+    splits = bfhrf.newick_bitmasks(bfh.consensus(), bfh.taxon_map)
+    assert {split for split in splits if 1 < bin(split).count('1') < len(bfh.taxa) - 1} == expected
+
+
+def test_annotate_matches_dendropy_frequencies(tree_files):
+    ref_trees, query_trees = tree_files
+    bfh = bfhrf.BFH.from_trees(bfhrf.read_trees(ref_trees))
+    tns = dendropy.TaxonNamespace(bfh.taxa)
+    tree_list = dendropy.TreeList.get(path=ref_trees, schema="newick", rooting="force-unrooted", taxon_namespace=tns)
+    frequencies = tree_list.split_distribution().split_frequencies
+    full = (1 << len(bfh.taxa)) - 1
+    for tree_str in bfhrf.read_trees(query_trees):
+        annotated = dendropy.Tree.get(data=bfh.annotate(tree_str), schema="newick", rooting="force-unrooted",
+                                      taxon_namespace=tns)
+        annotated.encode_bipartitions(collapse_unrooted_basal_bifurcation=False)
+        for node in annotated.internal_nodes(exclude_seed_node=True):
+            split = node.edge.bipartition.leafset_bitmask
+            split = full ^ split if split & 1 else split
+            assert float(node.label) == pytest.approx(frequencies.get(split, 0.0), abs=5e-4)
@@ -0,0 +1,39 @@
+"""
+Bipartition filtering: the filtered average RF equals the mean RF over the reference trees computed pair by pair,
+counting only the splits whose smaller side has min to max-1 taxa.
+"""
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import BipartitionFrequencyHash as bfhrf
+
+
+def filtered_splits(tree_str, taxa, low, high):
+    """
+    :param tree_str:
+    :param taxa: taxon label -> bit index
+    :param low:
+    :param high:
+    :return: set of the split bitmasks of the tree whose smaller side has low to high-1 taxa
+    """
+    return {bitmask for bitmask in bfhrf.newick_bitmasks(tree_str, taxa)
+            if low <= min(bin(bitmask).count('1'), len(taxa) - bin(bitmask).count('1')) < high}
+
+
+@pytest.mark.parametrize("backend", ["array", "dict"])
+@pytest.mark.parametrize("num_cpu", [None, 2])
+@pytest.mark.parametrize("low, high", [(2, 4), (3, 7), (1, 2)])
+def test_filter_matches_brute_force(tree_files, backend, num_cpu, low, high):
+    ref_trees, query_trees = tree_files
+    bfh = bfhrf.BFH.from_trees(bfhrf.read_trees(ref_trees), bipartition_filter=(low, high), backend=backend,
+                               num_cpu=num_cpu)
+    query = list(bfhrf.read_trees(query_trees))
+    ref_splits = [filtered_splits(tree_str, bfh.taxon_map, low, high) for tree_str in bfhrf.read_trees(ref_trees)]
+    expected = []
+    for tree_str in query:
+        splits = filtered_splits(tree_str, bfh.taxon_map, low, high)
+        expected.append(sum(len(splits ^ other) for other in ref_splits) / len(ref_splits))
+    assert bfh.score_many(query) == pytest.approx(expected)
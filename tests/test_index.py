@@ -0,0 +1,77 @@
+"""
+BFH index files: a saved index scores the query trees exactly like the BFH it was written from, and headers that do
+not match (magic, version, taxa) are rejected.
+"""
+
+import json
+import os
+import shutil
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import BipartitionFrequencyHash as bfhrf
+
+
+def test_saved_index_reproduces_scores(tree_files, tmp_path):
+    ref_trees, query_trees = tree_files
+    bfh = bfhrf.BFH.from_trees(bfhrf.read_trees(ref_trees))
+    index_file = str(tmp_path / "ref.idx")
+    bfh.save(index_file)
+    loaded = bfhrf.BFH.load(index_file)
+    assert loaded.taxa == bfh.taxa
+    assert loaded.num_ref_trees == bfh.num_ref_trees
+    assert len(loaded) == len(bfh)
+    query = list(bfhrf.read_trees(query_trees))
+    assert loaded.score_many(query) == bfh.score_many(query)
+
+
+def test_query_command_matches_default(tree_files, tmp_path, run_bfhrf, read_rows):
+    ref_trees, query_trees = tree_files
+    run_bfhrf(ref_trees, query_trees, 12, 1, "-output_file", "default.txt")
+    run_bfhrf("build-index", ref_trees, "ref.idx", 12, 1)
+    run_bfhrf("query", "ref.idx", query_trees, 1, "-output_file", "query.txt")
+    assert read_rows(tmp_path / "query.txt") == read_rows(tmp_path / "default.txt")
+
+
+def rewrite_header(index_file, changes):
+    """
+    :param index_file: index file to rewrite in place
+    :param changes: header fields to set
+    :return:
+    """
+    with open(index_file, 'rb') as ifh:
+        magic = ifh.read(len(bfhrf.index_magic))
+        header_len = int.from_bytes(ifh.read(8), 'little')
+        header = json.loads(ifh.read(header_len).decode())
+        data = ifh.read()
+    header.update(changes)
+    header = json.dumps(header).encode()
+    with open(index_file, 'wb') as ofh:
+        ofh.write(magic + len(header).to_bytes(8, 'little') + header + data)
+
+
+def test_rejects_mismatched_headers(tree_files, tmp_path):
+    ref_trees, query_trees = tree_files
+    index_file = str(tmp_path / "ref.idx")
+    bfhrf.BFH.from_trees(bfhrf.read_trees(ref_trees)).save(index_file)
+
+    other_version = str(tmp_path / "version.idx")
+    shutil.copyfile(index_file, other_version)
+    rewrite_header(other_version, {"version": bfhrf.index_version - 1})
+    with pytest.raises(ValueError, match="version"):
+        bfhrf.BFH.load(other_version)
+
+    not_index = str(tmp_path / "not.idx")
+    with open(not_index, 'w') as ofh:
+        ofh.write("(t0,t1,(t2,t3));\n")
+    with pytest.raises(ValueError, match="not a BFH index"):
+        bfhrf.BFH.load(not_index)
+
+    # Query trees must be over the taxa of the index
+    other_taxa = str(tmp_path / "taxa.idx")
+    shutil.copyfile(index_file, other_taxa)
+    taxa = bfhrf.read_index(index_file)[0]["taxa"]
+    rewrite_header(other_taxa, {"taxa": ["x" + label for label in taxa]})
+    with pytest.raises(ValueError, match="not in the taxon namespace"):
+        bfhrf.BFH.load(other_taxa).score_many(bfhrf.read_trees(query_trees))
@@ -0,0 +1,50 @@
+"""
+Sharded builds: merging the partial indexes of the shards gives the index of a full build, also when the partials
+have keys of different widths, and partials with different taxon orders are rejected.
+"""
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import BipartitionFrequencyHash as bfhrf
+
+
+def read_bytes(path):
+    with open(path, 'rb') as ifh:
+        return ifh.read()
+
+
+def test_merged_shards_equal_full_build(tree_files, tmp_path, run_bfhrf):
+    ref_trees, query_trees = tree_files
+    run_bfhrf("build-index", ref_trees, "full.idx", 12, 1)
+    for shard in range(3):
+        run_bfhrf("build-index", ref_trees, "part{}.idx".format(shard), 12, 1, "-shard", "{}/3".format(shard))
+    run_bfhrf("merge", "merged.idx", "part0.idx", "part1.idx", "part2.idx")
+    assert read_bytes(tmp_path / "merged.idx") == read_bytes(tmp_path / "full.idx")
+
+
+def test_merge_widens_keys(tree_files, tmp_path, run_bfhrf):
+    ref_trees, query_trees = tree_files
+    run_bfhrf("build-index", ref_trees, "full.idx", 100, 1)
+    run_bfhrf("build-index", ref_trees, "narrow.idx", 12, 1, "-shard", "0/2")
+    run_bfhrf("build-index", ref_trees, "wide.idx", 100, 1, "-shard", "1/2")
+    assert bfhrf.read_index(str(tmp_path / "narrow.idx"))[1].num_words < \
+        bfhrf.read_index(str(tmp_path / "wide.idx"))[1].num_words
+    run_bfhrf("merge", "merged.idx", "narrow.idx", "wide.idx")
+    assert read_bytes(tmp_path / "merged.idx") == read_bytes(tmp_path / "full.idx")
+    query = list(bfhrf.read_trees(query_trees))
+    assert bfhrf.BFH.load(str(tmp_path / "merged.idx")).score_many(query) == \
+        bfhrf.BFH.from_trees(bfhrf.read_trees(ref_trees)).score_many(query)
+
+
+def test_merge_rejects_other_taxon_order(tree_files, tmp_path, run_bfhrf):
+    ref_trees, query_trees = tree_files
+    taxa = bfhrf.BFH.from_trees(bfhrf.read_trees(ref_trees)).taxa
+    with open(tmp_path / "reversed.tre", 'w') as ofh:
+        ofh.write("(" + ",".join(reversed(taxa)) + ");\n")
+    run_bfhrf("build-index", ref_trees, "part0.idx", 12, 1, "-shard", "0/2")
+    run_bfhrf("build-index", ref_trees, "part1.idx", 12, 1, "-shard", "1/2", "-taxa_from", "reversed.tre")
+    with pytest.raises(ValueError, match="different taxon order"):
+        bfhrf.BFH.merge_files([str(tmp_path / "part0.idx"), str(tmp_path / "part1.idx")])
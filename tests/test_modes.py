@@ -0,0 +1,33 @@
+"""
+Command line modes against the default path: the same query trees must get the same average RFs.
+"""
+
+import pytest
+
+
+@pytest.fixture
+def default_rows(tree_files, tmp_path, run_bfhrf, read_rows):
+    ref_trees, query_trees = tree_files
+    run_bfhrf(ref_trees, query_trees, 12, 2, "-output_file", "default.txt")
+    return read_rows(tmp_path / "default.txt")
+
+
+def test_stream_matches_default(tree_files, tmp_path, run_bfhrf, read_rows, default_rows):
+    ref_trees, query_trees = tree_files
+    run_bfhrf(ref_trees, query_trees, 12, 2, "-stream", "-batch_size", 4, "-output_file", "stream.txt")
+    assert sorted(read_rows(tmp_path / "stream.txt")) == sorted(default_rows)
+    run_bfhrf(ref_trees, query_trees, 12, 2, "-stream", "-batch_size", 4, "-ordered", "-output_file", "ordered.txt")
+    assert read_rows(tmp_path / "ordered.txt") == default_rows
+
+
+def test_pipeline_matches_default(tree_files, tmp_path, run_bfhrf, read_rows, default_rows):
+    ref_trees, query_trees = tree_files
+    run_bfhrf(ref_trees, query_trees, 12, 2, "-pipeline", "-output_file", "pipeline.txt")
+    assert read_rows(tmp_path / "pipeline.txt") == default_rows
+
+
+def test_self_mode_matches_default(tree_files, tmp_path, run_bfhrf, read_rows):
+    ref_trees, query_trees = tree_files
+    run_bfhrf(ref_trees, ref_trees, 12, 2, "-output_file", "self.txt")
+    run_bfhrf(ref_trees, ref_trees, 12, 2, "-no_self", "-output_file", "no_self.txt")
+    assert read_rows(tmp_path / "self.txt") == read_rows(tmp_path / "no_self.txt")
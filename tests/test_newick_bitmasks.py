@@ -0,0 +1,50 @@
+"""
+newick_bitmasks against Dendropy's encode_bipartitions on the Newick features the tokenizer handles.
+"""
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import BipartitionFrequencyHash as bfhrf
+
+dendropy = pytest.importorskip("dendropy")
+
+trees = {
+    "unrooted": "((A,B),(C,D),E);",
+    "rooted": "[&R] ((A,B),(C,(D,E)));",
+    "unrooted tag": "[&U] ((A,B),(C,(D,E)),F);",
+    "basal bifurcation": "((A,B),(C,(D,E)));",
+    "basal bifurcation unrooted tag": "[&U] ((A,B),((C,F),(D,E)));",
+    "basal bifurcation leaf": "(A,(B,(C,(D,E))));",
+    "unifurcations": "(((A,B)),((C)),(D,E));",
+    "unifurcating root": "(((A,B),(C,D),E));",
+    "rooted unifurcations": "[&R] ((((A,B)),C),(D,E));",
+    "branch lengths and labels": "((A:0.1,B:0.2)0.95:0.3,(C:1e-3,D:4)lbl:5,E:1)root:0.0;",
+    "quoted labels": "(('A x',B_y),('it''s',D),'(E,F);');",
+    "comments": "[tree 1] ((A[&a=1],B)[&&NHX:S=x]:1[x],(C,[y]D)[z],E)[&R-not-a-tag];",
+    "comment before rooting tag": "[note] [&R] ((A,B),(C,D));",
+    "whitespace": "  ( ( A , B ) ,\t( C , D ) , E ) ;\n",
+}
+
+
+def dendropy_splits(tree_str, labels):
+    tree = dendropy.Tree.get(data=tree_str, schema="newick", taxon_namespace=dendropy.TaxonNamespace(labels))
+    tree.encode_bipartitions()
+    return sorted(bp.split_bitmask for bp in tree.bipartition_encoding)
+
+
+@pytest.mark.parametrize("name", sorted(trees))
+def test_matches_dendropy(name):
+    labels = bfhrf.newick_taxa(trees[name])
+    taxa = {label: i for i, label in enumerate(labels)}
+    assert sorted(bfhrf.newick_bitmasks(trees[name], taxa)) == dendropy_splits(trees[name], labels)
+
+
+@pytest.mark.parametrize("tree_str", ["((A,B)", "(", "((A,B),(C,D),E)", "((A,B),(C,D),E));", "((A,B),(C,D)),(E);",
+                                      "((A,A),(C,D),E);"])
+def test_rejects_malformed(tree_str):
+    taxa = {label: i for i, label in enumerate("ABCDE")}
+    with pytest.raises(ValueError):
+        bfhrf.newick_bitmasks(tree_str, taxa)
@@ -0,0 +1,92 @@
+"""
+Tree file input: Newick trees spanning or sharing lines, Nexus TREES blocks and compressed files give the same trees,
+and the same scores, as a plain file of one tree per line.
+"""
+
+import bz2
+import gzip
+import lzma
+import os
+import re
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import BipartitionFrequencyHash as bfhrf
+
+
+@pytest.fixture
+def plain(tree_files):
+    """
+    :return: (query trees file, its trees, their split bitmasks, their scores against the reference trees)
+    """
+    ref_trees, query_trees = tree_files
+    bfh = bfhrf.BFH.from_trees(bfhrf.read_trees(ref_trees))
+    trees = list(bfhrf.read_trees(query_trees))
+    return query_trees, trees, [bfhrf.newick_bitmasks(tree_str, bfh.taxon_map) for tree_str in trees], \
+        bfh.score_many(trees)
+
+
+def check_trees(trees_file, tree_files, plain):
+    """
+    Asserts that a tree file holds the trees of the plain query file.
+    :param trees_file:
+    :param tree_files: fixture
+    :param plain: fixture
+    :return:
+    """
+    query_trees, trees, bitmasks, rfs = plain
+    bfh = bfhrf.BFH.from_trees(bfhrf.read_trees(tree_files[0]))
+    read = list(bfhrf.read_trees(trees_file))
+    assert [bfhrf.newick_bitmasks(tree_str, bfh.taxon_map) for tree_str in read] == bitmasks
+    assert bfh.score_many(read) == rfs
+
+
+def test_split_statements_multi_line(tree_files, plain, tmp_path):
+    query_trees, trees, bitmasks, rfs = plain
+    quoted = [tree_str.strip().replace("t0", "'t;0'") for tree_str in trees]  # a ';' inside a quoted label
+    text = ""
+    for i, tree_str in enumerate(quoted):
+        if i % 3 == 0:  # spanning lines, after a comment holding a ';'
+            text += "[note; {}]\n".format(i) + tree_str.replace(",", ",\n  ") + "\n\n"
+        elif i % 3 == 1:  # sharing a line with the next tree
+            text += tree_str + " "
+        else:
+            text += tree_str + "\n"
+    statements = list(bfhrf.split_statements(text.splitlines(True)))
+    taxa = {label.replace("t0", "t;0"): index for label, index in bfhrf.BFH.from_trees(trees).taxon_map.items()}
+    assert [bfhrf.newick_bitmasks(statement, taxa) for statement in statements] == \
+        [bfhrf.newick_bitmasks(tree_str, taxa) for tree_str in quoted]
+    multi_line = str(tmp_path / "multi_line.tre")
+    with open(multi_line, 'w') as ofh:
+        ofh.write(text.replace("'t;0'", "t0"))
+    check_trees(multi_line, tree_files, plain)
+
+
+def nexus_text(trees):
+    """
+    :param trees: Newick strings over taxa t0..t11
+    :return: Nexus file with the trees in a TREES block, taxa numbered through a TRANSLATE table
+    """
+    translate = ",\n".join("        {} t{}".format(i + 1, i) for i in range(12))
+    tree_lines = ["    tree tree_{} = [&U] {}".format(i, re.sub(r"\bt(\d+)\b", lambda m: str(int(m.group(1)) + 1),
+                                                                  tree_str.strip()))
+                  for i, tree_str in enumerate(trees)]
+    return "#NEXUS\nbegin taxa;\n    dimensions ntax=12;\nend;\nbegin trees;\n    translate\n{};\n{}\nend;\n".format(
+        translate, "\n".join(tree_lines))
+
+
+def test_nexus_trees_block(tree_files, plain, tmp_path):
+    nexus = str(tmp_path / "query.nex")
+    with open(nexus, 'w') as ofh:
+        ofh.write(nexus_text(plain[1]))
+    check_trees(nexus, tree_files, plain)
+
+
+@pytest.mark.parametrize("compressor", [gzip, bz2, lzma])
+def test_compressed_input(tree_files, plain, tmp_path, compressor):
+    for name, text in (("query.tre", open(plain[0]).read()), ("query.nex", nexus_text(plain[1]))):
+        compressed = str(tmp_path / (name + ".compressed"))
+        with compressor.open(compressed, 'wt') as ofh:
+            ofh.write(text)
+        check_trees(compressed, tree_files, plain)
@@ -0,0 +1,70 @@
+"""
+Average RF of the BFH against the mean of Dendropy's symmetric_difference over the reference trees.
+"""
+
+import os
+import random
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import BipartitionFrequencyHash as bfhrf
+
+dendropy = pytest.importorskip("dendropy")
+from dendropy.calculate import treecompare
+
+labels = ["T{}".format(i) for i in range(9)]
+
+
+def random_tree(rng, num_leaves=len(labels)):
+    """
+    :param rng: random.Random
+    :param num_leaves: taxa T0 .. T(num_leaves-1)
+    :return: Newick string of a random unrooted topology, with a polytomy now and then
+    """
+    subtrees = labels[:num_leaves]
+    rng.shuffle(subtrees)
+    while len(subtrees) > 3:
+        size = 3 if len(subtrees) > 4 and rng.random() < 0.2 else 2
+        joined = [subtrees.pop(rng.randrange(len(subtrees))) for _ in range(size)]
+        subtrees.append("(" + ",".join(joined) + ")")
+    return "(" + ",".join(subtrees) + ");"
+
+
+def dendropy_average_rf(query_tree, ref_trees):
+    tns = dendropy.TaxonNamespace(labels)
+    query = dendropy.Tree.get(data=query_tree, schema="newick", taxon_namespace=tns)
+    refs = [dendropy.Tree.get(data=tree_str, schema="newick", taxon_namespace=tns) for tree_str in ref_trees]
+    return sum(treecompare.symmetric_difference(query, ref) for ref in refs) / len(refs)
+
+
+@pytest.mark.parametrize("backend", ["array", "dict"])
+@pytest.mark.parametrize("num_cpu", [None, 1])
+def test_matches_dendropy(backend, num_cpu):
+    rng = random.Random(9)
+    ref_trees = [random_tree(rng) for _ in range(25)]
+    # half the queries are reference trees, so their bipartitions are shared with only some reference trees
+    query_trees = [random_tree(rng) for _ in range(5)] + ref_trees[:5]
+    bfh = bfhrf.BFH.from_trees(ref_trees, taxa=labels, backend=backend, num_cpu=num_cpu)
+    rfs = bfh.score_many(query_trees)
+    assert rfs == pytest.approx([dendropy_average_rf(tree_str, ref_trees) for tree_str in query_trees])
+
+
+def test_instances_are_independent():
+    rng = random.Random(22)
+    ref_trees = [[random_tree(rng) for _ in range(10)] for _ in range(2)]
+    query_trees = [random_tree(rng) for _ in range(5)]
+    bfhs = [bfhrf.BFH(taxa=labels) for _ in ref_trees]
+    # interleaved, so state written for one BFH would show up in the other's scores
+    for i in range(10):
+        for bfh, trees in zip(bfhs, ref_trees):
+            bfh.update(add=trees[i:i + 1])
+    for bfh, trees in zip(bfhs, ref_trees):
+        assert bfh.score_many(query_trees) == pytest.approx([dendropy_average_rf(tree_str, trees)
+                                                             for tree_str in query_trees])
+
+
+def test_consensus_needs_array_backend():
+    bfh = bfhrf.BFH.from_trees([random_tree(random.Random(1)) for _ in range(3)], taxa=labels, backend="dict")
+    with pytest.raises(ValueError):
+        bfh.consensus()
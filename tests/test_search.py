@@ -0,0 +1,42 @@
+"""
+BipartitionSearch: the score delta of every NNI and SPR neighbor equals a full rescoring of the modified tree, and
+start trees that newick_bitmasks rejects are rejected too.
+"""
+
+import copy
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import BipartitionFrequencyHash as bfhrf
+import BipartitionSearch
+
+
+@pytest.mark.parametrize("moves", [("nni",), ("spr",)])
+@pytest.mark.parametrize("bipartition_filter", [None, (2, 5)])
+def test_deltas_match_full_rescoring(tree_files, moves, bipartition_filter):
+    ref_trees, query_trees = tree_files
+    bfh = bfhrf.BFH.from_trees(bfhrf.read_trees(ref_trees), bipartition_filter=bipartition_filter)
+    scorer = BipartitionSearch.Scorer(bfh)
+    for tree_str in list(bfhrf.read_trees(query_trees))[:3]:
+        tree = BipartitionSearch.SearchTree(tree_str, bfh.taxon_map)
+        score = bfh.score(tree.newick())
+        assert scorer.score(tree) == pytest.approx(score)
+        deltas = scorer.neighbor_deltas(tree, moves)
+        assert deltas
+        for move, delta in deltas:
+            neighbor = copy.deepcopy(tree)
+            neighbor.apply(move)
+            assert set(neighbor.splits()) == set(bfhrf.newick_bitmasks(neighbor.newick(), bfh.taxon_map))
+            assert score + delta == pytest.approx(bfh.score(neighbor.newick()))
+
+
+@pytest.mark.parametrize("tree_str", ["((t0,t1),(t2,t3)));", "((t0,t1),(t2,t3);", "((t0,t1),t2),(t3,t4));",
+                                      "((t0,t1),(t2,t1));", "((t0,t1),(t2,t3))"])
+def test_rejects_malformed_start_trees(tree_str):
+    taxa = {"t{}".format(i): i for i in range(5)}
+    with pytest.raises(ValueError):
+        bfhrf.newick_bitmasks(tree_str, taxa)
+    with pytest.raises(ValueError):
+        BipartitionSearch.SearchTree(tree_str, taxa)
@@ -0,0 +1,39 @@
+"""
+-top_k and -max_rf: the selected rows are exactly those of full scoring sorted by average RF (ties in input order)
+or thresholded, even though the workers skip trees that cannot be selected.
+"""
+
+import pytest
+
+
+@pytest.fixture
+def query_file(tree_files, tmp_path):
+    """
+    The query trees followed by the reference trees, which repeat each other's scores so that there are ties.
+    """
+    ref_trees, query_trees = tree_files
+    with open(query_trees) as query_fh, open(ref_trees) as ref_fh, open(tmp_path / "query.tre", 'w') as ofh:
+        ofh.write(query_fh.read() + ref_fh.read())
+    return str(tmp_path / "query.tre")
+
+
+@pytest.fixture
+def default_rows(tree_files, query_file, tmp_path, run_bfhrf, read_rows):
+    run_bfhrf(tree_files[0], query_file, 12, 2, "-output_file", "default.txt")
+    return read_rows(tmp_path / "default.txt")
+
+
+@pytest.mark.parametrize("top_k", [1, 7, 200])
+def test_top_k_matches_sorted_scores(tree_files, query_file, tmp_path, run_bfhrf, read_rows, default_rows, top_k):
+    run_bfhrf(tree_files[0], query_file, 12, 2, "-top_k", top_k, "-batch_size", 5, "-output_file", "top_k.txt")
+    assert read_rows(tmp_path / "top_k.txt") == sorted(default_rows, key=lambda row: row[1])[:top_k]
+
+
+def test_max_rf_matches_threshold(tree_files, query_file, tmp_path, run_bfhrf, read_rows, default_rows):
+    max_rf = sorted(rf for tree_str, rf in default_rows)[len(default_rows) // 2]
+    run_bfhrf(tree_files[0], query_file, 12, 2, "-max_rf", max_rf, "-batch_size", 5, "-output_file", "max_rf.txt")
+    assert read_rows(tmp_path / "max_rf.txt") == [row for row in default_rows if row[1] <= max_rf]
+    run_bfhrf(tree_files[0], query_file, 12, 2, "-max_rf", max_rf, "-top_k", 7, "-batch_size", 5, "-output_file",
+              "both.txt")
+    assert read_rows(tmp_path / "both.txt") == sorted([row for row in default_rows if row[1] <= max_rf],
+                                                      key=lambda row: row[1])[:7]
@@ -0,0 +1,43 @@
+"""
+The serve command: a server on an ephemeral port answers query_server with the scores of the default path, reports
+bad trees as errors and stops on a shutdown request.
+"""
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+import BipartitionFrequencyHash as bfhrf
+
+
+def test_serve_round_trip(tree_files):
+    ref_trees, query_trees = tree_files
+    server = subprocess.Popen([sys.executable, os.path.join(root, "BipartitionFrequencyHash.py"), "serve", ref_trees,
+                               "1", "-port", "0"], stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        for line in server.stdout:
+            if line.startswith("|Serving"):
+                break
+        host, port = line.split()[-1].rsplit(":", 1)
+        address = (host, int(port))
+        query = list(bfhrf.read_trees(query_trees))
+        rfs = bfhrf.query_server(address, query, timeout=60)
+        assert rfs == pytest.approx(bfhrf.BFH.from_trees(bfhrf.read_trees(ref_trees)).score_many(query))
+        with pytest.raises(ValueError, match="not in the taxon namespace"):
+            bfhrf.query_server(address, ["(x0,x1,(x2,x3));"], timeout=60)
+        with socket.create_connection(address, timeout=60) as client:
+            client.sendall((json.dumps({"command": "shutdown"}) + "\n").encode())
+            with client.makefile('rb') as response_file:
+                assert json.loads(response_file.readline()) == {"shutdown": True}
+        server.stdout.read()
+        assert server.wait(timeout=60) == 0
+    finally:
+        if server.poll() is None:
+            server.kill()
+            server.wait()
+        server.stdout.close()
@@ -0,0 +1,32 @@
+"""
+Sketch backend: the count-min sketch never undercounts a bipartition, however small it is, and its per-popcount
+totals are exact.
+"""
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import BipartitionFrequencyHash as bfhrf
+
+
+@pytest.mark.parametrize("sketch_memory", [None, 64])
+def test_sketch_never_undercounts(tree_files, sketch_memory):
+    ref_trees, query_trees = tree_files
+    exact = bfhrf.BFH.from_trees(bfhrf.read_trees(ref_trees))
+    sketch = bfhrf.BFH(backend="sketch", num_cpu=1, sketch_epsilon=1e-3, sketch_memory=sketch_memory)
+    sketch.build_file(ref_trees)
+    try:
+        assert sketch.num_ref_trees == exact.num_ref_trees
+        assert sketch.ref_trees_bipartitions.total() == exact.ref_trees_bipartitions.total()
+        trees = list(bfhrf.read_trees(ref_trees)) + list(bfhrf.read_trees(query_trees))
+        bitmasks = sorted({bitmask for tree_str in trees
+                           for bitmask in bfhrf.newick_bitmasks(tree_str, exact.taxon_map)})
+        estimates = bfhrf.bfh_counts(sketch, bitmasks)
+        counts = bfhrf.bfh_counts(exact, bitmasks)
+        assert all(estimate >= count for estimate, count in zip(estimates, counts))
+        if sketch_memory:  # a handful of counters per row: bipartitions collide, and are overcounted
+            assert estimates != counts
+    finally:
+        sketch.release()
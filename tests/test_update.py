@@ -0,0 +1,51 @@
+"""
+BFH.update: removing trees that were added restores the BFH, and removing trees that were never added is an error
+that leaves the BFH unchanged.
+"""
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import BipartitionFrequencyHash as bfhrf
+
+
+def bfh_counts(bfh):
+    """
+    :param bfh:
+    :return: {bipartition key: count} of either backend
+    """
+    bipartitions = bfh.ref_trees_bipartitions
+    if bfh.bfh_backend == "array":
+        return {key.tobytes(): int(count) for key, count in zip(bipartitions.keys_array, bipartitions.counts)}
+    return dict(bipartitions)
+
+
+@pytest.mark.parametrize("backend", ["array", "dict"])
+@pytest.mark.parametrize("num_cpu", [None, 2])
+def test_add_then_remove_restores_bfh(tree_files, backend, num_cpu):
+    ref_trees, query_trees = tree_files
+    bfh = bfhrf.BFH.from_trees(bfhrf.read_trees(ref_trees), backend=backend, num_cpu=num_cpu)
+    counts = bfh_counts(bfh)
+    num_ref_trees = bfh.num_ref_trees
+    added = list(bfhrf.read_trees(query_trees))
+    bfh.update(add=added)
+    assert bfh.num_ref_trees == num_ref_trees + len(added)
+    assert bfh_counts(bfh) != counts
+    bfh.update(remove=added)
+    assert bfh.num_ref_trees == num_ref_trees
+    assert bfh_counts(bfh) == counts
+    assert bfh.score_many(added) == bfhrf.BFH.from_trees(bfhrf.read_trees(ref_trees), backend=backend).score_many(added)
+
+
+@pytest.mark.parametrize("backend", ["array", "dict"])
+def test_remove_absent_trees(tree_files, backend):
+    ref_trees, query_trees = tree_files
+    bfh = bfhrf.BFH.from_trees(bfhrf.read_trees(ref_trees), backend=backend)
+    counts = bfh_counts(bfh)
+    num_ref_trees = bfh.num_ref_trees
+    with pytest.raises(ValueError, match="not in the BFH"):
+        bfh.update(remove=bfhrf.read_trees(query_trees))
+    assert bfh.num_ref_trees == num_ref_trees
+    assert bfh_counts(bfh) == counts